@@ -1,39 +1,99 @@
 import os
 import json
+import asyncio
+import inspect
+import weakref
 import re
 import base64
+import contextlib
+import contextvars
+import atexit
+import datetime
+import functools
+import hashlib
+import html
+import importlib
+import importlib.util
+import math
+import random
+import sqlite3
+import tempfile
+import uuid
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable, Iterator, AsyncIterator, NamedTuple, Union
 
+import pydantic
 import streamlit as st
 import yaml
-import altair as alt
 
-# --- Optional PDF / OCR libraries ---
-try:
-    from PyPDF2 import PdfReader
-except ImportError:
-    PdfReader = None
+# -----------------------------------------------------------
+# Lazy Imports (provider SDKs, charting, PDF / OCR libraries)
+# -----------------------------------------------------------
 
-try:
-    from pdf2image import convert_from_bytes
-except ImportError:
-    convert_from_bytes = None
+class LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access.
+    Streamlit re-executes this script on every interaction, so provider SDKs
+    and PDF / OCR libraries are loaded when a feature first needs them rather
+    than before the first paint. `available` checks installation without
+    importing, for optional libraries.
+    """
 
-try:
-    import pytesseract
-except ImportError:
-    pytesseract = None
+    def __init__(self, name: str):
+        self._name = name
+        self._module: Any = None
+        self._available: Optional[bool] = None
 
-# --- LLM client libraries ---
-from openai import OpenAI
-import google.generativeai as genai
-from anthropic import Anthropic
+    def load(self) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            self._available = True
+        return self._module
 
-# --- xAI (Grok) SDK (per official sample) ---
-from xai_sdk import Client as XaiClient
-from xai_sdk.chat import user as xai_user, system as xai_system
-# from xai_sdk.chat import image as xai_image  # for future image OCR use
+    @property
+    def available(self) -> bool:
+        if self._available is None:
+            try:
+                self._available = importlib.util.find_spec(self._name) is not None
+            except (ImportError, ValueError):
+                self._available = False
+        return self._available
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr: str) -> Any:
+        if attr.startswith("_"):
+            if attr in ("_name", "_module", "_available"):
+                raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+# --- LLM client libraries (imported on the first call to each provider) ---
+openai = LazyModule("openai")
+genai = LazyModule("google.generativeai")
+anthropic = LazyModule("anthropic")
+# xAI (Grok) SDK (per official sample)
+xai_sdk = LazyModule("xai_sdk")
+xai_chat = LazyModule("xai_sdk.chat")
+# xai_chat.image is available for future image OCR use
+
+# --- Charting and optional PDF / OCR libraries ---
+alt = LazyModule("altair")
+PyPDF2 = LazyModule("PyPDF2")
+pdf2image = LazyModule("pdf2image")
+pytesseract = LazyModule("pytesseract")
+fitz = LazyModule("fitz")  # PyMuPDF
+tiktoken = LazyModule("tiktoken")
+opentelemetry_trace = LazyModule("opentelemetry.trace")  # optional telemetry exporter
 
 # -----------------------------------------------------------
 # Nordic Theme + Flower Styles Configuration
@@ -192,14 +252,13 @@ def init_session_state():
         "flower_style": "Edelweiss",
         "player_level": 1,
         "health": 100,
-        "mana": 100,
         "experience": 0,
         "quests_completed": 0,
         "achievements": [],
-        "combat_log": [],
         "template": "## 案件模板\n\n在此撰寫或貼上 510(k) 案件相關模板內容...",
         "observations": "在此新增臨床、風險或技術觀察備註...",
         "pipeline_history": [],
+        "pipeline_resume": None,
         "note_raw_text": "",
         "note_markdown": "",
         "note_formatted": "",
@@ -213,24 +272,245 @@ def init_session_state():
         "ocr_global_keywords": "510(k), substantial equivalence, risk, performance testing, adverse event, indication, predicate device, 臨床, 風險, 性能測試, 適應症",
         "combined_markdown": "",
         "combined_entities": [],
+        "combined_entities_fingerprint": "",
         "combined_qa_history": [],
+        # LLM response cache
+        "llm_cache_enabled": True,
+        "llm_cache_hits": 0,
+        "llm_cache_misses": 0,
+        "telemetry_session": uuid.uuid4().hex[:12],
+        # Provider-side prompt caching
+        "prompt_cache_enabled": True,
+        # Token budget
+        "token_budget_policy": DEFAULT_TOKEN_BUDGET_POLICY,
     }
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
+    # Activity log (ActivityLog ring buffer) under "combat_log"
+    get_activity_log()
 
 # -----------------------------------------------------------
-# Utility Functions
+# Agent Registry (validated agents.yaml, indexed, reloaded on change)
 # -----------------------------------------------------------
 
-@st.cache_data
-def load_agents_config(path: str = "agents.yaml") -> Dict[str, Any]:
-    """Load agents configuration from YAML file"""
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f)
-    except FileNotFoundError:
-        return {"agents": [], "pipelines": []}
+AGENTS_CONFIG_PATH = "agents.yaml"
+
+class AgentConfigError(ValueError):
+    """agents.yaml is malformed: duplicate keys or ids, bad fields, dangling agent_ids."""
+
+    def __init__(self, path: str, problems: List[str]):
+        super().__init__(f"{path}: " + "；".join(problems))
+        self.path = path
+        self.problems = problems
+
+class _UniqueKeyLoader(yaml.SafeLoader):
+    """SafeLoader that rejects duplicate mapping keys instead of keeping the last one"""
+
+    def construct_mapping(self, node, deep=False):
+        seen: Dict[Any, Any] = {}
+        for key_node, _value_node in node.value:
+            key = self.construct_object(key_node, deep=deep)
+            if key in seen:
+                raise yaml.constructor.ConstructorError(
+                    "while constructing a mapping", node.start_mark,
+                    f"重複的鍵 '{key}'（第一次出現於第 {seen[key].line + 1} 行）", key_node.start_mark,
+                )
+            seen[key] = key_node.start_mark
+        return super().construct_mapping(node, deep=deep)
+
+class AgentSpec(pydantic.BaseModel):
+    """One agent entry; keys the app does not know are kept as-is."""
+
+    model_config = pydantic.ConfigDict(extra="allow")
+
+    id: str
+    name: str = ""
+    provider: str = "openai"
+    default_model: str = "gpt-4o-mini"
+    system_prompt: str = ""
+    cache: Optional[bool] = None
+    cache_nonzero_temperature: Optional[bool] = None
+
+    @pydantic.field_validator("provider")
+    @classmethod
+    def _known_provider(cls, value: str) -> str:
+        value = value.lower().strip()
+        if value not in PROVIDER_API_KEY_SOURCES:
+            raise ValueError(f"未知的供應商 {value}")
+        return value
+
+class PipelineStepSpec(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(extra="allow")
+
+    agent_id: str
+    id: Optional[str] = None
+    input: Optional[str] = None
+    depends_on: Union[str, List[str], None] = None
+
+class PipelineSpec(pydantic.BaseModel):
+    model_config = pydantic.ConfigDict(extra="allow")
+
+    id: str
+    name: str = ""
+    description: str = ""
+    max_concurrency: Optional[int] = None
+    steps: List[PipelineStepSpec] = pydantic.Field(min_length=1)
+
+def _spec_problems(kind: str, index: int, raw: Any, error: pydantic.ValidationError) -> List[str]:
+    label = raw.get("id") if isinstance(raw, dict) and raw.get("id") else f"#{index + 1}"
+    return [
+        f"{kind} {label} 欄位 {'.'.join(str(p) for p in e['loc']) or '(整筆)'}：{e['msg']}"
+        for e in error.errors()
+    ]
+
+class AgentRegistry:
+    """
+    agents.yaml compiled once: validated agents indexed by id, pipelines by id
+    and name, and each pipeline's steps already resolved into DAG nodes (see
+    resolve_pipeline_steps). Agents and pipelines are plain dicts, as before.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        signature: Optional[Tuple[int, int]],
+        agents: Dict[str, Dict[str, Any]],
+        pipelines: Dict[str, Dict[str, Any]],
+        steps: Dict[str, List[Dict[str, Any]]],
+    ):
+        self.path = path
+        self.signature = signature
+        self.agents = agents
+        self.pipelines = pipelines
+        self.steps = steps
+        self.pipelines_by_name = {p["name"]: p for p in pipelines.values()}
+
+    @classmethod
+    def compile(cls, path: str) -> "AgentRegistry":
+        """Parse and validate path; raises AgentConfigError listing every problem"""
+        try:
+            signature = _file_signature(path)
+            with open(path, "r", encoding="utf-8") as f:
+                raw = yaml.load(f, Loader=_UniqueKeyLoader) or {}
+        except FileNotFoundError:
+            return cls(path, None, {}, {}, {})
+        except yaml.YAMLError as e:
+            raise AgentConfigError(path, [str(e)]) from None
+        except UnicodeDecodeError as e:
+            raise AgentConfigError(path, [f"檔案不是有效的 UTF-8：{e}"]) from None
+        except OSError as e:
+            raise AgentConfigError(path, [f"無法讀取檔案：{e}"]) from None
+        if not isinstance(raw, dict):
+            raise AgentConfigError(path, ["最上層必須是含 agents / pipelines 的對應表"])
+
+        problems: List[str] = []
+        agents: Dict[str, Dict[str, Any]] = {}
+        for index, item in enumerate(raw.get("agents") or []):
+            try:
+                spec = AgentSpec.model_validate(item)
+            except pydantic.ValidationError as e:
+                problems.extend(_spec_problems("代理", index, item, e))
+                continue
+            if spec.id in agents:
+                problems.append(f"代理 id 重複：{spec.id}")
+                continue
+            agent = spec.model_dump(exclude_none=True)
+            agent["name"] = agent["name"] or spec.id
+            agents[spec.id] = agent
+
+        pipelines: Dict[str, Dict[str, Any]] = {}
+        steps: Dict[str, List[Dict[str, Any]]] = {}
+        for index, item in enumerate(raw.get("pipelines") or []):
+            try:
+                spec = PipelineSpec.model_validate(item)
+            except pydantic.ValidationError as e:
+                problems.extend(_spec_problems("流程", index, item, e))
+                continue
+            if spec.id in pipelines:
+                problems.append(f"流程 id 重複：{spec.id}")
+                continue
+            pipeline = spec.model_dump(exclude_none=True)
+            pipeline["name"] = pipeline["name"] or spec.id
+            try:
+                resolved = resolve_pipeline_steps(pipeline)
+            except ValueError as e:
+                problems.append(str(e))
+                continue
+            dangling = [s["agent_id"] for s in resolved if s["agent_id"] not in agents]
+            if dangling:
+                problems.append(f"流程 {spec.id} 參照不存在的代理：{', '.join(dangling)}")
+                continue
+            pipelines[spec.id] = pipeline
+            steps[spec.id] = resolved
+
+        names = [p["name"] for p in pipelines.values()]
+        for name in sorted({n for n in names if names.count(n) > 1}):
+            problems.append(f"流程名稱重複：{name}")
+        if problems:
+            raise AgentConfigError(path, problems)
+        return cls(path, signature, agents, pipelines, steps)
+
+    def pipeline_steps(self, pipeline_id: str) -> List[Dict[str, Any]]:
+        return self.steps[pipeline_id]
+
+def _file_signature(path: str) -> Tuple[int, int]:
+    info = os.stat(path)
+    return info.st_mtime_ns, info.st_size
+
+class AgentRegistryCache:
+    """
+    Compiled registries by path, recompiled only when the file's mtime or size
+    changes. A reload that fails keeps serving the last good registry and
+    exposes the error, so a half-saved edit does not take the app down; the
+    failed file's signature is remembered so it is not recompiled on every
+    rerun, only once the file changes again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._registries: Dict[str, AgentRegistry] = {}
+        self._failed: Dict[str, Optional[Tuple[int, int]]] = {}
+        self.errors: Dict[str, AgentConfigError] = {}
+
+    def get(self, path: str) -> AgentRegistry:
+        try:
+            signature: Optional[Tuple[int, int]] = _file_signature(path)
+        except FileNotFoundError:
+            signature = None
+        with self._lock:
+            current = self._registries.get(path)
+            if current is not None and current.signature == signature:
+                return current
+            if path in self._failed and self._failed[path] == signature:
+                if current is None:
+                    raise self.errors[path]
+                return current
+            try:
+                registry = AgentRegistry.compile(path)
+            except AgentConfigError as e:
+                self.errors[path] = e
+                self._failed[path] = signature
+                if current is None:
+                    raise
+                return current
+            self.errors.pop(path, None)
+            self._failed.pop(path, None)
+            self._registries[path] = registry
+            return registry
+
+@st.cache_resource
+def get_agent_registry_cache() -> AgentRegistryCache:
+    """Process-wide registry cache, kept across reruns and shared by sessions"""
+    return AgentRegistryCache()
+
+def get_agent_registry(path: str = AGENTS_CONFIG_PATH) -> AgentRegistry:
+    """The compiled agents.yaml, hot-reloaded when the file changes"""
+    return get_agent_registry_cache().get(path)
+
+# -----------------------------------------------------------
+# Utility Functions
+# -----------------------------------------------------------
 
 def get_translation(key: str) -> str:
     """Get translated text based on current language"""
@@ -355,6 +635,21 @@ def apply_custom_css():
         font-weight: 600;
     }}
 
+    /* Activity log: one scrollable block */
+    .activity-log {{
+        overflow-y: auto;
+        font-size: 0.85rem;
+        line-height: 1.5;
+        padding: 0.25rem 0.5rem;
+        border-left: 3px solid {accent_color};
+    }}
+    .activity-log-time {{
+        opacity: 0.6;
+        font-variant-numeric: tabular-nums;
+    }}
+    .activity-log-warning {{ color: #F59E0B; }}
+    .activity-log-error {{ color: #EF4444; }}
+
     /* Coral keyword highlight demo */
     .coral-keyword {{
         color: {coral};
@@ -369,40 +664,198 @@ def update_player_stats(action: str):
     Update abstracted 'player' stats, re-interpreted as review metrics:
     - level: 審查成熟度等級
     - health: 合規健康度
-    - mana: AI 資源容量
+    AI 資源容量 is not a player stat: it is the real token budget tracked by
+    the QuotaGovernor.
     """
+    # Item access with defaults keeps this usable headless (batch_runner.py),
+    # where session state is always empty
+    state = st.session_state
     if action == "quest_complete":
-        st.session_state.experience += 10
-        st.session_state.quests_completed += 1
-        if st.session_state.experience >= st.session_state.player_level * 50:
-            st.session_state.player_level += 1
-            st.session_state.experience = 0
-            st.toast(f"🎯 審查成熟度提升！目前等級：{st.session_state.player_level}")
-    elif action == "use_mana":
-        st.session_state.mana = max(0, st.session_state.mana - 20)
+        state["experience"] = state.get("experience", 0) + 10
+        state["quests_completed"] = state.get("quests_completed", 0) + 1
+        if state.get("experience", 0) >= state.get("player_level", 1) * 50:
+            state["player_level"] = state.get("player_level", 1) + 1
+            state["experience"] = 0
+            st.toast(f"🎯 審查成熟度提升！目前等級：{state.get('player_level', 1)}")
     elif action == "regenerate":
-        st.session_state.mana = min(100, st.session_state.mana + 10)
-        st.session_state.health = min(100, st.session_state.health + 5)
+        state["health"] = min(100, state.get("health", 100) + 5)
+
+# Activity log: entries kept in memory per session; with ACTIVITY_LOG_SPILL set,
+# entries that fall out of the buffer are appended to a per-session JSONL file
+ACTIVITY_LOG_MAX_ENTRIES = int(os.getenv("ACTIVITY_LOG_MAX_ENTRIES", "500"))
+ACTIVITY_LOG_SPILL = os.getenv("ACTIVITY_LOG_SPILL", "").lower() in ("1", "true", "yes")
+ACTIVITY_LOG_SPILL_BATCH = 64
+
+ACTIVITY_LOG_ICONS = {
+    "info": "ℹ️",
+    "success": "✅",
+    "warning": "⚠️",
+    "error": "❌",
+    "spell": "🧠",
+}
+# Severity of each entry type, for level filtering
+ACTIVITY_LOG_LEVELS = {
+    "info": "info",
+    "success": "info",
+    "spell": "info",
+    "warning": "warning",
+    "error": "error",
+}
+
+class ActivityLog:
+    """
+    Bounded ring buffer of activity entries with per-type and per-level
+    indexes. Appends and evictions are O(1): the evicted entry is always the
+    oldest one, so it is also the head of its index deques. Each entry gets a
+    sequence number, a monotonic timestamp (ordering and intervals) and a wall
+    clock time (display). With spill_path, evicted entries are appended to
+    that JSONL file in batches, so the full history survives while memory
+    stays bounded.
+    """
+
+    def __init__(self, max_entries: int = ACTIVITY_LOG_MAX_ENTRIES, spill_path: Optional[str] = None):
+        self._entries: "deque[Dict[str, Any]]" = deque()
+        self._by_type: Dict[str, "deque[Dict[str, Any]]"] = {}
+        self._by_level: Dict[str, "deque[Dict[str, Any]]"] = {}
+        self._spill: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.spill_path = spill_path
+        self.total = 0
+        self.started = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def append(self, message: str, message_type: str = "info") -> Dict[str, Any]:
+        level = ACTIVITY_LOG_LEVELS.get(message_type, "info")
+        with self._lock:
+            self.total += 1
+            entry = {
+                "seq": self.total,
+                "mono": time.monotonic(),
+                "ts": time.time(),
+                "type": message_type,
+                "level": level,
+                "icon": ACTIVITY_LOG_ICONS.get(message_type, "ℹ️"),
+                "message": message,
+            }
+            if len(self._entries) >= self.max_entries:
+                evicted = self._entries.popleft()
+                self._by_type[evicted["type"]].popleft()
+                self._by_level[evicted["level"]].popleft()
+                if self.spill_path:
+                    self._spill.append(evicted)
+            self._entries.append(entry)
+            self._by_type.setdefault(message_type, deque()).append(entry)
+            self._by_level.setdefault(level, deque()).append(entry)
+            spill = self._take_spill(force=False)
+        self._write_spill(spill)
+        return entry
+
+    def _take_spill(self, force: bool) -> List[Dict[str, Any]]:
+        """Detach pending spilled entries (caller holds the lock)"""
+        if not self._spill or (not force and len(self._spill) < ACTIVITY_LOG_SPILL_BATCH):
+            return []
+        spill, self._spill = self._spill, []
+        return spill
+
+    def _write_spill(self, entries: List[Dict[str, Any]]):
+        if not entries:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.spill_path)), exist_ok=True)
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries))
+
+    def flush(self):
+        """Write spilled entries that are still waiting for a full batch"""
+        with self._lock:
+            spill = self._take_spill(force=True)
+        self._write_spill(spill)
+
+    def entries(
+        self,
+        types: Optional[List[str]] = None,
+        levels: Optional[List[str]] = None,
+        query: str = "",
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Buffered entries matching every given filter, newest first. Type and
+        level filters read only their index deques; query is a
+        case-insensitive substring match on the message.
+        """
+        with self._lock:
+            if types is not None:
+                pools = [self._by_type.get(t, ()) for t in types]
+                level_set = set(levels) if levels is not None else None
+            elif levels is not None:
+                pools = [self._by_level.get(lv, ()) for lv in levels]
+                level_set = None
+            else:
+                pools = [self._entries]
+                level_set = None
+            candidates = [e for pool in pools for e in pool]
+        if len(pools) > 1:
+            candidates.sort(key=lambda e: e["seq"])
+        needle = query.strip().lower()
+        out: List[Dict[str, Any]] = []
+        for entry in reversed(candidates):
+            if level_set is not None and entry["level"] not in level_set:
+                continue
+            if needle and needle not in entry["message"].lower():
+                continue
+            out.append(entry)
+            if limit is not None and len(out) >= limit:
+                break
+        return out
+
+    def type_counts(self) -> Dict[str, int]:
+        with self._lock:
+            return {t: len(pool) for t, pool in self._by_type.items() if pool}
+
+    def export_jsonl(self) -> str:
+        """Full history as JSONL, oldest first: spilled entries, then the buffer"""
+        self.flush()
+        spilled = ""
+        if self.spill_path and os.path.exists(self.spill_path):
+            with open(self.spill_path, "r", encoding="utf-8") as f:
+                spilled = f.read()
+        with self._lock:
+            buffered = list(self._entries)
+        return spilled + "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in buffered)
+
+def get_activity_log() -> ActivityLog:
+    """This session's activity log, created on first use"""
+    log = st.session_state.get("combat_log")
+    if not isinstance(log, ActivityLog):
+        spill_path = None
+        if ACTIVITY_LOG_SPILL:
+            session = st.session_state.get("telemetry_session", "headless")
+            spill_path = os.path.join(APP_CACHE_DIR, "activity_logs", f"{session}.jsonl")
+        log = ActivityLog(spill_path=spill_path)
+        st.session_state["combat_log"] = log
+    return log
 
 def add_combat_log(message: str, message_type: str = "info"):
     """Add entry to review activity log"""
-    icons = {
-        "info": "ℹ️",
-        "success": "✅",
-        "warning": "⚠️",
-        "error": "❌",
-        "spell": "🧠",
-    }
-    log_entry = {
-        "icon": icons.get(message_type, "ℹ️"),
-        "message": message,
-        "timestamp": st.session_state.get("quests_completed", 0),
-    }
-    if "combat_log" not in st.session_state:
-        st.session_state.combat_log = []
-    st.session_state.combat_log.append(log_entry)
-    if len(st.session_state.combat_log) > 200:
-        st.session_state.combat_log.pop(0)
+    get_activity_log().append(message, message_type)
+
+def render_log_block(entries: List[Dict[str, Any]], height: int = 360):
+    """Render log entries as one scrollable HTML block (a single element per rerun)"""
+    if not entries:
+        st.info("沒有符合條件的活動紀錄。")
+        return
+    lines = "".join(
+        f"<div class='activity-log-{e['level']}'>"
+        f"<span class='activity-log-time'>{time.strftime('%H:%M:%S', time.localtime(e['ts']))}</span> "
+        f"{e['icon']} {html.escape(e['message'])}</div>"
+        for e in entries
+    )
+    st.markdown(
+        f"<div class='activity-log' style='max-height:{height}px'>{lines}</div>",
+        unsafe_allow_html=True,
+    )
 
 # -----------------------------------------------------------
 # API Key Management
@@ -415,6 +868,7 @@ def get_api_key_from_env_or_ui(
     label: str,
 ) -> Optional[str]:
     """Get API key from environment or user input (do not echo env key)"""
+    previous_key = st.session_state.get(session_key)
     env_val = os.getenv(env_var)
     if env_val:
         st.caption(f"🔑 {label}: 已從環境變數載入")
@@ -427,231 +881,3402 @@ def get_api_key_from_env_or_ui(
         type="password",
     )
     if key:
+        if previous_key and previous_key != key:
+            # Key rotation: stop pooling the client bound to the old key
+            get_client_registry().retire(provider_name.lower(), previous_key)
+            add_combat_log(f"{provider_name} API 金鑰已更換，後續呼叫改用新連線。", "info")
         st.session_state[session_key] = key
         st.caption(f"🔑 {label} 已暫存於工作階段")
         return key
     return None
 
 # -----------------------------------------------------------
-# LLM Call Router (OpenAI, Gemini, Grok via xai_sdk, Anthropic)
+# Provider Client Registry (pooled, long-lived SDK clients)
 # -----------------------------------------------------------
 
-def call_llm(
-    provider: str,
-    model: str,
-    system_prompt: str,
-    user_prompt: str,
-    max_tokens: int = 512,
-    temperature: float = 0.7,
-) -> str:
-    """Route LLM calls to appropriate provider"""
-    provider = provider.lower().strip()
+# provider -> (session_state key, environment variable, label used in errors)
+PROVIDER_API_KEY_SOURCES = {
+    "openai": ("openai_api_key", "OPENAI_API_KEY", "OpenAI"),
+    "gemini": ("gemini_api_key", "GEMINI_API_KEY", "Gemini"),
+    "xai": ("xai_api_key", "XAI_API_KEY", "xAI (Grok)"),
+    "anthropic": ("anthropic_api_key", "ANTHROPIC_API_KEY", "Anthropic"),
+}
 
-    add_combat_log(f"呼叫 {provider} 模型：{model}", "spell")
-    update_player_stats("use_mana")
+class ProviderClientRegistry:
+    """
+    Process-wide registry of connection-pooled provider clients, keyed by
+    (provider, api_key). Clients survive Streamlit reruns so every agent step,
+    notes button and OCR call reuses the same HTTP / gRPC connection pool.
+    """
 
-    if provider == "openai":
-        api_key = st.session_state.get("openai_api_key")
-        if not api_key:
-            raise RuntimeError("OpenAI API key is not set.")
-        client = OpenAI(api_key=api_key)
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            max_tokens=max_tokens,
-            temperature=temperature,
-        )
-        return resp.choices[0].message.content
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, str], Any] = {}
+        self._gemini_models: Dict[Tuple[str, str], Any] = {}
+        # (api_key, model, prompt digest) -> (model bound to the cache or None, expiry, CachedContent)
+        self._gemini_cached: Dict[Tuple[str, str, str], Tuple[Any, float, Any]] = {}
+        self._gemini_cache_locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+        # (api_key, model, prompt digest) -> (uses, last use); a cache is made on the second use
+        self._gemini_prompt_uses: Dict[Tuple[str, str, str], Tuple[int, float]] = {}
+        # (api_key, model, slot) -> prompt digest the slot (agent) currently uses
+        self._gemini_slots: Dict[Tuple[str, str, str], str] = {}
+        self._gemini_key: Optional[str] = None
+
+    def _build(self, provider: str, api_key: str) -> Any:
+        # SDK-level retries are off: the provider scheduler (scheduled_call) is
+        # the only retry layer, so every attempt passes its rate limits and
+        # circuit breaker and is counted in telemetry
+        if provider == "openai":
+            return openai.OpenAI(api_key=api_key, max_retries=0)
+        if provider == "anthropic":
+            return anthropic.Anthropic(api_key=api_key, max_retries=0)
+        if provider == "xai":
+            return xai_sdk.Client(api_key=api_key, timeout=3600)
+        raise ValueError(f"Unsupported provider: {provider}")
 
-    elif provider == "gemini":
-        api_key = st.session_state.get("gemini_api_key")
+    def get(self, provider: str, api_key: str) -> Any:
+        """Return the pooled client for provider/api_key, creating it on first use"""
+        key = (provider, api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._build(provider, api_key)
+                self._clients[key] = client
+            return client
+
+    def get_gemini_model(self, api_key: str, model: str) -> Any:
+        """
+        Return a cached GenerativeModel. google-generativeai keeps its API key in
+        process-global state, so genai.configure only runs when the key changes.
+        """
+        with self._lock:
+            if self._gemini_key != api_key:
+                genai.configure(api_key=api_key)
+                self._gemini_key = api_key
+                self._gemini_models.clear()
+            model_obj = self._gemini_models.get((api_key, model))
+            if model_obj is None:
+                model_obj = genai.GenerativeModel(model)
+                self._gemini_models[(api_key, model)] = model_obj
+            return model_obj
+
+    def get_gemini_cached_model(
+        self, api_key: str, model: str, system_prompt: str, slot: Optional[str] = None
+    ) -> Any:
+        """
+        Return a GenerativeModel bound to a server-side CachedContent holding
+        system_prompt, creating (or renewing near expiry) the cache as needed.
+        Gemini bills cache storage, so the first use of a prompt returns None
+        (send it uncached) and the cache is created on its second use within
+        the TTL. Also returns None when the model cannot cache that prompt; the
+        failure is remembered until the TTL would have run out so it is not
+        retried per call.
+
+        slot names the caller whose prompt this is (the agent id): when a
+        slot's prompt changes, the cache for its previous prompt is deleted
+        instead of being billed until it expires. Expired entries are dropped
+        on every lookup.
+
+        The CachedContent.create RPC runs under a per-prompt lock only, so one
+        slow cache creation never blocks clients or other prompts; concurrent
+        callers for the same prompt wait for it instead of creating duplicates.
+        """
+        digest = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        key = (api_key, model, digest)
+        with self._lock:
+            if self._gemini_key != api_key:
+                genai.configure(api_key=api_key)
+                self._gemini_key = api_key
+                self._gemini_models.clear()
+            now = time.time()
+            self._prune_gemini_caches(now)
+            superseded = []
+            if slot is not None:
+                superseded = self._move_gemini_slot((api_key, model, slot), digest)
+            entry = self._gemini_cached.get(key)
+            fresh = entry is not None and entry[1] > now + 60
+            uses = self._gemini_prompt_uses.get(key, (0, now))[0] + 1
+            self._gemini_prompt_uses[key] = (uses, now)
+            key_lock = None
+            if not fresh and uses > 1:
+                key_lock = self._gemini_cache_locks.setdefault(key, threading.Lock())
+        _delete_gemini_caches(superseded)
+        if fresh:
+            return entry[0]
+        if key_lock is None:
+            return None
+        with key_lock:
+            with self._lock:
+                # Another caller may have created it while this one waited
+                entry = self._gemini_cached.get(key)
+                if entry is not None and entry[1] > time.time() + 60:
+                    return entry[0]
+            now = time.time()
+            cached = None
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=model,
+                    system_instruction=system_prompt,
+                    ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL_SECONDS),
+                )
+                model_obj = genai.GenerativeModel.from_cached_content(cached_content=cached)
+            except Exception:
+                model_obj = None
+            with self._lock:
+                self._gemini_cached[key] = (model_obj, now + GEMINI_CACHE_TTL_SECONDS, cached)
+            return model_obj
+
+    def _prune_gemini_caches(self, now: float):
+        """
+        Drop expired caches (the provider deletes those itself), prompt-use
+        counts older than the TTL, and the locks and slots left without
+        either. Caller holds self._lock.
+        """
+        for key in [k for k, entry in self._gemini_cached.items() if entry[1] <= now]:
+            del self._gemini_cached[key]
+        horizon = now - GEMINI_CACHE_TTL_SECONDS
+        for key in [k for k, (_uses, seen) in self._gemini_prompt_uses.items() if seen <= horizon]:
+            del self._gemini_prompt_uses[key]
+        live = self._gemini_cached.keys() | self._gemini_prompt_uses.keys()
+        for key in [k for k, lock in self._gemini_cache_locks.items() if k not in live and not lock.locked()]:
+            del self._gemini_cache_locks[key]
+        for slot_key in [k for k, d in self._gemini_slots.items() if (k[0], k[1], d) not in live]:
+            del self._gemini_slots[slot_key]
+
+    def _move_gemini_slot(self, slot_key: Tuple[str, str, str], digest: str) -> List[Any]:
+        """
+        Point a slot at its current prompt; returns the caches of a previous
+        prompt no other slot still uses, for deletion (caller holds self._lock).
+        """
+        previous = self._gemini_slots.get(slot_key)
+        self._gemini_slots[slot_key] = digest
+        if previous is None or previous == digest:
+            return []
+        api_key, model, _slot = slot_key
+        if any(k[:2] == (api_key, model) and d == previous for k, d in self._gemini_slots.items()):
+            return []
+        old_key = (api_key, model, previous)
+        self._gemini_prompt_uses.pop(old_key, None)
+        entry = self._gemini_cached.pop(old_key, None)
+        return [entry[2]] if entry is not None and entry[2] is not None else []
+
+    def retire(self, provider: str, api_key: Optional[str]):
+        """
+        Forget the clients built for an API key without closing them: other
+        sessions may share the key and have calls in flight on the client.
+        Callers holding it finish normally; the SDK client closes its pool
+        when the last reference is dropped, and the next get() builds a new one.
+        """
         if not api_key:
-            raise RuntimeError("Gemini API key is not set.")
-        genai.configure(api_key=api_key)
-        model_obj = genai.GenerativeModel(model)
-        resp = model_obj.generate_content(
-            system_prompt + "\n\nUSER MESSAGE:\n" + user_prompt,
-            generation_config=genai.types.GenerationConfig(
-                max_output_tokens=max_tokens,
-                temperature=temperature,
-            )
-        )
-        return resp.text
+            return
+        with self._lock:
+            self._clients.pop((provider, api_key), None)
+            if provider == "gemini":
+                for cache_key in [k for k in self._gemini_models if k[0] == api_key]:
+                    del self._gemini_models[cache_key]
+                for cache_key in [k for k in self._gemini_cached if k[0] == api_key]:
+                    del self._gemini_cached[cache_key]
+                for cache_key in [k for k in self._gemini_cache_locks if k[0] == api_key]:
+                    del self._gemini_cache_locks[cache_key]
+                for cache_key in [k for k in self._gemini_prompt_uses if k[0] == api_key]:
+                    del self._gemini_prompt_uses[cache_key]
+                for cache_key in [k for k in self._gemini_slots if k[0] == api_key]:
+                    del self._gemini_slots[cache_key]
+                if self._gemini_key == api_key:
+                    self._gemini_key = None
+
+    def close_all(self):
+        """Process shutdown only: close every pooled connection"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._gemini_models.clear()
+            self._gemini_cached.clear()
+            self._gemini_cache_locks.clear()
+            self._gemini_prompt_uses.clear()
+            self._gemini_slots.clear()
+            self._gemini_key = None
+        for client in clients:
+            _close_client(client)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for provider, _ in self._clients:
+                counts[provider] = counts.get(provider, 0) + 1
+            if self._gemini_models:
+                counts["gemini"] = len(self._gemini_models)
+            return counts
+
+def _delete_gemini_caches(caches: List[Any]):
+    """Best-effort delete of superseded CachedContent (they expire with their TTL anyway)"""
+    for cached in caches:
+        try:
+            cached.delete()
+        except Exception:
+            pass
+
+def _close_client(client: Any):
+    close = getattr(client, "close", None)
+    if callable(close):
+        try:
+            close()
+        except Exception:
+            pass
+
+@st.cache_resource
+def get_client_registry() -> ProviderClientRegistry:
+    """Shared client registry (one per server process, kept across reruns)"""
+    registry = ProviderClientRegistry()
+    atexit.register(registry.close_all)
+    return registry
+
+def get_provider_api_key(provider: str) -> str:
+    """Resolve the API key for a provider from session state or environment"""
+    if provider not in PROVIDER_API_KEY_SOURCES:
+        raise ValueError(f"Unsupported provider: {provider}")
+    session_key, env_var, label = PROVIDER_API_KEY_SOURCES[provider]
+    api_key = st.session_state.get(session_key) or os.getenv(env_var)
+    if not api_key:
+        raise RuntimeError(f"{label} API key is not set.")
+    return api_key
 
-    elif provider == "xai":
-        # Grok via xai_sdk (per official sample)
-        api_key = st.session_state.get("xai_api_key")
-        if not api_key:
-            raise RuntimeError("xAI (Grok) API key is not set.")
-        client = XaiClient(api_key=api_key, timeout=3600)
-        chat = client.chat.create(model=model)
-        chat.append(xai_system(system_prompt))
-        chat.append(xai_user(user_prompt))
-        response = chat.sample()
-        # response.content is typically a string
-        return getattr(response, "content", str(response))
+# -----------------------------------------------------------
+# LLM Response Cache (content-addressed, on-disk, TTL + LRU)
+# -----------------------------------------------------------
 
-    elif provider == "anthropic":
-        api_key = st.session_state.get("anthropic_api_key")
-        if not api_key:
-            raise RuntimeError("Anthropic API key is not set.")
-        client = Anthropic(api_key=api_key)
-        resp = client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            system=system_prompt,
-            messages=[{"role": "user", "content": user_prompt}],
-        )
-        if resp.content and len(resp.content) > 0:
-            block = resp.content[0]
-            if hasattr(block, "text"):
-                return block.text
-        return json.dumps(resp.model_dump(), indent=2)
+APP_CACHE_DIR = os.getenv(
+    "FDA_APP_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"),
+)
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
 
-    else:
-        raise ValueError(f"Unsupported provider: {provider}")
+class LLMResponseCache:
+    """
+    Persistent SQLite cache of completions, keyed by a SHA-256 of every input
+    that affects the output. Entries expire after ttl_seconds; once the cache
+    exceeds max_entries or max_bytes the least recently used entries are evicted.
+    """
 
-def run_agent(
-    agent_cfg: Dict[str, Any],
-    user_prompt: str,
-    override_provider: Optional[str] = None,
-    override_model: Optional[str] = None,
-    override_system_prompt: Optional[str] = None,
-    max_tokens: int = 512,
-    temperature: float = 0.7,
-) -> str:
-    """Run a single configured agent"""
-    provider = override_provider or agent_cfg.get("provider", "openai")
-    model = override_model or agent_cfg.get("default_model", "gpt-4o-mini")
-    system_prompt = override_system_prompt or agent_cfg.get("system_prompt", "")
-    return call_llm(
-        provider=provider,
-        model=model,
-        system_prompt=system_prompt,
-        user_prompt=user_prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
+    def __init__(self, path: str, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(
+        provider: str,
+        model: str,
+        system_prompt: str,
+        user_prompt: str,
+        temperature: float,
+        max_tokens: int,
+    ) -> str:
+        payload = json.dumps(
+            [provider, model, system_prompt, user_prompt, round(float(temperature), 4), int(max_tokens)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now),
+            )
+            self._evict_locked(now)
+            self._conn.commit()
+
+    def _evict_locked(self, now: float):
+        self._conn.execute(
+            "DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,)
+        )
+        count, total = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall()
+        stale: List[str] = []
+        for key, size in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            stale.append(key)
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", [(k,) for k in stale])
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"entries": count, "bytes": total, "hits": self.hits, "misses": self.misses}
+
+@st.cache_resource
+def get_llm_response_cache() -> LLMResponseCache:
+    """Shared on-disk response cache (one connection per server process)"""
+    return LLMResponseCache(
+        os.path.join(APP_CACHE_DIR, "llm_responses.sqlite"),
+        max_entries=LLM_CACHE_MAX_ENTRIES,
+        max_bytes=LLM_CACHE_MAX_BYTES,
+        ttl_seconds=LLM_CACHE_TTL_SECONDS,
     )
 
+def agent_allows_cache(agent_cfg: Dict[str, Any], temperature: float) -> bool:
+    """
+    Per-agent cache policy from agents.yaml:
+    - cache: false                      never cache this agent
+    - cache_nonzero_temperature: false  only cache when temperature == 0
+    """
+    if agent_cfg.get("cache") is False:
+        return False
+    if temperature > 0 and agent_cfg.get("cache_nonzero_temperature") is False:
+        return False
+    return True
+
+def record_llm_cache_event(hit: bool, provider: str, model: str):
+    """Update per-session hit/miss counters and note them in the activity log"""
+    counter = "llm_cache_hits" if hit else "llm_cache_misses"
+    st.session_state[counter] = st.session_state.get(counter, 0) + 1
+    hits = st.session_state.get("llm_cache_hits", 0)
+    misses = st.session_state.get("llm_cache_misses", 0)
+    if hit:
+        add_combat_log(
+            f"快取命中 {provider} / {model}（命中 {hits}／未命中 {misses}）", "success"
+        )
+    else:
+        add_combat_log(
+            f"快取未命中 {provider} / {model}（命中 {hits}／未命中 {misses}）", "info"
+        )
+
 # -----------------------------------------------------------
-# Status Indicators
+# Token Budget (prompt-size estimation, context limits, cost)
 # -----------------------------------------------------------
 
-def render_status_indicators():
-    """Render review status indicators (WOW gauges)"""
-    col1, col2, col3, col4 = st.columns(4)
+# Default output budgets per kind of call, instead of literals at each call site
+DEFAULT_MAX_TOKENS = {
+    "agent": 512,
+    "chat": 1024,
+    "note_format": 2048,
+    "note_extraction": 1024,
+    "ocr_cleanup": 1500,
+    "txt_format": 2000,
+    "summary": 800,
+    "entities": 2000,
+    "qa": 1200,
+}
 
-    with col1:
-        st.markdown(f"**{get_translation('level')}**")
-        st.metric(label="", value=st.session_state.player_level)
+# Context window, max output and USD price per 1M tokens (input, output).
+# Matched by longest model-name prefix; prices are list prices used for estimates only.
+MODEL_TOKEN_LIMITS: Dict[str, Dict[str, float]] = {
+    "gpt-5-nano": {"context": 400000, "max_output": 128000, "input_per_m": 0.05, "output_per_m": 0.40},
+    "gpt-5": {"context": 400000, "max_output": 128000, "input_per_m": 1.25, "output_per_m": 10.0},
+    "gpt-4o-mini": {"context": 128000, "max_output": 16384, "input_per_m": 0.15, "output_per_m": 0.60},
+    "gpt-4o": {"context": 128000, "max_output": 16384, "input_per_m": 2.50, "output_per_m": 10.0},
+    "gpt-4.1-mini": {"context": 1047576, "max_output": 32768, "input_per_m": 0.40, "output_per_m": 1.60},
+    "gpt-4.1": {"context": 1047576, "max_output": 32768, "input_per_m": 2.00, "output_per_m": 8.00},
+    "gemini-2.5-flash-lite": {"context": 1048576, "max_output": 65536, "input_per_m": 0.10, "output_per_m": 0.40},
+    "gemini-2.5-flash": {"context": 1048576, "max_output": 65536, "input_per_m": 0.30, "output_per_m": 2.50},
+    "grok-4-fast": {"context": 2000000, "max_output": 30000, "input_per_m": 0.20, "output_per_m": 0.50},
+    "grok-3-mini": {"context": 131072, "max_output": 16384, "input_per_m": 0.30, "output_per_m": 0.50},
+    "claude-3-5-sonnet": {"context": 200000, "max_output": 8192, "input_per_m": 3.00, "output_per_m": 15.0},
+    "claude-3-opus": {"context": 200000, "max_output": 4096, "input_per_m": 15.0, "output_per_m": 75.0},
+}
+PROVIDER_TOKEN_LIMITS: Dict[str, Dict[str, float]] = {
+    "openai": {"context": 128000, "max_output": 16384, "input_per_m": 2.50, "output_per_m": 10.0},
+    "gemini": {"context": 1048576, "max_output": 8192, "input_per_m": 0.30, "output_per_m": 2.50},
+    "xai": {"context": 131072, "max_output": 16384, "input_per_m": 3.00, "output_per_m": 15.0},
+    "anthropic": {"context": 200000, "max_output": 4096, "input_per_m": 3.00, "output_per_m": 15.0},
+}
 
-    with col2:
-        st.markdown(f"**{get_translation('health')}**")
-        st.progress(st.session_state.health / 100)
-        st.caption(f"{st.session_state.health}/100")
+TOKEN_BUDGET_POLICIES = {
+    "truncate": "截斷過長輸入（保留開頭與結尾）",
+    "chunk": "分段呼叫後合併輸出",
+    "abort": "直接中止，不送出請求",
+}
+DEFAULT_TOKEN_BUDGET_POLICY = "truncate"
+# Safety margin for estimator error and per-message overhead
+TOKEN_ESTIMATE_MARGIN = 1.1
+TOKEN_MESSAGE_OVERHEAD = 16
 
-    with col3:
-        st.markdown(f"**{get_translation('mana')}**")
-        st.progress(st.session_state.mana / 100)
-        st.caption(f"{st.session_state.mana}/100")
+_CJK_CHAR_RE = re.compile("[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef\uac00-\ud7af]")
 
-    with col4:
-        st.markdown(f"**{get_translation('experience')}**")
-        max_xp = st.session_state.player_level * 50
-        st.progress(st.session_state.experience / max_xp)
-        st.caption(f"{st.session_state.experience}/{max_xp}")
+class PromptBudgetError(ValueError):
+    """Prompt plus requested output does not fit the model's context window."""
 
-def render_activity_log():
-    """Render review activity log"""
-    st.markdown("### 📑 活動紀錄")
-    with st.expander("檢視近期動作", expanded=False):
-        if st.session_state.combat_log:
-            for entry in reversed(st.session_state.combat_log[-40:]):
-                st.markdown(f"{entry['icon']} {entry['message']}")
-        else:
-            st.info("目前尚無活動紀錄")
+def model_token_limits(provider: str, model: str) -> Dict[str, float]:
+    matches = [name for name in MODEL_TOKEN_LIMITS if model.startswith(name)]
+    if matches:
+        return MODEL_TOKEN_LIMITS[max(matches, key=len)]
+    return PROVIDER_TOKEN_LIMITS.get(provider, PROVIDER_TOKEN_LIMITS["openai"])
 
-# -----------------------------------------------------------
-# Review Context Selector
-# -----------------------------------------------------------
+@functools.lru_cache(maxsize=8)
+def _tiktoken_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
 
-def render_review_context_selector():
-    """Render interactive review context selector"""
-    st.markdown("### 🏥 審查情境選擇器")
+# Estimates are memoised by a digest of the text, not the text itself, so
+# repeated estimates of corpus-sized prompts do not pin them in memory
+TOKEN_ESTIMATE_CACHE_SIZE = 256
+_token_estimates: "OrderedDict[Tuple[bytes, str, str], int]" = OrderedDict()
+_token_estimates_lock = threading.Lock()
 
-    cols = st.columns(5)
-    styles = list(REVIEW_CONTEXT_STYLES.keys())
+def estimate_tokens(text: str, provider: str = "openai", model: str = "") -> int:
+    """
+    Local token estimate. Uses tiktoken for OpenAI models when installed;
+    otherwise ~1 token per CJK character and ~4 characters per token for the
+    rest, scaled for tokenizers that are known to split more finely.
+    """
+    if not text:
+        return 0
+    key = (hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest(), provider, model)
+    with _token_estimates_lock:
+        count = _token_estimates.get(key)
+        if count is not None:
+            _token_estimates.move_to_end(key)
+            return count
+    count = _count_tokens(text, provider, model)
+    with _token_estimates_lock:
+        _token_estimates[key] = count
+        while len(_token_estimates) > TOKEN_ESTIMATE_CACHE_SIZE:
+            _token_estimates.popitem(last=False)
+    return count
+
+def _count_tokens(text: str, provider: str, model: str) -> int:
+    if provider == "openai" and tiktoken.available:
+        return len(_tiktoken_encoding(model or "gpt-4o").encode(text, disallowed_special=()))
+    cjk = len(_CJK_CHAR_RE.findall(text))
+    estimate = cjk + (len(text) - cjk) / 4.0
+    if provider == "anthropic":
+        estimate *= 1.15
+    return int(math.ceil(estimate))
+
+def estimate_call_cost(
+    provider: str, model: str, input_tokens: int, output_tokens: int
+) -> float:
+    limits = model_token_limits(provider, model)
+    return (
+        input_tokens * limits["input_per_m"] + output_tokens * limits["output_per_m"]
+    ) / 1_000_000
+
+def prompt_budget(
+    provider: str, model: str, system_prompt: str, user_prompt: str, max_tokens: int
+) -> Dict[str, Any]:
+    """Estimated input tokens, clamped output budget and whether the call fits."""
+    return budget_for_tokens(
+        provider,
+        model,
+        estimate_tokens(system_prompt, provider, model),
+        estimate_tokens(user_prompt, provider, model),
+        max_tokens,
+    )
 
-    for idx, style in enumerate(styles):
-        with cols[idx % 5]:
-            style_data = REVIEW_CONTEXT_STYLES[style]
-            button_label = f"{style_data['icon']} {style}"
-            if st.button(
-                button_label,
-                key=f"style_{style}",
-                help=style_data["description"],
-                use_container_width=True
-            ):
-                st.session_state.art_style = style
-                add_combat_log(f"切換審查情境為：{style}", "success")
-                st.rerun()
+def budget_for_tokens(
+    provider: str, model: str, system_tokens: int, user_tokens: int, max_tokens: int
+) -> Dict[str, Any]:
+    """prompt_budget from token counts the caller already has (e.g. per-document sums)"""
+    limits = model_token_limits(provider, model)
+    input_tokens = int((system_tokens + user_tokens) * TOKEN_ESTIMATE_MARGIN) + TOKEN_MESSAGE_OVERHEAD
+    output_tokens = min(int(max_tokens), int(limits["max_output"]))
+    return {
+        "input_tokens": input_tokens,
+        "user_tokens": user_tokens,
+        "output_tokens": output_tokens,
+        "context": int(limits["context"]),
+        "fits": input_tokens + output_tokens <= limits["context"],
+        "cost": estimate_call_cost(provider, model, input_tokens, output_tokens),
+    }
 
-    current_style = st.session_state.get("art_style", "General 510(k)")
-    style_data = REVIEW_CONTEXT_STYLES[current_style]
-    st.markdown(
-        f"<div class='review-card' style='text-align: center; "
-        f"background: linear-gradient(135deg, {style_data['color']}33, transparent);'>"
-        f"<h3>{style_data['icon']} 目前情境：{current_style}</h3>"
-        f"<p>{style_data['description']}</p>"
-        f"</div>",
-        unsafe_allow_html=True
+def _user_prompt_char_budget(budget: Dict[str, Any], user_prompt: str) -> int:
+    """Characters of user prompt that fit in what is left of the context."""
+    available = budget["context"] - budget["output_tokens"] - (budget["input_tokens"] - int(
+        budget["user_tokens"] * TOKEN_ESTIMATE_MARGIN
+    ))
+    available = int(available / TOKEN_ESTIMATE_MARGIN)
+    if available <= 0:
+        return 0
+    chars_per_token = len(user_prompt) / max(budget["user_tokens"], 1)
+    return int(available * chars_per_token * 0.95)
+
+def truncate_to_budget(user_prompt: str, max_chars: int) -> str:
+    """Keep the head and tail of the prompt, eliding the middle."""
+    if len(user_prompt) <= max_chars:
+        return user_prompt
+    marker = "\n\n[… 內容過長，已省略中段 …]\n\n"
+    keep = max(max_chars - len(marker), 0)
+    head = keep * 2 // 3
+    return user_prompt[:head] + marker + user_prompt[len(user_prompt) - (keep - head):]
+
+def split_to_budget(user_prompt: str, max_chars: int) -> List[str]:
+    """Split on paragraph boundaries into pieces of at most max_chars."""
+    pieces: List[str] = []
+    current = ""
+    for para in user_prompt.split("\n\n"):
+        while len(para) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(para[:max_chars])
+            para = para[max_chars:]
+        if current and len(current) + len(para) + 2 > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n\n{para}" if current else para
+    if current:
+        pieces.append(current)
+    return pieces
+
+def current_budget_policy(policy: Optional[str] = None) -> str:
+    policy = policy or st.session_state.get("token_budget_policy", DEFAULT_TOKEN_BUDGET_POLICY)
+    return policy if policy in TOKEN_BUDGET_POLICIES else DEFAULT_TOKEN_BUDGET_POLICY
+
+def apply_token_budget(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    policy: Optional[str] = None,
+) -> Tuple[List[str], int, Dict[str, Any]]:
+    """
+    Check a call against the model's context window before it is sent.
+    Returns (user prompts to send, clamped max_tokens, budget). More than one
+    prompt means the chunk policy split the input. Raises PromptBudgetError
+    under the abort policy, or when even the system prompt does not fit.
+    """
+    budget = prompt_budget(provider, model, system_prompt, user_prompt, max_tokens)
+    max_tokens = budget["output_tokens"]
+    if budget["fits"]:
+        return [user_prompt], max_tokens, budget
+
+    policy = current_budget_policy(policy)
+    needed = budget["input_tokens"] + budget["output_tokens"]
+    message = (
+        f"{provider} / {model}：預估 {needed:,} tokens 超過上下文上限 {budget['context']:,}"
+    )
+    max_chars = _user_prompt_char_budget(budget, user_prompt)
+    if policy == "abort" or max_chars <= 0:
+        raise PromptBudgetError(message + "，已中止請求。")
+
+    def fitted(text: str, shrink: Callable[[str, int], List[str]]) -> List[str]:
+        # Token density varies along the text (CJK vs Latin), so re-check each
+        # piece and shrink the ones that still overflow
+        out: List[str] = []
+        pending = [(piece, 0) for piece in shrink(text, max_chars)]
+        while pending:
+            piece, rounds = pending.pop(0)
+            piece_budget = prompt_budget(provider, model, system_prompt, piece, max_tokens)
+            if piece_budget["fits"] or rounds >= 8:
+                out.append(piece)
+                continue
+            limit = max(_user_prompt_char_budget(piece_budget, piece), 1)
+            pending[:0] = [(p, rounds + 1) for p in shrink(piece, limit)]
+        return out
+
+    if policy == "truncate":
+        add_combat_log(message + "，已截斷輸入。", "warning")
+        return fitted(user_prompt, lambda t, n: [truncate_to_budget(t, n)]), max_tokens, budget
+    pieces = fitted(user_prompt, split_to_budget)
+    add_combat_log(message + f"，已分為 {len(pieces)} 段呼叫。", "warning")
+    return [
+        f"[Part {i}/{len(pieces)} of a longer input]\n{piece}"
+        for i, piece in enumerate(pieces, start=1)
+    ], max_tokens, budget
+
+def render_cost_estimate(
+    provider: str, model: str, system_prompt: str, user_prompt: str, max_tokens: int
+):
+    """Caption with the estimated tokens and cost of a call before it is sent."""
+    render_budget_caption(prompt_budget(provider, model, system_prompt, user_prompt, max_tokens))
+
+def render_budget_caption(budget: Dict[str, Any]):
+    note = "" if budget["fits"] else f"（超過上下文上限 {budget['context']:,}，將依「{TOKEN_BUDGET_POLICIES[current_budget_policy()]}」處理）"
+    st.caption(
+        f"🧮 預估輸入 {budget['input_tokens']:,} + 輸出上限 {budget['output_tokens']:,} tokens，"
+        f"約 ${budget['cost']:.4f}{note}"
     )
 
 # -----------------------------------------------------------
-# Enhanced Sidebar (incl. Magic Flower Wheel)
+# Provider Scheduler (rate limits, retry with backoff, circuit breaker)
 # -----------------------------------------------------------
 
-def render_enhanced_sidebar(config: Dict[str, Any]):
-    """Render Nordic-themed sidebar with controls"""
-    st.sidebar.markdown(f"# {get_translation('title')}")
-    st.sidebar.markdown(f"*{get_translation('subtitle')}*")
-    st.sidebar.markdown("---")
+# Requests and tokens per minute per provider; override with e.g. OPENAI_RPM / OPENAI_TPM
+PROVIDER_RATE_LIMITS = {
+    "openai": {"rpm": 500, "tpm": 200000},
+    "gemini": {"rpm": 1000, "tpm": 1000000},
+    "xai": {"rpm": 60, "tpm": 100000},
+    "anthropic": {"rpm": 50, "tpm": 40000},
+}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_SECONDS = 1.0
+LLM_RETRY_MAX_SECONDS = 30.0
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 30.0
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+# gRPC status names (xAI SDK) and SDK exception class-name fragments that are transient
+_RETRYABLE_GRPC_CODES = {"RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL", "ABORTED"}
+_RETRYABLE_ERROR_NAMES = (
+    "RateLimit", "Timeout", "Connection", "ServiceUnavailable", "ResourceExhausted",
+    "InternalServerError", "Overloaded", "DeadlineExceeded",
+)
+
+class ProviderUnavailableError(RuntimeError):
+    """A provider kept failing after retries, or its circuit breaker is open."""
+
+    def __init__(self, provider: str, message: str):
+        super().__init__(message)
+        self.provider = provider
+
+def provider_rate_limits(provider: str) -> Dict[str, float]:
+    limits = dict(PROVIDER_RATE_LIMITS.get(provider, {"rpm": 60, "tpm": 100000}))
+    for name in ("rpm", "tpm"):
+        value = os.getenv(f"{provider.upper()}_{name.upper()}")
+        if value:
+            limits[name] = float(value)
+    return limits
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. reserve() takes capacity immediately (the level
+    may go negative) and returns how long the caller must wait before using
+    it, so concurrent callers queue up fairly instead of polling.
+    """
 
-    # Theme and Language Selection
-    col1, col2 = st.sidebar.columns(2)
-    with col1:
-        theme = st.selectbox(
-            get_translation("theme"),
-            ["light", "dark"],
-            index=1 if st.session_state.theme == "dark" else 0,
-            key="theme_selector"
-        )
-        if theme != st.session_state.theme:
-            st.session_state.theme = theme
-            st.rerun()
+    def __init__(self, capacity: float, per_second: float):
+        self.capacity = capacity
+        self.rate = per_second
+        self.level = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        # A request larger than the bucket waits for a full bucket, not forever
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures; after `cooldown` seconds one
+    trial call is let through (half-open) and its outcome closes or re-opens it.
+    """
 
-    with col2:
-        lang = st.selectbox(
-            get_translation("language"),
-            ["zh", "en"],
-            index=0 if st.session_state.language == "zh" else 1,
-            key="lang_selector"
-        )
-        if lang != st.session_state.language:
-            st.session_state.language = lang
-            st.rerun()
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD, cooldown: float = CIRCUIT_COOLDOWN_SECONDS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+class ProviderScheduler:
+    """Per-provider request/token buckets and circuit breakers, shared process-wide."""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _buckets_for(self, provider: str) -> Tuple[TokenBucket, TokenBucket]:
+        with self._lock:
+            if provider not in self._buckets:
+                limits = provider_rate_limits(provider)
+                self._buckets[provider] = (
+                    TokenBucket(limits["rpm"], limits["rpm"] / 60.0),
+                    TokenBucket(limits["tpm"], limits["tpm"] / 60.0),
+                )
+            return self._buckets[provider]
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        with self._lock:
+            if provider not in self._breakers:
+                self._breakers[provider] = CircuitBreaker()
+            return self._breakers[provider]
+
+    def reserve(self, provider: str, tokens: int) -> float:
+        """Reserve one request and `tokens` tokens; returns seconds to wait."""
+        requests, token_bucket = self._buckets_for(provider)
+        return max(requests.reserve(1), token_bucket.reserve(tokens))
+
+    def breaker_states(self) -> Dict[str, str]:
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {p: b.state for p, b in breakers.items()}
+
+@st.cache_resource
+def get_provider_scheduler() -> ProviderScheduler:
+    """Process-wide scheduler: provider quotas are shared by every session."""
+    return ProviderScheduler()
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """Transient provider errors: 429 / 5xx, timeouts, connection resets."""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    code = getattr(exc, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    if status is None and isinstance(code, int):
+        status = code
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS_CODES
+    if getattr(code, "name", None) in _RETRYABLE_GRPC_CODES:
+        return True
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    return any(part in type(exc).__name__ for part in _RETRYABLE_ERROR_NAMES)
+
+def retry_delay(attempt: int, exc: BaseException) -> float:
+    """Retry-After when the provider sent one, else jittered exponential backoff."""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after", ""))
+        if retry_after >= 0:
+            return min(retry_after, LLM_RETRY_MAX_SECONDS)
+    except (TypeError, ValueError):
+        pass
+    ceiling = min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+def _attempt_gate(provider: str, tokens: int) -> float:
+    """Check the circuit breaker and reserve quota; returns seconds to wait."""
+    scheduler = get_provider_scheduler()
+    if not scheduler.breaker(provider).allow():
+        raise ProviderUnavailableError(provider, f"{provider} 斷路器開啟中，暫停呼叫")
+    return scheduler.reserve(provider, tokens)
+
+def _attempt_failed(provider: str, exc: Exception, attempt: int) -> float:
+    """Record a failed attempt; returns the backoff delay or re-raises."""
+    breaker = get_provider_scheduler().breaker(provider)
+    if not is_retryable_error(exc):
+        # The provider answered (e.g. a 400); that is not an outage
+        breaker.record_success()
+        raise exc
+    breaker.record_failure()
+    if attempt >= LLM_MAX_RETRIES:
+        raise ProviderUnavailableError(
+            provider, f"{provider} 重試 {attempt} 次後仍失敗：{exc}"
+        ) from exc
+    delay = retry_delay(attempt, exc)
+    add_combat_log(
+        f"{provider} 暫時性錯誤，{delay:.1f} 秒後重試（第 {attempt + 1} 次）：{exc}", "warning"
+    )
+    return delay
+
+def _trace_wait(trace: Optional[Dict[str, Any]], seconds: float, retry: bool = False) -> float:
+    """Count a rate-limit or backoff wait (and a retry) on the call's trace"""
+    if trace is not None:
+        trace["queue_s"] += seconds
+        if retry:
+            trace["retries"] += 1
+    return seconds
+
+def scheduled_call(
+    provider: str, tokens: int, fn: Callable[[], Any], trace: Optional[Dict[str, Any]] = None
+) -> Any:
+    """
+    Run fn under the provider's rate limits and in-flight limit (see
+    QuotaGovernor), retrying transient errors.
+    """
+    attempt = 0
+    while True:
+        wait = _attempt_gate(provider, tokens)
+        _trace_wait(trace, wait)
+        if wait:
+            time.sleep(wait)
+        try:
+            with quota_slot(provider, trace):
+                result = fn()
+        except Exception as exc:
+            time.sleep(_trace_wait(trace, _attempt_failed(provider, exc, attempt), retry=True))
+            attempt += 1
+            continue
+        get_provider_scheduler().breaker(provider).record_success()
+        return result
 
-    # Magic Flower Wheel
-    st.sidebar.markdown("### 🌸 Magic Flower Wheel")
-    flower_names = list(FLOWER_STYLES.keys())
-    flower_labels = [
-        f"{FLOWER_STYLES[name]['icon']} {name}" for name in flower_names
-    ]
-    current_index = flower_names.index(st.session_state.get("flower_style", "Edelweiss"))
+def scheduled_stream(
+    provider: str,
+    tokens: int,
+    make_stream: Callable[[], Iterator[str]],
+    trace: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """Streaming variant; only retries when no chunk has been yielded yet."""
+    attempt = 0
+    while True:
+        wait = _attempt_gate(provider, tokens)
+        _trace_wait(trace, wait)
+        if wait:
+            time.sleep(wait)
+        started = False
+        try:
+            with quota_slot(provider, trace):
+                for chunk in make_stream():
+                    started = True
+                    yield chunk
+        except Exception as exc:
+            if started:
+                get_provider_scheduler().breaker(provider).record_failure()
+                raise
+            time.sleep(_trace_wait(trace, _attempt_failed(provider, exc, attempt), retry=True))
+            attempt += 1
+            continue
+        get_provider_scheduler().breaker(provider).record_success()
+        return
+
+async def ascheduled_call(
+    provider: str, tokens: int, fn: Callable[[], Awaitable[Any]], trace: Optional[Dict[str, Any]] = None
+) -> Any:
+    """Async scheduled_call; waits with asyncio.sleep so other calls keep running."""
+    attempt = 0
+    while True:
+        wait = _attempt_gate(provider, tokens)
+        _trace_wait(trace, wait)
+        if wait:
+            await asyncio.sleep(wait)
+        try:
+            async with aquota_slot(provider, trace):
+                result = await fn()
+        except Exception as exc:
+            await asyncio.sleep(_trace_wait(trace, _attempt_failed(provider, exc, attempt), retry=True))
+            attempt += 1
+            continue
+        get_provider_scheduler().breaker(provider).record_success()
+        return result
+
+async def ascheduled_stream(
+    provider: str,
+    tokens: int,
+    make_stream: Callable[[], AsyncIterator[str]],
+    trace: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[str]:
+    """Async scheduled_stream; only retries when no chunk has been yielded yet."""
+    attempt = 0
+    while True:
+        wait = _attempt_gate(provider, tokens)
+        _trace_wait(trace, wait)
+        if wait:
+            await asyncio.sleep(wait)
+        started = False
+        try:
+            async with aquota_slot(provider, trace):
+                async for chunk in make_stream():
+                    started = True
+                    yield chunk
+        except Exception as exc:
+            if started:
+                get_provider_scheduler().breaker(provider).record_failure()
+                raise
+            await asyncio.sleep(_trace_wait(trace, _attempt_failed(provider, exc, attempt), retry=True))
+            attempt += 1
+            continue
+        get_provider_scheduler().breaker(provider).record_success()
+        return
+
+def agent_fallbacks(agent_cfg: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """
+    Fallback (provider, model) pairs from an agent's yaml `fallback` key, which
+    may be a single {provider, model} mapping or a list of them.
+    """
+    raw = agent_cfg.get("fallback") or []
+    if isinstance(raw, dict):
+        raw = [raw]
+    return [
+        (str(fb["provider"]).lower().strip(), str(fb["model"]))
+        for fb in raw
+        if isinstance(fb, dict) and fb.get("provider") and fb.get("model")
+    ]
+
+def log_failover(provider: str, model: str, fallbacks: List[Tuple[str, str]], error: Exception):
+    fb_provider, fb_model = fallbacks[0]
+    add_combat_log(
+        f"{provider} / {model} 無法使用（{error}），改用備援 {fb_provider} / {fb_model}", "warning"
+    )
+
+# -----------------------------------------------------------
+# Provider Prompt Caching (stable prefixes, cache-hit accounting)
+# -----------------------------------------------------------
+
+# Smallest system prompt worth an explicit cache marker. Anthropic bills cache
+# writes above the input price and Gemini bills cache storage, so short prompts
+# are sent plainly. OpenAI and xAI cache identical prefixes automatically.
+PROMPT_CACHE_MIN_TOKENS = {"anthropic": 1024, "gemini": 4096}
+GEMINI_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CACHE_TTL_SECONDS", "3600"))
+# Price of a cache-hit input token relative to the list input price
+PROMPT_CACHE_PRICE_FACTOR = {"openai": 0.5, "anthropic": 0.1, "gemini": 0.25, "xai": 0.25}
+
+def prompt_cache_applies(provider: str, model: str, system_prompt: str) -> bool:
+    """Whether the system prompt should be sent as an explicitly cached prefix"""
+    if not st.session_state.get("prompt_cache_enabled", True):
+        return False
+    minimum = PROMPT_CACHE_MIN_TOKENS.get(provider)
+    return minimum is not None and estimate_tokens(system_prompt, provider, model) >= minimum
+
+def new_token_usage() -> Dict[str, int]:
+    # truncated: 1 when the response stopped at max_tokens (read_stop_reason)
+    return {
+        "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0,
+        "truncated": 0,
+    }
+
+def _usage_field(obj: Any, name: str) -> int:
+    value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def read_provider_usage(provider: str, raw: Any, usage: Optional[Dict[str, int]]):
+    """Copy token counts, including prompt-cache hits, from an SDK usage object"""
+    if usage is None or raw is None:
+        return
+    if provider == "openai":
+        details = raw.get("prompt_tokens_details") if isinstance(raw, dict) else getattr(
+            raw, "prompt_tokens_details", None
+        )
+        usage["input_tokens"] = _usage_field(raw, "prompt_tokens")
+        usage["output_tokens"] = _usage_field(raw, "completion_tokens")
+        usage["cached_tokens"] = _usage_field(details, "cached_tokens") if details else 0
+    elif provider == "anthropic":
+        # Anthropic's input_tokens excludes the tokens read from or written to the cache
+        usage["cached_tokens"] = _usage_field(raw, "cache_read_input_tokens")
+        usage["cache_write_tokens"] = _usage_field(raw, "cache_creation_input_tokens")
+        usage["input_tokens"] = (
+            _usage_field(raw, "input_tokens") + usage["cached_tokens"] + usage["cache_write_tokens"]
+        )
+        usage["output_tokens"] = _usage_field(raw, "output_tokens")
+    elif provider == "gemini":
+        usage["input_tokens"] = _usage_field(raw, "prompt_token_count")
+        usage["output_tokens"] = _usage_field(raw, "candidates_token_count")
+        usage["cached_tokens"] = _usage_field(raw, "cached_content_token_count")
+    elif provider == "xai":
+        usage["input_tokens"] = _usage_field(raw, "prompt_tokens")
+        usage["output_tokens"] = _usage_field(raw, "completion_tokens")
+        usage["cached_tokens"] = _usage_field(raw, "cached_prompt_text_tokens")
+
+# Stop reasons meaning "ran out of max_tokens", per provider
+_LENGTH_STOP_REASONS = {
+    "openai": {"length"},
+    "anthropic": {"max_tokens"},
+    "gemini": {"MAX_TOKENS", "2"},
+    "xai": {"REASON_MAX_LEN", "length"},
+}
+
+def read_stop_reason(provider: str, resp: Any, usage: Optional[Dict[str, int]]):
+    """Set usage["truncated"] when a non-streamed response stopped at max_tokens"""
+    if usage is None or resp is None:
+        return
+    if provider == "openai":
+        choices = getattr(resp, "choices", None) or [None]
+        reason = getattr(choices[0], "finish_reason", None)
+    elif provider == "anthropic":
+        reason = getattr(resp, "stop_reason", None)
+    elif provider == "gemini":
+        candidates = getattr(resp, "candidates", None) or [None]
+        reason = getattr(candidates[0], "finish_reason", None)
+        reason = getattr(reason, "name", reason)
+    else:
+        reason = getattr(resp, "finish_reason", None)
+    if reason is not None and str(reason) in _LENGTH_STOP_REASONS.get(provider, ()):
+        usage["truncated"] = 1
+
+def log_prompt_cache_usage(
+    provider: str, model: str, usage: Dict[str, int], price_factor: float = 1.0
+):
+    """Report provider-side cache hits and the discount they earned"""
+    cached = usage.get("cached_tokens", 0)
+    if not cached:
+        return
+    saved = (
+        cached
+        * model_token_limits(provider, model)["input_per_m"]
+        * (1 - PROMPT_CACHE_PRICE_FACTOR.get(provider, 1.0))
+        * price_factor
+        / 1_000_000
+    )
+    add_combat_log(
+        f"{provider} / {model}：提示快取命中 {cached:,} / {usage.get('input_tokens', 0):,} 輸入 tokens，"
+        f"約省 ${saved:.4f}",
+        "success",
+    )
+
+def gemini_model_and_prompt(
+    api_key: str, model: str, system_prompt: str, user_prompt: str, agent_id: Optional[str] = None
+) -> Tuple[Any, str]:
+    """
+    Gemini model object and prompt text for a call. A long system prompt that
+    is reused is moved into cached content so only the user message is sent
+    each time; the agent id lets an edited prompt replace its old cache.
+    """
+    registry = get_client_registry()
+    if prompt_cache_applies("gemini", model, system_prompt):
+        cached_model = registry.get_gemini_cached_model(api_key, model, system_prompt, slot=agent_id)
+        if cached_model is not None:
+            return cached_model, user_prompt
+    return registry.get_gemini_model(api_key, model), system_prompt + "\n\nUSER MESSAGE:\n" + user_prompt
+
+# -----------------------------------------------------------
+# LLM Call Telemetry (latency, tokens, cost; ring buffer + exporters)
+# -----------------------------------------------------------
+
+LLM_TELEMETRY_BUFFER_SIZE = int(os.getenv("LLM_TELEMETRY_BUFFER_SIZE", "5000"))
+# Optional exporters: a JSONL file path, and/or OpenTelemetry spans (needs opentelemetry-api
+# plus whatever SDK / exporter the deployment configures)
+LLM_TELEMETRY_JSONL = os.getenv("LLM_TELEMETRY_JSONL", "")
+LLM_TELEMETRY_OTEL = os.getenv("LLM_TELEMETRY_OTEL", "").lower() in ("1", "true", "yes")
+
+class JsonlTelemetryExporter:
+    """Appends every call record to a JSONL file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+class OtelTelemetryExporter:
+    """
+    Emits every call as an OpenTelemetry span with GenAI semantic-convention
+    attributes. Span processors and exporters come from the deployment's
+    OpenTelemetry SDK setup; without one the API is a no-op.
+    """
+
+    def __init__(self):
+        self._tracer = opentelemetry_trace.get_tracer("fda-510k-review-studio")
+
+    def export(self, record: Dict[str, Any]):
+        end_ns = int(record["ts"] * 1e9)
+        attributes = {
+            "gen_ai.operation.name": "chat",
+            "gen_ai.system": record["provider"],
+            "gen_ai.request.model": record["model"],
+            "gen_ai.agent.id": record["agent_id"],
+            "gen_ai.usage.input_tokens": record["input_tokens"],
+            "gen_ai.usage.output_tokens": record["output_tokens"],
+            "app.llm.cached_tokens": record["cached_tokens"],
+            "app.llm.queue_s": record["queue_s"],
+            "app.llm.ttfb_s": record["ttfb_s"],
+            "app.llm.retries": record["retries"],
+            "app.llm.status": record["status"],
+            "app.llm.cost_usd": record["cost"],
+            "app.llm.session": record["session"],
+        }
+        span = self._tracer.start_span(
+            f"chat {record['model']}",
+            start_time=end_ns - int(record["total_s"] * 1e9),
+            attributes={k: v for k, v in attributes.items() if v is not None},
+        )
+        if record["status"] == "error":
+            span.set_status(opentelemetry_trace.Status(
+                opentelemetry_trace.StatusCode.ERROR, record["error"] or ""
+            ))
+        span.end(end_time=end_ns)
+
+class LLMTelemetry:
+    """
+    Process-wide ring buffer of per-call records (oldest dropped first), each
+    also handed to the configured exporters. Exporter failures are swallowed:
+    telemetry never fails a model call.
+    """
+
+    def __init__(self, max_records: int, exporters: Optional[List[Any]] = None):
+        self._records: "deque[Dict[str, Any]]" = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+        self.exporters = exporters or []
+
+    def record(self, record: Dict[str, Any]):
+        with self._lock:
+            self._records.append(record)
+        for exporter in self.exporters:
+            try:
+                exporter.export(record)
+            except Exception:
+                pass
+
+    def records(self, session: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            records = list(self._records)
+        if session is None:
+            return records
+        return [r for r in records if r["session"] == session]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+@st.cache_resource
+def get_llm_telemetry() -> LLMTelemetry:
+    """Shared call telemetry (one buffer per server process)"""
+    exporters: List[Any] = []
+    if LLM_TELEMETRY_JSONL:
+        exporters.append(JsonlTelemetryExporter(LLM_TELEMETRY_JSONL))
+    if LLM_TELEMETRY_OTEL and opentelemetry_trace.available:
+        exporters.append(OtelTelemetryExporter())
+    return LLMTelemetry(LLM_TELEMETRY_BUFFER_SIZE, exporters)
+
+def usage_cost(provider: str, model: str, usage: Dict[str, int]) -> float:
+    """USD cost of a call from the provider-reported token counts"""
+    limits = model_token_limits(provider, model)
+    cached = usage.get("cached_tokens", 0)
+    uncached = max(usage.get("input_tokens", 0) - cached, 0)
+    return (
+        uncached * limits["input_per_m"]
+        + cached * limits["input_per_m"] * PROMPT_CACHE_PRICE_FACTOR.get(provider, 1.0)
+        + usage.get("output_tokens", 0) * limits["output_per_m"]
+    ) / 1_000_000
+
+def start_llm_trace(
+    provider: str, model: str, agent_id: Optional[str], streamed: bool
+) -> Dict[str, Any]:
+    """
+    Per-call timing state. The scheduler adds rate-limit, concurrency and
+    retry-backoff waits to queue_s and counts retries; streaming calls set
+    first_token_s (seconds since start) on the first chunk.
+    """
+    return {
+        "provider": provider,
+        "model": model,
+        "agent_id": agent_id,
+        "streamed": streamed,
+        "started": time.perf_counter(),
+        "queue_s": 0.0,
+        "first_token_s": None,
+        "retries": 0,
+    }
+
+def finish_llm_trace(
+    trace: Dict[str, Any],
+    usage: Optional[Dict[str, int]] = None,
+    budget: Optional[Dict[str, Any]] = None,
+    error: Optional[BaseException] = None,
+    status: Optional[str] = None,
+    price_factor: float = 1.0,
+    batch: bool = False,
+) -> Dict[str, Any]:
+    """
+    Turn a trace into a telemetry record, store it, charge the tokens and cost
+    to the quota governor (the only spend ledger) and note the call in the
+    activity log
+    """
+    total_s = time.perf_counter() - trace["started"]
+    usage = usage or new_token_usage()
+    provider, model = trace["provider"], trace["model"]
+    if status is None:
+        status = "error" if error is not None else "ok"
+    if status == "cache_hit" or error is not None:
+        cost, cost_estimated = 0.0, False
+    elif usage.get("input_tokens"):
+        cost, cost_estimated = usage_cost(provider, model, usage) * price_factor, False
+    else:
+        cost, cost_estimated = (budget or {}).get("cost", 0.0) * price_factor, True
+    queue_s = trace["queue_s"]
+    if trace["first_token_s"] is not None:
+        ttfb_s: Optional[float] = max(trace["first_token_s"] - queue_s, 0.0)
+    elif status == "ok" and not batch:
+        # A non-streamed body arrives all at once: first byte ~ service time
+        ttfb_s = max(total_s - queue_s, 0.0)
+    else:
+        ttfb_s = None
+    record = {
+        "ts": time.time(),
+        "session": quota_session(),
+        "provider": provider,
+        "model": model,
+        "agent_id": trace["agent_id"],
+        "status": status,
+        "error": f"{type(error).__name__}: {error}" if error is not None else None,
+        "streamed": trace["streamed"],
+        "batch": batch,
+        "queue_s": round(queue_s, 4),
+        "ttfb_s": round(ttfb_s, 4) if ttfb_s is not None else None,
+        "total_s": round(total_s, 4),
+        "retries": trace["retries"],
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "cached_tokens": usage.get("cached_tokens", 0),
+        "cache_write_tokens": usage.get("cache_write_tokens", 0),
+        "cost": round(cost, 6),
+        "cost_estimated": cost_estimated,
+    }
+    get_llm_telemetry().record(record)
+    charged = {k: record[k] for k in ("input_tokens", "output_tokens", "cached_tokens")}
+    if status == "ok" and not charged["input_tokens"] + charged["output_tokens"]:
+        charged.update(
+            input_tokens=(budget or {}).get("input_tokens", 0),
+            output_tokens=(budget or {}).get("output_tokens", 0),
+        )
+    if status == "ok" or charged["input_tokens"] + charged["output_tokens"]:
+        get_quota_governor().charge(
+            record["session"], provider, charged, record["cost"], quota_reservation.get()
+        )
+    if status == "ok" and not batch:
+        if trace["streamed"] and ttfb_s is not None:
+            add_combat_log(
+                f"{provider} / {model}：首個 token {ttfb_s:.2f} 秒，總計 {total_s:.2f} 秒"
+                f"（排隊 {queue_s:.2f} 秒，重試 {trace['retries']} 次），花費 ${cost:.4f}",
+                "info",
+            )
+        else:
+            add_combat_log(
+                f"{provider} / {model}：總計 {total_s:.2f} 秒"
+                f"（排隊 {queue_s:.2f} 秒，重試 {trace['retries']} 次），花費 ${cost:.4f}",
+                "info",
+            )
+    if status == "ok":
+        log_prompt_cache_usage(provider, model, usage, price_factor=price_factor)
+        if usage.get("truncated"):
+            add_combat_log(
+                f"{provider} / {model}：輸出達到 max_tokens 上限（{record['output_tokens']:,} tokens），內容可能被截斷。",
+                "warning",
+            )
+    return record
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Linear-interpolated percentile (q in 0..100); None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.0
+    low = int(math.floor(pos))
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+def summarize_llm_calls(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Per-agent call counts, latency percentiles, tokens and cost, costliest first"""
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for record in records:
+        groups.setdefault(record["agent_id"] or "(未指定代理)", []).append(record)
+    rows = []
+    for agent_id, items in groups.items():
+        sent = [r for r in items if r["status"] == "ok"]
+        totals = [r["total_s"] for r in sent]
+        ttfbs = [r["ttfb_s"] for r in sent if r["ttfb_s"] is not None]
+        rows.append({
+            "agent_id": agent_id,
+            "calls": len(items),
+            "errors": sum(1 for r in items if r["status"] == "error"),
+            "cache_hits": sum(1 for r in items if r["status"] == "cache_hit"),
+            "retries": sum(r["retries"] for r in items),
+            "p50_s": percentile(totals, 50),
+            "p95_s": percentile(totals, 95),
+            "p50_ttfb_s": percentile(ttfbs, 50),
+            "p50_queue_s": percentile([r["queue_s"] for r in sent], 50),
+            "input_tokens": sum(r["input_tokens"] for r in items),
+            "output_tokens": sum(r["output_tokens"] for r in items),
+            "cached_tokens": sum(r["cached_tokens"] for r in items),
+            "cost": sum(r["cost"] for r in items),
+        })
+    return sorted(rows, key=lambda row: row["cost"], reverse=True)
+
+# -----------------------------------------------------------
+# Quota Governor (token budgets, in-flight calls, pipeline reservations)
+# -----------------------------------------------------------
+
+# Tokens (input + output) per provider, per browser session and per calendar day
+# (server local time, all sessions together); 0 = unlimited. Override with e.g.
+# OPENAI_SESSION_TOKENS / OPENAI_DAILY_TOKENS
+PROVIDER_TOKEN_BUDGETS = {
+    "openai": {"session": 2_000_000, "daily": 20_000_000},
+    "gemini": {"session": 4_000_000, "daily": 40_000_000},
+    "xai": {"session": 1_000_000, "daily": 10_000_000},
+    "anthropic": {"session": 2_000_000, "daily": 20_000_000},
+}
+# Requests on the wire per provider across the whole server process (every
+# session and event loop); override with e.g. OPENAI_MAX_IN_FLIGHT
+PROVIDER_MAX_IN_FLIGHT = {
+    "openai": 16,
+    "gemini": 16,
+    "xai": 8,
+    "anthropic": 16,
+}
+QUOTA_SLOT_POLL_SECONDS = 0.05
+# Per-session spend is kept in memory for this many most recent sessions
+QUOTA_MAX_SESSIONS = 1000
+
+class QuotaExceededError(RuntimeError):
+    """A call or pipeline reservation does not fit a provider's remaining token budget."""
+
+    def __init__(self, provider: str, message: str):
+        super().__init__(message)
+        self.provider = provider
+
+def provider_token_budgets(provider: str) -> Dict[str, int]:
+    budgets = dict(PROVIDER_TOKEN_BUDGETS.get(provider, {"session": 1_000_000, "daily": 10_000_000}))
+    for name in ("session", "daily"):
+        value = os.getenv(f"{provider.upper()}_{name.upper()}_TOKENS")
+        if value:
+            budgets[name] = int(value)
+    return budgets
+
+def provider_max_in_flight(provider: str) -> int:
+    value = os.getenv(f"{provider.upper()}_MAX_IN_FLIGHT")
+    return int(value) if value else PROVIDER_MAX_IN_FLIGHT.get(provider, 8)
+
+def new_llm_usage() -> Dict[str, float]:
+    """Spend totals kept by the quota governor per session and per reservation"""
+    return {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0, "cost": 0.0}
+
+class QuotaReservation:
+    """
+    Tokens set aside per provider for one pipeline run. Calls made while it is
+    the active reservation (quota_reservation) draw on it first; whatever is
+    left is returned to the budget when it is released. usage totals what the
+    run's calls were charged (e.g. one batch case).
+    """
+
+    def __init__(self, session: str, tokens: Dict[str, int]):
+        self.session = session
+        self.reserved = dict(tokens)
+        self.used: Dict[str, int] = {}
+        self.usage = new_llm_usage()
+
+    def remaining(self, provider: str) -> int:
+        return max(self.reserved.get(provider, 0) - self.used.get(provider, 0), 0)
+
+# Reservation of the pipeline run in progress. Tasks spawned while it is set
+# share it, so a whole pipeline run is counted together.
+quota_reservation: "contextvars.ContextVar[Optional[QuotaReservation]]" = contextvars.ContextVar(
+    "quota_reservation", default=None
+)
+
+def quota_session() -> str:
+    """Budget owner of the current call: the active reservation's session, else this browser session"""
+    reservation = quota_reservation.get()
+    if reservation is not None:
+        return reservation.session
+    return st.session_state.get("telemetry_session", "headless")
+
+class QuotaGovernor:
+    """
+    Process-wide token spend and in-flight request accounting per provider:
+    the one limiter of concurrent requests and the one ledger of token and
+    cost spend (per session, per reservation and per day).
+
+    Spend is charged after each call from the provider-reported usage (the
+    pre-call estimate when none is reported) against a per-session and a
+    per-day budget; daily totals live in SQLite so a restart does not reset
+    them. Tokens held by active reservations count as spent when admitting
+    other work. Admission is checked before a call is sent, so calls already
+    in flight can overshoot a budget by at most their own size.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._slots = threading.Condition()
+        self._in_flight: Dict[str, int] = {}
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._reservations: List[QuotaReservation] = []
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota_daily_usage ("
+            " day TEXT NOT NULL,"
+            " provider TEXT NOT NULL,"
+            " tokens INTEGER NOT NULL,"
+            " cost REAL NOT NULL,"
+            " PRIMARY KEY (day, provider))"
+        )
+        self._conn.commit()
+        self._day = ""
+        self._daily: Dict[str, int] = {}
+
+    def _roll_day(self):
+        """Reload daily totals when the calendar day changes (caller holds the lock)"""
+        today = datetime.date.today().isoformat()
+        if today != self._day:
+            self._day = today
+            self._daily = dict(self._conn.execute(
+                "SELECT provider, tokens FROM quota_daily_usage WHERE day = ?", (today,)
+            ).fetchall())
+
+    def _session_spend(self, session: str) -> Dict[str, Any]:
+        """{"tokens": {provider: tokens}, "usage": new_llm_usage()} of a session"""
+        spend = self._sessions.get(session)
+        if spend is None:
+            spend = self._sessions[session] = {"tokens": {}, "usage": new_llm_usage()}
+            while len(self._sessions) > QUOTA_MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session)
+        return spend
+
+    def _headroom(self, session: str, provider: str) -> Tuple[Optional[int], Optional[int]]:
+        """(session, daily) tokens still free after spend and reservations; None = unlimited"""
+        budgets = provider_token_budgets(provider)
+        held_session = sum(r.remaining(provider) for r in self._reservations if r.session == session)
+        held_daily = sum(r.remaining(provider) for r in self._reservations)
+        session_free = daily_free = None
+        if budgets["session"]:
+            spent = self._session_spend(session)["tokens"].get(provider, 0)
+            session_free = budgets["session"] - spent - held_session
+        if budgets["daily"]:
+            daily_free = budgets["daily"] - self._daily.get(provider, 0) - held_daily
+        return session_free, daily_free
+
+    def _check(self, session: str, provider: str, tokens: int, what: str):
+        session_free, daily_free = self._headroom(session, provider)
+        for free, scope in ((session_free, "本工作階段"), (daily_free, "本日")):
+            if free is not None and tokens > free:
+                raise QuotaExceededError(
+                    provider,
+                    f"{provider} {scope} token 預算不足：{what}需約 {tokens:,} tokens，"
+                    f"剩餘 {max(free, 0):,} tokens",
+                )
+
+    def reserve(self, session: str, tokens: Dict[str, int]) -> QuotaReservation:
+        """Set aside tokens per provider, or raise QuotaExceededError without reserving anything."""
+        with self._lock:
+            self._roll_day()
+            for provider, amount in tokens.items():
+                self._check(session, provider, amount, "此流程")
+            reservation = QuotaReservation(session, tokens)
+            self._reservations.append(reservation)
+            return reservation
+
+    def release(self, reservation: QuotaReservation) -> Dict[str, int]:
+        """Return a reservation's unused tokens to the budget; returns them per provider."""
+        with self._lock:
+            if reservation in self._reservations:
+                self._reservations.remove(reservation)
+        return {p: reservation.remaining(p) for p in reservation.reserved}
+
+    def admit(self, session: str, provider: str, tokens: int, reservation: Optional[QuotaReservation] = None):
+        """Raise QuotaExceededError unless the reservation or the free budget covers the call."""
+        with self._lock:
+            self._roll_day()
+            covered = reservation.remaining(provider) if reservation is not None else 0
+            if tokens > covered:
+                self._check(session, provider, tokens - covered, "此次呼叫")
+
+    def charge(
+        self,
+        session: str,
+        provider: str,
+        usage: Dict[str, int],
+        cost: float,
+        reservation: Optional[QuotaReservation] = None,
+    ):
+        """Record what a call spent (input_tokens / output_tokens / cached_tokens and cost)"""
+        tokens = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+        with self._lock:
+            self._roll_day()
+            spend = self._session_spend(session)
+            spend["tokens"][provider] = spend["tokens"].get(provider, 0) + tokens
+            self._daily[provider] = self._daily.get(provider, 0) + tokens
+            totals = [spend["usage"]]
+            if reservation is not None:
+                reservation.used[provider] = reservation.used.get(provider, 0) + tokens
+                totals.append(reservation.usage)
+            for total in totals:
+                total["calls"] += 1
+                for field in ("input_tokens", "output_tokens", "cached_tokens"):
+                    total[field] += usage.get(field, 0)
+                total["cost"] += cost
+            self._conn.execute(
+                "INSERT INTO quota_daily_usage (day, provider, tokens, cost) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (day, provider) DO UPDATE SET"
+                " tokens = tokens + excluded.tokens, cost = cost + excluded.cost",
+                (self._day, provider, tokens, cost),
+            )
+            self._conn.commit()
+
+    def try_acquire_slot(self, provider: str) -> bool:
+        with self._slots:
+            if self._in_flight.get(provider, 0) >= provider_max_in_flight(provider):
+                return False
+            self._in_flight[provider] = self._in_flight.get(provider, 0) + 1
+            return True
+
+    def acquire_slot(self, provider: str):
+        """Block until fewer than the provider's maximum requests are in flight, then take a slot."""
+        with self._slots:
+            self._slots.wait_for(
+                lambda: self._in_flight.get(provider, 0) < provider_max_in_flight(provider)
+            )
+            self._in_flight[provider] = self._in_flight.get(provider, 0) + 1
+
+    def release_slot(self, provider: str):
+        with self._slots:
+            self._in_flight[provider] = max(self._in_flight.get(provider, 0) - 1, 0)
+            self._slots.notify_all()
+
+    def session_usage(self, session: str) -> Dict[str, float]:
+        """Calls, tokens and cost charged to a session so far"""
+        with self._lock:
+            spend = self._sessions.get(session)
+            return dict(spend["usage"]) if spend is not None else new_llm_usage()
+
+    def snapshot(self, session: str) -> List[Dict[str, Any]]:
+        """Per-provider spend, budgets, reservations and in-flight requests for display"""
+        with self._lock:
+            self._roll_day()
+            spend = dict(self._sessions[session]["tokens"]) if session in self._sessions else {}
+            rows = []
+            for provider in PROVIDER_TOKEN_BUDGETS:
+                budgets = provider_token_budgets(provider)
+                rows.append({
+                    "provider": provider,
+                    "session_tokens": spend.get(provider, 0),
+                    "session_budget": budgets["session"],
+                    "daily_tokens": self._daily.get(provider, 0),
+                    "daily_budget": budgets["daily"],
+                    "reserved": sum(
+                        r.remaining(provider) for r in self._reservations if r.session == session
+                    ),
+                    "in_flight": self._in_flight.get(provider, 0),
+                    "max_in_flight": provider_max_in_flight(provider),
+                })
+        return rows
+
+@st.cache_resource
+def get_quota_governor() -> QuotaGovernor:
+    """Process-wide governor: daily budgets and in-flight limits are shared by every session."""
+    return QuotaGovernor(os.path.join(APP_CACHE_DIR, "quota_usage.sqlite"))
+
+def admit_llm_call(provider: str, budget: Dict[str, Any]):
+    """Admission control for one call: raises QuotaExceededError when the budget cannot cover it."""
+    get_quota_governor().admit(
+        quota_session(),
+        provider,
+        budget["input_tokens"] + budget["output_tokens"],
+        quota_reservation.get(),
+    )
+
+@contextlib.contextmanager
+def quota_slot(provider: str, trace: Optional[Dict[str, Any]] = None):
+    """Hold one of the provider's in-flight slots; the wait counts as queue time."""
+    governor = get_quota_governor()
+    started = time.perf_counter()
+    governor.acquire_slot(provider)
+    _trace_wait(trace, time.perf_counter() - started)
+    try:
+        yield
+    finally:
+        governor.release_slot(provider)
+
+@contextlib.asynccontextmanager
+async def aquota_slot(provider: str, trace: Optional[Dict[str, Any]] = None):
+    """Async quota_slot; polls with asyncio.sleep so the event loop keeps running."""
+    governor = get_quota_governor()
+    started = time.perf_counter()
+    while not governor.try_acquire_slot(provider):
+        await asyncio.sleep(QUOTA_SLOT_POLL_SECONDS)
+    _trace_wait(trace, time.perf_counter() - started)
+    try:
+        yield
+    finally:
+        governor.release_slot(provider)
+
+def release_quota_reservation(reservation: QuotaReservation):
+    """Release a pipeline reservation and log what it used."""
+    unused = get_quota_governor().release(reservation)
+    for provider, reserved in reservation.reserved.items():
+        add_combat_log(
+            f"{provider} 配額：預留 {reserved:,} tokens，實際使用 {reservation.used.get(provider, 0):,}，"
+            f"釋放 {unused[provider]:,}",
+            "info",
+        )
+
+# -----------------------------------------------------------
+# LLM Call Router (OpenAI, Gemini, Grok via xai_sdk, Anthropic)
+# -----------------------------------------------------------
+
+def openai_chat_request(
+    model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float
+) -> Dict[str, Any]:
+    """
+    Chat Completions request body, shared by sync, async, streaming and batch
+    calls. The system prompt always comes first so OpenAI's automatic prompt
+    caching can match it as a prefix.
+    """
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+
+def anthropic_message_request(
+    model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float
+) -> Dict[str, Any]:
+    """
+    Messages API request params, shared by sync, async, streaming and batch
+    calls. A long system prompt carries a cache_control breakpoint so repeated
+    calls read it from Anthropic's prompt cache.
+    """
+    system: Union[str, List[Dict[str, Any]]] = system_prompt
+    if prompt_cache_applies("anthropic", model, system_prompt):
+        system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "system": system,
+        "messages": [{"role": "user", "content": user_prompt}],
+    }
+
+def invoke_provider(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    api_key: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    usage: Optional[Dict[str, int]] = None,
+    agent_id: Optional[str] = None,
+) -> str:
+    """
+    Send one completion request through the pooled provider client. When a
+    usage dict is given it is filled with the reported token counts.
+    """
+    registry = get_client_registry()
+
+    if provider == "openai":
+        client = registry.get("openai", api_key)
+        resp = client.chat.completions.create(
+            **openai_chat_request(model, system_prompt, user_prompt, max_tokens, temperature),
+        )
+        read_provider_usage("openai", resp.usage, usage)
+        read_stop_reason("openai", resp, usage)
+        return resp.choices[0].message.content
+
+    elif provider == "gemini":
+        model_obj, prompt = gemini_model_and_prompt(
+            api_key, model, system_prompt, user_prompt, agent_id
+        )
+        resp = model_obj.generate_content(
+            prompt,
+            generation_config=genai.types.GenerationConfig(
+                max_output_tokens=max_tokens,
+                temperature=temperature,
+            )
+        )
+        read_provider_usage("gemini", getattr(resp, "usage_metadata", None), usage)
+        read_stop_reason("gemini", resp, usage)
+        return resp.text
+
+    elif provider == "xai":
+        # Grok via xai_sdk (per official sample)
+        client = registry.get("xai", api_key)
+        chat = client.chat.create(model=model)
+        chat.append(xai_chat.system(system_prompt))
+        chat.append(xai_chat.user(user_prompt))
+        response = chat.sample()
+        read_provider_usage("xai", getattr(response, "usage", None), usage)
+        read_stop_reason("xai", response, usage)
+        # response.content is typically a string
+        return getattr(response, "content", str(response))
+
+    elif provider == "anthropic":
+        client = registry.get("anthropic", api_key)
+        resp = client.messages.create(
+            **anthropic_message_request(model, system_prompt, user_prompt, max_tokens, temperature)
+        )
+        read_provider_usage("anthropic", resp.usage, usage)
+        read_stop_reason("anthropic", resp, usage)
+        if resp.content and len(resp.content) > 0:
+            block = resp.content[0]
+            if hasattr(block, "text"):
+                return block.text
+        return json.dumps(resp.model_dump(), indent=2)
+
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+def stream_provider(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    api_key: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    usage: Optional[Dict[str, int]] = None,
+    agent_id: Optional[str] = None,
+) -> Iterator[str]:
+    """Yield completion text chunks as the provider streams them"""
+    registry = get_client_registry()
+
+    if provider == "openai":
+        client = registry.get("openai", api_key)
+        stream = client.chat.completions.create(
+            **openai_chat_request(model, system_prompt, user_prompt, max_tokens, temperature),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        for chunk in stream:
+            if chunk.usage:
+                read_provider_usage("openai", chunk.usage, usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    elif provider == "gemini":
+        model_obj, prompt = gemini_model_and_prompt(
+            api_key, model, system_prompt, user_prompt, agent_id
+        )
+        resp = model_obj.generate_content(
+            prompt,
+            generation_config=genai.types.GenerationConfig(
+                max_output_tokens=max_tokens,
+                temperature=temperature,
+            ),
+            stream=True,
+        )
+        for chunk in resp:
+            read_provider_usage("gemini", getattr(chunk, "usage_metadata", None), usage)
+            text = _gemini_chunk_text(chunk)
+            if text:
+                yield text
+
+    elif provider == "xai":
+        client = registry.get("xai", api_key)
+        chat = client.chat.create(model=model)
+        chat.append(xai_chat.system(system_prompt))
+        chat.append(xai_chat.user(user_prompt))
+        response = None
+        for response, chunk in chat.stream():
+            if chunk.content:
+                yield chunk.content
+        read_provider_usage("xai", getattr(response, "usage", None), usage)
+
+    elif provider == "anthropic":
+        client = registry.get("anthropic", api_key)
+        with client.messages.stream(
+            **anthropic_message_request(model, system_prompt, user_prompt, max_tokens, temperature)
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
+            read_provider_usage("anthropic", stream.get_final_message().usage, usage)
+
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+def _gemini_chunk_text(chunk: Any) -> str:
+    # chunk.text raises when a chunk carries no text part (e.g. safety metadata)
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        return ""
+
+def lookup_cached_response(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    use_cache: bool,
+    agent_id: Optional[str] = None,
+) -> Tuple[Optional[LLMResponseCache], Optional[str], Optional[str]]:
+    """
+    Return (cache, cache_key, cached_response); cache is None when disabled.
+    A hit is recorded in the call telemetry as a cache_hit.
+    """
+    if not (use_cache and st.session_state.get("llm_cache_enabled", True)):
+        return None, None, None
+    cache = get_llm_response_cache()
+    cache_key = LLMResponseCache.make_key(
+        provider, model, system_prompt, user_prompt, temperature, max_tokens
+    )
+    cached = cache.get(cache_key)
+    record_llm_cache_event(cached is not None, provider, model)
+    if cached is not None:
+        finish_llm_trace(start_llm_trace(provider, model, agent_id, False), status="cache_hit")
+    return cache, cache_key, cached
+
+def call_llm(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    use_cache: bool = True,
+    stream: bool = False,
+    budget_policy: Optional[str] = None,
+    fallbacks: Optional[List[Tuple[str, str]]] = None,
+    agent_id: Optional[str] = None,
+) -> Union[str, Iterator[str]]:
+    """
+    Route LLM calls to appropriate provider (through the response cache).
+    With stream=True an iterator of text chunks is returned instead.
+    The prompt is checked against the model's context window first; see
+    apply_token_budget for the truncate / chunk / abort policies. Calls run
+    under the provider scheduler (rate limits, retries, circuit breaker);
+    when the provider stays unavailable the next (provider, model) in
+    fallbacks is tried. Every call is recorded in the call telemetry under
+    agent_id (see finish_llm_trace).
+    """
+    provider = provider.lower().strip()
+    prompts, max_tokens, budget = apply_token_budget(
+        provider, model, system_prompt, user_prompt, max_tokens, budget_policy
+    )
+    if len(prompts) > 1:
+        parts = (
+            call_llm(provider, model, system_prompt, p, max_tokens, temperature,
+                     use_cache, stream, budget_policy="abort", fallbacks=fallbacks,
+                     agent_id=agent_id)
+            for p in prompts
+        )
+        if stream:
+            return _chain_streams(parts)
+        return "\n\n".join(parts)
+    user_prompt = prompts[0]
+
+    if stream:
+        return _stream_llm(
+            provider, model, system_prompt, user_prompt, max_tokens, temperature, use_cache,
+            budget, budget_policy, fallbacks or [], agent_id,
+        )
+
+    cache, cache_key, cached = lookup_cached_response(
+        provider, model, system_prompt, user_prompt, max_tokens, temperature, use_cache, agent_id
+    )
+    if cached is not None:
+        return cached
+
+    admit_llm_call(provider, budget)
+    add_combat_log(f"呼叫 {provider} 模型：{model}", "spell")
+
+    api_key = get_provider_api_key(provider)
+    usage = new_token_usage()
+    trace = start_llm_trace(provider, model, agent_id, streamed=False)
+    try:
+        result = scheduled_call(
+            provider,
+            budget["input_tokens"] + budget["output_tokens"],
+            lambda: invoke_provider(
+                provider=provider,
+                model=model,
+                system_prompt=system_prompt,
+                user_prompt=user_prompt,
+                api_key=api_key,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                agent_id=agent_id,
+                usage=usage,
+            ),
+            trace=trace,
+        )
+    except Exception as e:
+        finish_llm_trace(trace, usage, budget, error=e)
+        if not isinstance(e, ProviderUnavailableError) or not fallbacks:
+            raise
+        log_failover(provider, model, fallbacks, e)
+        fb_provider, fb_model = fallbacks[0]
+        return call_llm(
+            fb_provider, fb_model, system_prompt, user_prompt, max_tokens, temperature,
+            use_cache, budget_policy=budget_policy, fallbacks=fallbacks[1:], agent_id=agent_id,
+        )
+    finish_llm_trace(trace, usage, budget)
+    if cache is not None and result and not usage["truncated"]:
+        cache.put(cache_key, result)
+    return result
+
+def _chain_streams(streams: Iterator[Iterator[str]]) -> Iterator[str]:
+    for i, chunks in enumerate(streams):
+        if i:
+            yield "\n\n"
+        yield from chunks
+
+def _stream_llm(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    use_cache: bool,
+    budget: Dict[str, Any],
+    budget_policy: Optional[str],
+    fallbacks: List[Tuple[str, str]],
+    agent_id: Optional[str] = None,
+) -> Iterator[str]:
+    cache, cache_key, cached = lookup_cached_response(
+        provider, model, system_prompt, user_prompt, max_tokens, temperature, use_cache, agent_id
+    )
+    if cached is not None:
+        yield cached
+        return
+
+    admit_llm_call(provider, budget)
+    add_combat_log(f"呼叫 {provider} 模型（串流）：{model}", "spell")
+
+    api_key = get_provider_api_key(provider)
+    usage = new_token_usage()
+    trace = start_llm_trace(provider, model, agent_id, streamed=True)
+    parts: List[str] = []
+    try:
+        for chunk in scheduled_stream(
+            provider,
+            budget["input_tokens"] + budget["output_tokens"],
+            lambda: stream_provider(
+                provider=provider,
+                model=model,
+                system_prompt=system_prompt,
+                user_prompt=user_prompt,
+                api_key=api_key,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                agent_id=agent_id,
+                usage=usage,
+            ),
+            trace=trace,
+        ):
+            if trace["first_token_s"] is None:
+                trace["first_token_s"] = time.perf_counter() - trace["started"]
+            parts.append(chunk)
+            yield chunk
+    except Exception as e:
+        finish_llm_trace(trace, usage, budget, error=e)
+        if parts or not isinstance(e, ProviderUnavailableError) or not fallbacks:
+            raise
+        log_failover(provider, model, fallbacks, e)
+        fb_provider, fb_model = fallbacks[0]
+        yield from call_llm(
+            fb_provider, fb_model, system_prompt, user_prompt, max_tokens, temperature,
+            use_cache, stream=True, budget_policy=budget_policy, fallbacks=fallbacks[1:],
+            agent_id=agent_id,
+        )
+        return
+    finish_llm_trace(trace, usage, budget)
+    result = "".join(parts)
+    if cache is not None and result:
+        cache.put(cache_key, result)
+
+def resolve_agent_call(
+    agent_cfg: Dict[str, Any],
+    user_prompt: str,
+    override_provider: Optional[str] = None,
+    override_model: Optional[str] = None,
+    override_system_prompt: Optional[str] = None,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+) -> Dict[str, Any]:
+    """Build call_llm / acall_llm keyword arguments for a configured agent"""
+    return {
+        "provider": override_provider or agent_cfg.get("provider", "openai"),
+        "model": override_model or agent_cfg.get("default_model", "gpt-4o-mini"),
+        "system_prompt": override_system_prompt or agent_cfg.get("system_prompt", ""),
+        "user_prompt": user_prompt,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "use_cache": agent_allows_cache(agent_cfg, temperature),
+        "fallbacks": agent_fallbacks(agent_cfg),
+        "agent_id": agent_cfg.get("id"),
+    }
+
+def run_agent(
+    agent_cfg: Dict[str, Any],
+    user_prompt: str,
+    override_provider: Optional[str] = None,
+    override_model: Optional[str] = None,
+    override_system_prompt: Optional[str] = None,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    deferred: Optional["DeferredBatchSet"] = None,
+) -> Union[str, "DeferredResult"]:
+    """
+    Run a single configured agent. With deferred, the call is queued in that
+    batch set instead and a DeferredResult is returned (see DeferredBatchSet).
+    """
+    kwargs = resolve_agent_call(
+        agent_cfg,
+        user_prompt,
+        override_provider=override_provider,
+        override_model=override_model,
+        override_system_prompt=override_system_prompt,
+        max_tokens=max_tokens,
+        temperature=temperature,
+    )
+    if deferred is not None:
+        return deferred.add(**kwargs)
+    return call_llm(**kwargs)
+
+# -----------------------------------------------------------
+# Async LLM Calls (AsyncOpenAI, Gemini async, xAI AsyncClient, AsyncAnthropic)
+# -----------------------------------------------------------
+
+DEFAULT_LLM_DEADLINE_SECONDS = float(os.getenv("LLM_CALL_DEADLINE_SECONDS", "600"))
+
+class AsyncProviderClients:
+    """
+    Async SDK clients for one event loop. Async HTTP pools are bound to the
+    loop that created them, so each loop gets its own set, shared by every
+    call scheduled on that loop. run_async uses a fresh loop per call, so
+    these connections are reused only within one run_async call (one
+    pipeline run, OCR batch or call fan-out), never across reruns; the
+    synchronous ProviderClientRegistry clients are the long-lived pools.
+    Concurrency is limited process-wide by the quota governor's in-flight
+    slots, not per loop.
+    """
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, str], Any] = {}
+
+    def get(self, provider: str, api_key: str) -> Any:
+        key = (provider, api_key)
+        if key not in self._clients:
+            if provider == "openai":
+                self._clients[key] = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+            elif provider == "anthropic":
+                self._clients[key] = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0)
+            elif provider == "xai":
+                self._clients[key] = xai_sdk.AsyncClient(api_key=api_key, timeout=3600)
+            else:
+                raise ValueError(f"Unsupported provider: {provider}")
+        return self._clients[key]
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            close = getattr(client, "close", None)
+            if not callable(close):
+                continue
+            try:
+                result = close()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                pass
+
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncProviderClients]" = (
+    weakref.WeakKeyDictionary()
+)
+
+def get_async_clients() -> AsyncProviderClients:
+    """Async clients for the running event loop"""
+    loop = asyncio.get_running_loop()
+    clients = _ASYNC_CLIENTS.get(loop)
+    if clients is None:
+        clients = AsyncProviderClients()
+        _ASYNC_CLIENTS[loop] = clients
+    return clients
+
+async def ainvoke_provider(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    api_key: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    usage: Optional[Dict[str, int]] = None,
+    agent_id: Optional[str] = None,
+) -> str:
+    """Async counterpart of invoke_provider"""
+    clients = get_async_clients()
+
+    if provider == "openai":
+        client = clients.get("openai", api_key)
+        resp = await client.chat.completions.create(
+            **openai_chat_request(model, system_prompt, user_prompt, max_tokens, temperature),
+        )
+        read_provider_usage("openai", resp.usage, usage)
+        read_stop_reason("openai", resp, usage)
+        return resp.choices[0].message.content
+
+    elif provider == "gemini":
+        model_obj, prompt = gemini_model_and_prompt(
+            api_key, model, system_prompt, user_prompt, agent_id
+        )
+        resp = await model_obj.generate_content_async(
+            prompt,
+            generation_config=genai.types.GenerationConfig(
+                max_output_tokens=max_tokens,
+                temperature=temperature,
+            )
+        )
+        read_provider_usage("gemini", getattr(resp, "usage_metadata", None), usage)
+        read_stop_reason("gemini", resp, usage)
+        return resp.text
+
+    elif provider == "xai":
+        client = clients.get("xai", api_key)
+        chat = client.chat.create(model=model)
+        chat.append(xai_chat.system(system_prompt))
+        chat.append(xai_chat.user(user_prompt))
+        response = await chat.sample()
+        read_provider_usage("xai", getattr(response, "usage", None), usage)
+        read_stop_reason("xai", response, usage)
+        return getattr(response, "content", str(response))
+
+    elif provider == "anthropic":
+        client = clients.get("anthropic", api_key)
+        resp = await client.messages.create(
+            **anthropic_message_request(model, system_prompt, user_prompt, max_tokens, temperature)
+        )
+        read_provider_usage("anthropic", resp.usage, usage)
+        read_stop_reason("anthropic", resp, usage)
+        if resp.content and len(resp.content) > 0:
+            block = resp.content[0]
+            if hasattr(block, "text"):
+                return block.text
+        return json.dumps(resp.model_dump(), indent=2)
+
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+async def astream_provider(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    api_key: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    usage: Optional[Dict[str, int]] = None,
+    agent_id: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """Async counterpart of stream_provider"""
+    clients = get_async_clients()
+
+    if provider == "openai":
+        client = clients.get("openai", api_key)
+        stream = await client.chat.completions.create(
+            **openai_chat_request(model, system_prompt, user_prompt, max_tokens, temperature),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                read_provider_usage("openai", chunk.usage, usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    elif provider == "gemini":
+        model_obj, prompt = gemini_model_and_prompt(
+            api_key, model, system_prompt, user_prompt, agent_id
+        )
+        resp = await model_obj.generate_content_async(
+            prompt,
+            generation_config=genai.types.GenerationConfig(
+                max_output_tokens=max_tokens,
+                temperature=temperature,
+            ),
+            stream=True,
+        )
+        async for chunk in resp:
+            read_provider_usage("gemini", getattr(chunk, "usage_metadata", None), usage)
+            text = _gemini_chunk_text(chunk)
+            if text:
+                yield text
+
+    elif provider == "xai":
+        client = clients.get("xai", api_key)
+        chat = client.chat.create(model=model)
+        chat.append(xai_chat.system(system_prompt))
+        chat.append(xai_chat.user(user_prompt))
+        response = None
+        async for response, chunk in chat.stream():
+            if chunk.content:
+                yield chunk.content
+        read_provider_usage("xai", getattr(response, "usage", None), usage)
+
+    elif provider == "anthropic":
+        client = clients.get("anthropic", api_key)
+        async with client.messages.stream(
+            **anthropic_message_request(model, system_prompt, user_prompt, max_tokens, temperature)
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            read_provider_usage("anthropic", (await stream.get_final_message()).usage, usage)
+
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+async def acall_llm(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    use_cache: bool = True,
+    deadline: Optional[float] = None,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    budget_policy: Optional[str] = None,
+    fallbacks: Optional[List[Tuple[str, str]]] = None,
+    agent_id: Optional[str] = None,
+    usage: Optional[Dict[str, int]] = None,
+) -> str:
+    """
+    Coroutine version of call_llm with a per-call deadline in seconds, which
+    covers waiting for an in-flight slot of the quota governor, rate-limit
+    waits and retries (all counted as queue_s). Cancelling the awaiting
+    task cancels the HTTP request. When on_chunk is given the response is
+    streamed and each text chunk is passed to it as it arrives; the full text
+    is still returned. A usage dict (new_token_usage) is incremented with the
+    reported tokens of the calls made, and its truncated count with the
+    responses that stopped at max_tokens; responses served from the cache
+    add nothing.
+    """
+    provider = provider.lower().strip()
+    prompts, max_tokens, budget = apply_token_budget(
+        provider, model, system_prompt, user_prompt, max_tokens, budget_policy
+    )
+    if len(prompts) > 1:
+        piece_kwargs = dict(
+            provider=provider, model=model, system_prompt=system_prompt,
+            max_tokens=max_tokens, temperature=temperature, use_cache=use_cache,
+            deadline=deadline, budget_policy="abort", fallbacks=fallbacks, agent_id=agent_id,
+            usage=usage,
+        )
+        if not on_chunk:
+            parts = await asyncio.gather(*(acall_llm(user_prompt=p, **piece_kwargs) for p in prompts))
+            return "\n\n".join(parts)
+        parts = []
+        for i, p in enumerate(prompts):
+            if i:
+                on_chunk("\n\n")
+            parts.append(await acall_llm(user_prompt=p, on_chunk=on_chunk, **piece_kwargs))
+        return "\n\n".join(parts)
+    user_prompt = prompts[0]
+
+    cache, cache_key, cached = lookup_cached_response(
+        provider, model, system_prompt, user_prompt, max_tokens, temperature, use_cache, agent_id
+    )
+    if cached is not None:
+        if on_chunk:
+            on_chunk(cached)
+        return cached
+
+    api_key = get_provider_api_key(provider)
+    deadline = DEFAULT_LLM_DEADLINE_SECONDS if deadline is None else deadline
+    request = {
+        "provider": provider,
+        "model": model,
+        "system_prompt": system_prompt,
+        "user_prompt": user_prompt,
+        "api_key": api_key,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "usage": new_token_usage(),
+        "agent_id": agent_id,
+    }
+
+    scheduled_tokens = budget["input_tokens"] + budget["output_tokens"]
+    trace = start_llm_trace(provider, model, agent_id, streamed=bool(on_chunk))
+    try:
+        admit_llm_call(provider, budget)
+        add_combat_log(f"呼叫 {provider} 模型：{model}", "spell")
+
+        async def consume_stream() -> str:
+            parts: List[str] = []
+            async for chunk in ascheduled_stream(
+                provider, scheduled_tokens, lambda: astream_provider(**request), trace=trace
+            ):
+                if trace["first_token_s"] is None:
+                    trace["first_token_s"] = time.perf_counter() - trace["started"]
+                parts.append(chunk)
+                on_chunk(chunk)
+            return "".join(parts)
+
+        try:
+            result = await asyncio.wait_for(
+                consume_stream() if on_chunk else ascheduled_call(
+                    provider, scheduled_tokens, lambda: ainvoke_provider(**request), trace=trace
+                ),
+                timeout=deadline,
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"{provider} / {model} 呼叫超過 {deadline:.0f} 秒期限") from None
+    except BaseException as e:
+        finish_llm_trace(
+            trace, request["usage"], budget, error=e,
+            status="cancelled" if isinstance(e, asyncio.CancelledError) else None,
+        )
+        if (not isinstance(e, ProviderUnavailableError) or not fallbacks
+                or trace["first_token_s"] is not None):
+            raise
+        log_failover(provider, model, fallbacks, e)
+        fb_provider, fb_model = fallbacks[0]
+        return await acall_llm(
+            fb_provider, fb_model, system_prompt, user_prompt, max_tokens, temperature,
+            use_cache, deadline=deadline, on_chunk=on_chunk, budget_policy=budget_policy,
+            fallbacks=fallbacks[1:], agent_id=agent_id, usage=usage,
+        )
+    finish_llm_trace(trace, request["usage"], budget)
+    if usage is not None:
+        for field, value in request["usage"].items():
+            usage[field] = usage.get(field, 0) + value
+
+    if cache is not None and result and not request["usage"]["truncated"]:
+        cache.put(cache_key, result)
+    return result
+
+async def arun_agent(
+    agent_cfg: Dict[str, Any],
+    user_prompt: str,
+    override_provider: Optional[str] = None,
+    override_model: Optional[str] = None,
+    override_system_prompt: Optional[str] = None,
+    max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+    temperature: float = 0.7,
+    deadline: Optional[float] = None,
+    on_chunk: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Coroutine version of run_agent"""
+    return await acall_llm(
+        **resolve_agent_call(
+            agent_cfg,
+            user_prompt,
+            override_provider=override_provider,
+            override_model=override_model,
+            override_system_prompt=override_system_prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+        ),
+        deadline=deadline,
+        on_chunk=on_chunk,
+    )
+
+def make_stream_renderer(
+    placeholder: Any, min_interval: float = 0.1, allow_html: bool = False
+) -> Callable[[Optional[str]], str]:
+    """
+    Return an on_chunk callback that accumulates streamed text into a
+    Streamlit placeholder (throttled). Call it with None to flush the final text.
+    Model output is rendered as plain Markdown unless allow_html is set.
+    """
+    parts: List[str] = []
+    last_render = [0.0]
+
+    def render(chunk: Optional[str] = None) -> str:
+        if chunk:
+            parts.append(chunk)
+        text = "".join(parts)
+        now = time.perf_counter()
+        if chunk is None:
+            placeholder.markdown(text, unsafe_allow_html=allow_html)
+        elif now - last_render[0] >= min_interval:
+            placeholder.markdown(text + " ▌", unsafe_allow_html=allow_html)
+            last_render[0] = now
+        return text
+
+    return render
+
+def run_async(coro_factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run a coroutine to completion from synchronous Streamlit code on a fresh
+    event loop, closing that loop's async clients afterwards.
+
+    Async connection pooling therefore applies only within one run_async
+    call. The loop deliberately does not outlive the call: it runs on the
+    calling script thread, so on_chunk / progress callbacks can update
+    Streamlit elements, and a shared background loop would run them
+    without the session's script context.
+    """
+    async def runner():
+        try:
+            return await coro_factory()
+        finally:
+            await get_async_clients().aclose()
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(runner())
+    # Already inside an event loop (e.g. notebooks): run on a helper thread,
+    # carrying over context variables (usage tracker, quota reservation)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(contextvars.copy_context().run, asyncio.run, runner()).result()
+
+def run_llm_calls_concurrently(calls: List[Dict[str, Any]]) -> List[Any]:
+    """
+    Schedule many call_llm-style requests at once on one event loop.
+    Returns results in order; failed calls are returned as the exception.
+    """
+    async def gather_all():
+        return await asyncio.gather(
+            *(acall_llm(**kwargs) for kwargs in calls), return_exceptions=True
+        )
+
+    return run_async(gather_all)
+
+# -----------------------------------------------------------
+# Pipeline DAG Executor
+# -----------------------------------------------------------
+
+DEFAULT_PIPELINE_CONCURRENCY = 4
+
+class PipelineStepError(RuntimeError):
+    """A pipeline step failed; carries the outputs of the steps that finished"""
+
+    def __init__(self, step: Dict[str, Any], error: Exception, outputs: Dict[str, str]):
+        super().__init__(f"{step['id']}: {error}")
+        self.step = step
+        self.error = error
+        self.outputs = outputs
+
+def build_pipeline_raw_input(template: str, observations: str, instructions: str) -> str:
+    """The raw case input a pipeline starts from"""
+    return (
+        "【510(k) 案件輸入】\n"
+        f"{template}\n\n"
+        "【審查觀察與備註】\n"
+        f"{observations}\n\n"
+        "【額外指示】\n"
+        f"{instructions}"
+    )
+
+def resolve_pipeline_steps(pipeline: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Normalize pipeline steps from agents.yaml into DAG nodes.
+
+    Each step may declare:
+    - id: step id (defaults to agent_id; repeated agents get a #n suffix)
+    - input: raw | previous | <step_id>  (default: previous, or the combined
+      outputs of depends_on when that is given)
+    - depends_on: [step_id, ...]
+    Steps without either keep the original strictly sequential behaviour.
+    """
+    raw_steps = pipeline.get("steps") or []
+    steps: List[Dict[str, Any]] = []
+    seen: Dict[str, int] = {}
+    for index, raw in enumerate(raw_steps):
+        agent_id = raw["agent_id"]
+        step_id = raw.get("id")
+        if not step_id:
+            seen[agent_id] = seen.get(agent_id, 0) + 1
+            step_id = agent_id if seen[agent_id] == 1 else f"{agent_id}#{seen[agent_id]}"
+        depends_on = raw.get("depends_on") or []
+        if isinstance(depends_on, str):
+            depends_on = [depends_on]
+        steps.append({
+            "id": str(step_id),
+            "agent_id": agent_id,
+            "index": index,
+            "input": raw.get("input") or ("depends" if depends_on else "previous"),
+            "depends_on": [str(d) for d in depends_on],
+        })
+
+    ids = [s["id"] for s in steps]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"流程 {pipeline.get('id')} 含重複的步驟 id。")
+    for step in steps:
+        source = step["input"]
+        if source == "previous":
+            step["source"] = steps[step["index"] - 1]["id"] if step["index"] > 0 else None
+        elif source in ("raw", "depends"):
+            step["source"] = None
+        else:
+            step["source"] = str(source)
+        deps = list(step["depends_on"])
+        if step["source"] and step["source"] not in deps:
+            deps.append(step["source"])
+        for dep in deps:
+            if dep not in ids:
+                raise ValueError(f"步驟 {step['id']} 參照不存在的步驟：{dep}")
+            if dep == step["id"]:
+                raise ValueError(f"步驟 {step['id']} 不可依賴自身。")
+        step["depends_on"] = deps
+
+    pipeline_levels(steps)  # raises on cycles
+    return steps
+
+def pipeline_levels(steps: List[Dict[str, Any]]) -> List[List[str]]:
+    """Group step ids into dependency levels (Kahn's algorithm); raises on cycles"""
+    remaining = {s["id"]: set(s["depends_on"]) for s in steps}
+    levels: List[List[str]] = []
+    done: set = set()
+    while remaining:
+        ready = [sid for sid, deps in remaining.items() if deps <= done]
+        if not ready:
+            raise ValueError("流程步驟存在循環依賴：" + ", ".join(sorted(remaining)))
+        levels.append(ready)
+        done.update(ready)
+        for sid in ready:
+            del remaining[sid]
+    return levels
+
+def build_step_input(step: Dict[str, Any], raw_input: str, outputs: Dict[str, str]) -> str:
+    """Assemble the user prompt for a step from raw input or upstream outputs"""
+    if step["input"] == "raw":
+        return raw_input
+    if step["input"] == "depends":
+        parts = [
+            f"【步驟 {dep} 輸出】\n{outputs[dep]}" for dep in step["depends_on"]
+        ]
+        return "\n\n".join(parts) if parts else raw_input
+    if step["source"] is None:
+        return raw_input
+    return outputs[step["source"]]
+
+def estimate_pipeline_tokens(
+    steps: List[Dict[str, Any]],
+    raw_input: str,
+    call_for: Callable[[Dict[str, Any], str], Dict[str, Any]],
+) -> Dict[str, int]:
+    """
+    Upper bound on the tokens one pipeline run spends, per provider. Upstream
+    outputs do not exist yet, so a step fed by other steps is charged their
+    output budgets as input. call_for(step, step_input) returns call_llm
+    keyword arguments.
+    """
+    by_id = {s["id"]: s for s in steps}
+    output_budgets: Dict[str, int] = {}
+    totals: Dict[str, int] = {}
+    for level in pipeline_levels(steps):
+        for sid in level:
+            step = by_id[sid]
+            kwargs = call_for(step, raw_input)
+            provider = kwargs["provider"].lower().strip()
+            budget = prompt_budget(
+                provider, kwargs["model"], kwargs["system_prompt"], raw_input, kwargs["max_tokens"]
+            )
+            if step["input"] == "depends" and step["depends_on"]:
+                upstream = step["depends_on"]
+            elif step["input"] != "raw" and step["source"] is not None:
+                upstream = [step["source"]]
+            else:
+                upstream = []
+            input_tokens = budget["input_tokens"]
+            if upstream:
+                input_tokens = prompt_budget(
+                    provider, kwargs["model"], kwargs["system_prompt"], "", kwargs["max_tokens"]
+                )["input_tokens"] + sum(output_budgets[d] for d in upstream)
+            output_budgets[sid] = budget["output_tokens"]
+            totals[provider] = totals.get(provider, 0) + input_tokens + budget["output_tokens"]
+    return totals
+
+def reserve_pipeline_quota(
+    steps: List[Dict[str, Any]],
+    raw_input: str,
+    call_for: Callable[[Dict[str, Any], str], Dict[str, Any]],
+) -> QuotaReservation:
+    """
+    Reserve a pipeline run's estimated tokens before it starts; raises
+    QuotaExceededError when the remaining budget cannot cover them. Set the
+    result as quota_reservation for the run and release it afterwards with
+    release_quota_reservation.
+    """
+    return get_quota_governor().reserve(
+        quota_session(), estimate_pipeline_tokens(steps, raw_input, call_for)
+    )
+
+async def aexecute_pipeline_dag(
+    steps: List[Dict[str, Any]],
+    raw_input: str,
+    run_step: Callable[[Dict[str, Any], str], Awaitable[str]],
+    max_concurrency: int = DEFAULT_PIPELINE_CONCURRENCY,
+    on_update: Optional[Callable[[Dict[str, Any], str], None]] = None,
+) -> Dict[str, str]:
+    """
+    Run independent steps concurrently as asyncio tasks, starting each step as
+    soon as its dependencies finish, so wall-clock time follows the critical path.
+    At most max_concurrency steps run at once. on_update(step, "started" | "done")
+    is called on the event loop thread. Raises PipelineStepError on the first
+    failure after cancelling the steps still running.
+    """
+    by_id = {s["id"]: s for s in steps}
+    outputs: Dict[str, str] = {}
+    pending = {s["id"]: set(s["depends_on"]) for s in steps}
+    running: Dict[asyncio.Task, Dict[str, Any]] = {}
+    limit = asyncio.Semaphore(max(1, int(max_concurrency)))
+
+    async def run_limited(step: Dict[str, Any], step_input: str) -> str:
+        async with limit:
+            if on_update:
+                on_update(step, "started")
+            return await run_step(step, step_input)
+
+    try:
+        while pending or running:
+            ready = [sid for sid, deps in pending.items() if deps <= outputs.keys()]
+            for sid in sorted(ready, key=lambda x: by_id[x]["index"]):
+                step = by_id[sid]
+                del pending[sid]
+                task = asyncio.ensure_future(
+                    run_limited(step, build_step_input(step, raw_input, outputs))
+                )
+                running[task] = step
+            if not running:
+                break
+            finished, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(finished, key=lambda t: running[t]["index"]):
+                step = running.pop(task)
+                error = task.exception()
+                if error is not None:
+                    raise PipelineStepError(step, error, outputs)
+                outputs[step["id"]] = task.result()
+                if on_update:
+                    on_update(step, "done")
+    finally:
+        # Failure or outer cancellation: stop the steps still in flight
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+    return outputs
+
+def execute_pipeline_dag(
+    steps: List[Dict[str, Any]],
+    raw_input: str,
+    run_step: Callable[[Dict[str, Any], str], Awaitable[str]],
+    max_concurrency: int = DEFAULT_PIPELINE_CONCURRENCY,
+    on_update: Optional[Callable[[Dict[str, Any], str], None]] = None,
+) -> Dict[str, str]:
+    """Synchronous entry point for aexecute_pipeline_dag"""
+    return run_async(lambda: aexecute_pipeline_dag(
+        steps, raw_input, run_step, max_concurrency=max_concurrency, on_update=on_update
+    ))
+
+# -----------------------------------------------------------
+# Pipeline Checkpoints (per-step, resumable)
+# -----------------------------------------------------------
+
+class PipelineCheckpointStore:
+    """
+    SQLite store of completed pipeline step outputs keyed by pipeline id,
+    input hash and step index. Each row also records the step fingerprint
+    (agent settings + actual step input), so a checkpoint is only reused
+    while nothing that determines that step's output has changed.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pipeline_checkpoints ("
+            " pipeline_id TEXT NOT NULL,"
+            " input_hash TEXT NOT NULL,"
+            " step_index INTEGER NOT NULL,"
+            " step_id TEXT NOT NULL,"
+            " fingerprint TEXT NOT NULL,"
+            " output TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " PRIMARY KEY (pipeline_id, input_hash, step_index))"
+        )
+        self._conn.commit()
+
+    def get(self, pipeline_id: str, input_hash: str, step_index: int, fingerprint: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output FROM pipeline_checkpoints"
+                " WHERE pipeline_id = ? AND input_hash = ? AND step_index = ? AND fingerprint = ?",
+                (pipeline_id, input_hash, step_index, fingerprint),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(
+        self,
+        pipeline_id: str,
+        input_hash: str,
+        step_index: int,
+        step_id: str,
+        fingerprint: str,
+        output: str,
+    ):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pipeline_checkpoints"
+                " (pipeline_id, input_hash, step_index, step_id, fingerprint, output, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (pipeline_id, input_hash, step_index, step_id, fingerprint, output, time.time()),
+            )
+            self._conn.commit()
+
+    def count(self, pipeline_id: str, input_hash: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM pipeline_checkpoints WHERE pipeline_id = ? AND input_hash = ?",
+                (pipeline_id, input_hash),
+            ).fetchone()[0]
+
+    def clear(self, pipeline_id: Optional[str] = None, input_hash: Optional[str] = None):
+        with self._lock:
+            if pipeline_id is None:
+                self._conn.execute("DELETE FROM pipeline_checkpoints")
+            elif input_hash is None:
+                self._conn.execute(
+                    "DELETE FROM pipeline_checkpoints WHERE pipeline_id = ?", (pipeline_id,)
+                )
+            else:
+                self._conn.execute(
+                    "DELETE FROM pipeline_checkpoints WHERE pipeline_id = ? AND input_hash = ?",
+                    (pipeline_id, input_hash),
+                )
+            self._conn.commit()
+
+@st.cache_resource
+def get_pipeline_checkpoint_store() -> PipelineCheckpointStore:
+    """Shared pipeline checkpoint store (one connection per server process)"""
+    return PipelineCheckpointStore(os.path.join(APP_CACHE_DIR, "pipeline_checkpoints.sqlite"))
+
+def pipeline_input_hash(raw_input: str) -> str:
+    return hashlib.sha256(raw_input.encode("utf-8")).hexdigest()
+
+def step_fingerprint(call_kwargs: Dict[str, Any]) -> str:
+    """Hash of the resolved call (provider, model, prompts, generation settings)."""
+    payload = json.dumps(
+        [
+            call_kwargs["provider"],
+            call_kwargs["model"],
+            call_kwargs["system_prompt"],
+            call_kwargs["user_prompt"],
+            int(call_kwargs["max_tokens"]),
+            round(float(call_kwargs["temperature"]), 4),
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def with_checkpoints(
+    run_step: Callable[[Dict[str, Any], str], Awaitable[str]],
+    pipeline_id: str,
+    raw_input: str,
+    fingerprint: Callable[[Dict[str, Any], str], str],
+    reuse: bool = True,
+    on_reuse: Optional[Callable[[Dict[str, Any], str], None]] = None,
+) -> Callable[[Dict[str, Any], str], Awaitable[str]]:
+    """
+    Wrap a DAG run_step so every completed step is checkpointed immediately,
+    and (with reuse) steps whose fingerprint matches a checkpoint return the
+    saved output without calling the model. Because a step's fingerprint
+    includes its actual input, editing one agent re-runs that step and its
+    downstream steps while unchanged upstream steps are reused.
+    """
+    store = get_pipeline_checkpoint_store()
+    input_hash = pipeline_input_hash(raw_input)
+
+    async def run(step: Dict[str, Any], step_input: str) -> str:
+        fp = fingerprint(step, step_input)
+        if reuse:
+            saved = store.get(pipeline_id, input_hash, step["index"], fp)
+            if saved is not None:
+                if on_reuse:
+                    on_reuse(step, saved)
+                return saved
+        output = await run_step(step, step_input)
+        store.put(pipeline_id, input_hash, step["index"], step["id"], fp, output)
+        return output
+
+    return run
+
+# -----------------------------------------------------------
+# Provider Batch APIs (deferred agent runs)
+# -----------------------------------------------------------
+
+BATCH_PROVIDERS = ("openai", "anthropic")
+BATCH_POLL_SECONDS = float(os.getenv("LLM_BATCH_POLL_SECONDS", "30"))
+BATCH_TIMEOUT_SECONDS = float(os.getenv("LLM_BATCH_TIMEOUT_SECONDS", str(24 * 3600)))
+# Batch endpoints are billed at half the synchronous list price
+BATCH_PRICE_FACTOR = 0.5
+_OPENAI_BATCH_FINAL = {"completed", "failed", "expired", "cancelled"}
+
+class BatchRequestError(RuntimeError):
+    """A request inside a provider batch did not succeed."""
+
+class DeferredResult:
+    """Handle for a request queued in a provider batch; resolved when the batch ends."""
+
+    def __init__(self, custom_id: str, provider: str, model: str):
+        self.custom_id = custom_id
+        self.provider = provider
+        self.model = model
+        self.done = False
+        self.usage = new_token_usage()
+        self._value: Optional[str] = None
+        self._error: Optional[Exception] = None
+
+    def set_result(self, value: str):
+        self._value, self.done = value, True
+
+    def set_error(self, error: Exception):
+        self._error, self.done = error, True
+
+    def result(self) -> str:
+        if not self.done:
+            raise RuntimeError(f"批次請求 {self.custom_id} 尚未完成")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class DeferredBatch:
+    """
+    Requests for one provider collected into a single batch job. OpenAI
+    requests are uploaded as a JSONL input file for /v1/batches; Anthropic
+    requests go to /v1/messages/batches. submit() creates the job, poll()
+    reports whether it has ended, collect() resolves each DeferredResult by
+    custom_id.
+    """
+
+    def __init__(self, provider: str):
+        if provider not in BATCH_PROVIDERS:
+            raise ValueError(f"{provider} 不支援批次 API")
+        self.provider = provider
+        self.requests: Dict[str, Tuple[DeferredResult, Dict[str, Any]]] = {}
+        self.batch_id: Optional[str] = None
+        self.status = "pending"
+        self._client = None
+
+    def add(self, handle: DeferredResult, request: Dict[str, Any]):
+        self.requests[handle.custom_id] = (handle, request)
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = get_client_registry().get(
+                self.provider, get_provider_api_key(self.provider)
+            )
+        return self._client
+
+    def _control(self, fn: Callable[[], Any]) -> Any:
+        """Batch control-plane request, retried by the scheduler (clients have SDK retries off)"""
+        return scheduled_call(self.provider, 0, fn)
+
+    def submit(self) -> str:
+        client = self._get_client()
+        if self.provider == "openai":
+            lines = [
+                json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": openai_chat_request(**request),
+                }, ensure_ascii=False)
+                for custom_id, (_handle, request) in self.requests.items()
+            ]
+            input_file = self._control(lambda: client.files.create(
+                file=("requests.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch",
+            ))
+            batch = self._control(lambda: client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            ))
+        else:
+            params = [
+                {"custom_id": custom_id, "params": anthropic_message_request(**request)}
+                for custom_id, (_handle, request) in self.requests.items()
+            ]
+            batch = self._control(lambda: client.messages.batches.create(requests=params))
+        self.batch_id = batch.id
+        self.status = "submitted"
+        add_combat_log(
+            f"已送出 {self.provider} 批次 {self.batch_id}（{len(self.requests)} 筆請求）", "spell"
+        )
+        return self.batch_id
+
+    def poll(self) -> bool:
+        """Refresh the job status; True once the provider has finished it."""
+        client = self._get_client()
+        if self.provider == "openai":
+            batch = self._control(lambda: client.batches.retrieve(self.batch_id))
+            self.status = batch.status
+            self._batch = batch
+            return batch.status in _OPENAI_BATCH_FINAL
+        batch = self._control(lambda: client.messages.batches.retrieve(self.batch_id))
+        self.status = batch.processing_status
+        return batch.processing_status == "ended"
+
+    def collect(self):
+        """Resolve every handle from the batch results (errors per request)."""
+        client = self._get_client()
+        if self.provider == "openai":
+            for file_id in (self._batch.output_file_id, self._batch.error_file_id):
+                if not file_id:
+                    continue
+                content = self._control(lambda: client.files.content(file_id).text)
+                for line in content.splitlines():
+                    if line.strip():
+                        self._resolve_openai(json.loads(line))
+        else:
+            for entry in self._control(lambda: list(client.messages.batches.results(self.batch_id))):
+                self._resolve_anthropic(entry)
+        for handle, _request in self.requests.values():
+            if not handle.done:
+                handle.set_error(BatchRequestError(
+                    f"{self.provider} 批次 {self.batch_id} 結束（{self.status}）但無此請求結果"
+                ))
+
+    def _resolve_openai(self, line: Dict[str, Any]):
+        entry = self.requests.get(line.get("custom_id"))
+        if not entry:
+            return
+        handle = entry[0]
+        response = line.get("response") or {}
+        if line.get("error") or response.get("status_code") != 200:
+            detail = line.get("error") or (response.get("body") or {}).get("error") or response
+            handle.set_error(BatchRequestError(f"{handle.custom_id}: {detail}"))
+            return
+        read_provider_usage("openai", response["body"].get("usage"), handle.usage)
+        handle.set_result(response["body"]["choices"][0]["message"]["content"] or "")
+
+    def _resolve_anthropic(self, entry: Any):
+        item = self.requests.get(entry.custom_id)
+        if not item:
+            return
+        handle = item[0]
+        result = entry.result
+        if result.type != "succeeded":
+            detail = getattr(getattr(result, "error", None), "error", None) or result.type
+            handle.set_error(BatchRequestError(f"{handle.custom_id}: {detail}"))
+            return
+        read_provider_usage("anthropic", getattr(result.message, "usage", None), handle.usage)
+        handle.set_result("".join(
+            block.text for block in result.message.content if getattr(block, "text", None)
+        ))
+
+class _PendingCall(NamedTuple):
+    """Bookkeeping for a queued deferred call until its batch is collected"""
+    cache: Optional[LLMResponseCache]
+    cache_key: Optional[str]
+    budget: Dict[str, Any]
+    trace: Dict[str, Any]
+    reservation: Optional[QuotaReservation]
+
+class DeferredBatchSet:
+    """
+    Collects deferred agent calls, one provider batch per provider. Cached
+    responses resolve immediately; providers without a batch API (Gemini,
+    xAI) are called synchronously when the set runs.
+    """
+
+    def __init__(self):
+        self.batches: Dict[str, DeferredBatch] = {}
+        self.direct: List[Tuple[DeferredResult, Dict[str, Any]]] = []
+        self._pending: Dict[str, _PendingCall] = {}
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return sum(len(b.requests) for b in self.batches.values()) + len(self.direct)
+
+    def add(
+        self,
+        provider: str,
+        model: str,
+        system_prompt: str,
+        user_prompt: str,
+        max_tokens: int = DEFAULT_MAX_TOKENS["agent"],
+        temperature: float = 0.7,
+        use_cache: bool = True,
+        budget_policy: Optional[str] = None,
+        agent_id: Optional[str] = None,
+        **_ignored: Any,
+    ) -> DeferredResult:
+        """
+        Queue one call (call_llm keyword arguments; fallbacks are not used in
+        batch mode) and return its handle. Usage is charged to the
+        quota_reservation active at the time of the call to add(), which
+        also runs quota admission (QuotaExceededError); the
+        call's telemetry record spans from queueing to batch collection.
+        """
+        provider = provider.lower().strip()
+        self._seq += 1
+        handle = DeferredResult(f"req-{self._seq:06d}", provider, model)
+
+        # One request per handle: the chunk policy cannot split a batch entry
+        policy = current_budget_policy(budget_policy)
+        if policy == "chunk":
+            policy = "truncate"
+        prompts, max_tokens, budget = apply_token_budget(
+            provider, model, system_prompt, user_prompt, max_tokens, policy
+        )
+        request = {
+            "model": model,
+            "system_prompt": system_prompt,
+            "user_prompt": prompts[0],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+        cache, cache_key, cached = lookup_cached_response(
+            provider, model, system_prompt, prompts[0], max_tokens, temperature, use_cache, agent_id
+        )
+        if cached is not None:
+            handle.set_result(cached)
+            return handle
+        admit_llm_call(provider, budget)
+        trace = start_llm_trace(provider, model, agent_id, streamed=False)
+        self._pending[handle.custom_id] = _PendingCall(
+            cache, cache_key, budget, trace, quota_reservation.get()
+        )
+
+        if provider in BATCH_PROVIDERS:
+            self.batches.setdefault(provider, DeferredBatch(provider)).add(handle, request)
+        else:
+            self.direct.append((handle, dict(request, provider=provider, agent_id=agent_id)))
+        return handle
+
+    def discard(self, handle: DeferredResult, reason: Exception):
+        """
+        Withdraw a queued call before run(): it is not submitted or billed,
+        and its telemetry record is closed as cancelled.
+        """
+        pending = self._pending.pop(handle.custom_id, None)
+        if pending is None:
+            return
+        batch = self.batches.get(handle.provider)
+        if batch is not None:
+            batch.requests.pop(handle.custom_id, None)
+            if not batch.requests:
+                del self.batches[handle.provider]
+        self.direct = [(h, r) for h, r in self.direct if h is not handle]
+        quota_token = quota_reservation.set(pending.reservation)
+        try:
+            finish_llm_trace(pending.trace, budget=pending.budget, error=reason, status="cancelled")
+        finally:
+            quota_reservation.reset(quota_token)
+        handle.set_error(reason)
+
+    def run(
+        self,
+        poll_interval: float = BATCH_POLL_SECONDS,
+        timeout: float = BATCH_TIMEOUT_SECONDS,
+        on_poll: Optional[Callable[[Dict[str, str]], None]] = None,
+    ):
+        """Submit every provider batch, run direct calls, then poll until all have ended."""
+        for batch in self.batches.values():
+            batch.submit()
+        for handle, request in self.direct:
+            quota_token = quota_reservation.set(self._pending[handle.custom_id].reservation)
+            try:
+                handle.set_result(call_llm(**request, use_cache=False))
+            except Exception as e:
+                handle.set_error(e)
+            finally:
+                quota_reservation.reset(quota_token)
+
+        deadline = time.monotonic() + timeout
+        waiting = list(self.batches.values())
+        while waiting:
+            waiting = [b for b in waiting if not b.poll()]
+            if on_poll:
+                on_poll({b.provider: b.status for b in self.batches.values()})
+            if not waiting:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    "批次逾時未完成：" + "、".join(f"{b.provider} {b.batch_id}" for b in waiting)
+                )
+            time.sleep(poll_interval)
+
+        for batch in self.batches.values():
+            batch.collect()
+            for handle, _request in batch.requests.values():
+                cache, cache_key, budget, trace, reservation = self._pending[handle.custom_id]
+                quota_token = quota_reservation.set(reservation)
+                try:
+                    finish_llm_trace(
+                        trace, handle.usage, budget, error=handle._error,
+                        price_factor=BATCH_PRICE_FACTOR, batch=True,
+                    )
+                finally:
+                    quota_reservation.reset(quota_token)
+                if handle._error is not None:
+                    continue
+                if cache is not None and handle.result():
+                    cache.put(cache_key, handle.result())
+
+def execute_pipelines_deferred(
+    steps: List[Dict[str, Any]],
+    jobs: Dict[str, str],
+    call_for: Callable[[str, Dict[str, Any], str], Dict[str, Any]],
+    pipeline_id: Optional[str] = None,
+    reuse_checkpoints: bool = True,
+    poll_interval: float = BATCH_POLL_SECONDS,
+    timeout: float = BATCH_TIMEOUT_SECONDS,
+    on_wave: Optional[Callable[[int, int, DeferredBatchSet], None]] = None,
+    on_poll: Optional[Callable[[Dict[str, str]], None]] = None,
+    reservations: Optional[Dict[str, QuotaReservation]] = None,
+    on_reuse: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+) -> Dict[str, Union[Dict[str, str], PipelineStepError]]:
+    """
+    Run one pipeline for many jobs ({job_id: raw_input}) through provider batch
+    APIs, one wave per dependency level: every job's steps of a level go into
+    the same batch set, and the next level is submitted once its inputs exist.
+    call_for(job_id, step, step_input) returns call_llm keyword arguments.
+    With pipeline_id, finished steps are checkpointed (and reused) exactly as
+    in interactive runs. reservations maps job ids to their quota
+    reservations, which each job's calls draw on and are charged to. Returns {job_id: outputs or PipelineStepError}.
+    """
+    by_id = {s["id"]: s for s in steps}
+    levels = pipeline_levels(steps)
+    outputs: Dict[str, Dict[str, str]] = {job_id: {} for job_id in jobs}
+    failed: Dict[str, PipelineStepError] = {}
+    store = get_pipeline_checkpoint_store() if pipeline_id else None
+
+    for wave, level in enumerate(levels, start=1):
+        batch_set = DeferredBatchSet()
+        queued: List[Tuple[str, Dict[str, Any], str, DeferredResult]] = []
+        for job_id, raw_input in jobs.items():
+            if job_id in failed:
+                continue
+            for sid in level:
+                step = by_id[sid]
+                kwargs = call_for(job_id, step, build_step_input(step, raw_input, outputs[job_id]))
+                fp = step_fingerprint(kwargs)
+                if store is not None and reuse_checkpoints:
+                    saved = store.get(pipeline_id, pipeline_input_hash(raw_input), step["index"], fp)
+                    if saved is not None:
+                        outputs[job_id][sid] = saved
+                        if on_reuse:
+                            on_reuse(job_id, step)
+                        continue
+                token = quota_reservation.set((reservations or {}).get(job_id))
+                try:
+                    queued.append((job_id, step, fp, batch_set.add(**kwargs)))
+                except Exception as e:
+                    failed[job_id] = PipelineStepError(step, e, dict(outputs[job_id]))
+                    # The job cannot finish: withdraw its other steps of this level
+                    for queued_job, _step, _fp, handle in queued:
+                        if queued_job == job_id:
+                            batch_set.discard(handle, e)
+                    queued = [q for q in queued if q[0] != job_id]
+                    break
+                finally:
+                    quota_reservation.reset(token)
+        if on_wave:
+            on_wave(wave, len(levels), batch_set)
+        if len(batch_set):
+            batch_set.run(poll_interval, timeout, on_poll)
+
+        for job_id, step, fp, handle in sorted(queued, key=lambda q: q[1]["index"]):
+            if job_id in failed:
+                continue
+            try:
+                output = handle.result()
+            except Exception as e:
+                failed[job_id] = PipelineStepError(step, e, dict(outputs[job_id]))
+                continue
+            outputs[job_id][step["id"]] = output
+            if store is not None:
+                store.put(
+                    pipeline_id, pipeline_input_hash(jobs[job_id]), step["index"], step["id"], fp, output
+                )
+
+    return {job_id: failed.get(job_id, outputs[job_id]) for job_id in jobs}
+
+# -----------------------------------------------------------
+# Status Indicators
+# -----------------------------------------------------------
+
+def render_status_indicators():
+    """Render review status indicators (WOW gauges)"""
+    col1, col2, col3, col4 = st.columns(4)
+
+    with col1:
+        st.markdown(f"**{get_translation('level')}**")
+        st.metric(label="", value=st.session_state.player_level)
+
+    with col2:
+        st.markdown(f"**{get_translation('health')}**")
+        st.progress(st.session_state.health / 100)
+        st.caption(f"{st.session_state.health}/100")
+
+    with col3:
+        # Tightest remaining token budget over providers, session and daily
+        st.markdown(f"**{get_translation('mana')}**")
+        tightest = (1.0, "", 0, 0)
+        for row in get_quota_governor().snapshot(quota_session()):
+            for scope, used, total in (
+                ("本工作階段", row["session_tokens"] + row["reserved"], row["session_budget"]),
+                ("本日", row["daily_tokens"], row["daily_budget"]),
+            ):
+                if total and 1 - used / total < tightest[0]:
+                    tightest = (max(1 - used / total, 0.0), f"{row['provider']} {scope}", used, total)
+        st.progress(tightest[0])
+        if tightest[1]:
+            st.caption(f"{tightest[1]}：剩餘 {max(tightest[3] - tightest[2], 0):,} / {tightest[3]:,} tokens")
+        else:
+            st.caption("無 token 預算上限")
+
+    with col4:
+        st.markdown(f"**{get_translation('experience')}**")
+        max_xp = st.session_state.player_level * 50
+        st.progress(st.session_state.experience / max_xp)
+        st.caption(f"{st.session_state.experience}/{max_xp}")
+
+def render_activity_log():
+    """Render review activity log"""
+    st.markdown("### 📑 活動紀錄")
+    with st.expander("檢視近期動作", expanded=False):
+        entries = get_activity_log().entries(limit=40)
+        if entries:
+            render_log_block(entries, height=320)
+        else:
+            st.info("目前尚無活動紀錄")
+
+# -----------------------------------------------------------
+# Review Context Selector
+# -----------------------------------------------------------
+
+def render_review_context_selector():
+    """Render interactive review context selector"""
+    st.markdown("### 🏥 審查情境選擇器")
+
+    cols = st.columns(5)
+    styles = list(REVIEW_CONTEXT_STYLES.keys())
+
+    for idx, style in enumerate(styles):
+        with cols[idx % 5]:
+            style_data = REVIEW_CONTEXT_STYLES[style]
+            button_label = f"{style_data['icon']} {style}"
+            if st.button(
+                button_label,
+                key=f"style_{style}",
+                help=style_data["description"],
+                use_container_width=True
+            ):
+                st.session_state.art_style = style
+                add_combat_log(f"切換審查情境為：{style}", "success")
+                st.rerun()
+
+    current_style = st.session_state.get("art_style", "General 510(k)")
+    style_data = REVIEW_CONTEXT_STYLES[current_style]
+    st.markdown(
+        f"<div class='review-card' style='text-align: center; "
+        f"background: linear-gradient(135deg, {style_data['color']}33, transparent);'>"
+        f"<h3>{style_data['icon']} 目前情境：{current_style}</h3>"
+        f"<p>{style_data['description']}</p>"
+        f"</div>",
+        unsafe_allow_html=True
+    )
+
+# -----------------------------------------------------------
+# Enhanced Sidebar (incl. Magic Flower Wheel)
+# -----------------------------------------------------------
+
+def render_enhanced_sidebar(registry: AgentRegistry):
+    """Render Nordic-themed sidebar with controls"""
+    st.sidebar.markdown(f"# {get_translation('title')}")
+    st.sidebar.markdown(f"*{get_translation('subtitle')}*")
+    st.sidebar.markdown("---")
+
+    # Theme and Language Selection
+    col1, col2 = st.sidebar.columns(2)
+    with col1:
+        theme = st.selectbox(
+            get_translation("theme"),
+            ["light", "dark"],
+            index=1 if st.session_state.theme == "dark" else 0,
+            key="theme_selector"
+        )
+        if theme != st.session_state.theme:
+            st.session_state.theme = theme
+            st.rerun()
+
+    with col2:
+        lang = st.selectbox(
+            get_translation("language"),
+            ["zh", "en"],
+            index=0 if st.session_state.language == "zh" else 1,
+            key="lang_selector"
+        )
+        if lang != st.session_state.language:
+            st.session_state.language = lang
+            st.rerun()
+
+    # Magic Flower Wheel
+    st.sidebar.markdown("### 🌸 Magic Flower Wheel")
+    flower_names = list(FLOWER_STYLES.keys())
+    flower_labels = [
+        f"{FLOWER_STYLES[name]['icon']} {name}" for name in flower_names
+    ]
+    current_index = flower_names.index(st.session_state.get("flower_style", "Edelweiss"))
     idx = st.sidebar.select_slider(
         "選擇 UI 花卉風格",
         options=list(range(len(flower_names))),
@@ -688,6 +4313,21 @@ def render_enhanced_sidebar(config: Dict[str, Any]):
             "Anthropic", "ANTHROPIC_API_KEY", "anthropic_api_key", "Anthropic API Key"
         )
 
+        pooled = get_client_registry().stats()
+        if pooled:
+            st.caption(
+                "🔌 已建立的模型連線："
+                + "、".join(f"{p} × {n}" for p, n in sorted(pooled.items()))
+            )
+            if st.button("🔌 重建本工作階段的模型連線", key="close_provider_clients"):
+                # Only this session's keys, and without closing clients that
+                # other sessions may be using (see ProviderClientRegistry.retire)
+                registry = get_client_registry()
+                for provider_id, (session_key, env_var, _label) in PROVIDER_API_KEY_SOURCES.items():
+                    registry.retire(provider_id, st.session_state.get(session_key) or os.getenv(env_var))
+                add_combat_log("已重建本工作階段的模型供應商連線。", "info")
+                st.rerun()
+
     st.sidebar.markdown("---")
 
     # Model Settings
@@ -714,7 +4354,7 @@ def render_enhanced_sidebar(config: Dict[str, Any]):
 
     st.sidebar.slider(
         "最大輸出 Token 數",
-        64, 4096, 1024, 64,
+        64, 4096, DEFAULT_MAX_TOKENS["chat"], 64,
         key="default_max_tokens",
     )
 
@@ -724,16 +4364,61 @@ def render_enhanced_sidebar(config: Dict[str, Any]):
         key="default_temperature",
     )
 
+    st.sidebar.selectbox(
+        "輸入超過模型上下文時",
+        list(TOKEN_BUDGET_POLICIES),
+        format_func=TOKEN_BUDGET_POLICIES.get,
+        key="token_budget_policy",
+    )
+    session_usage = get_quota_governor().session_usage(quota_session())
+    st.sidebar.caption(f"💲 本工作階段花費：${session_usage['cost']:.4f}")
+    tripped = {
+        p: state for p, state in get_provider_scheduler().breaker_states().items() if state != "closed"
+    }
+    if tripped:
+        st.sidebar.warning(
+            "⛔ 暫停呼叫中的供應商："
+            + "、".join(f"{p}（{'冷卻中' if state == 'open' else '試探中'}）" for p, state in tripped.items())
+        )
+
+    st.sidebar.checkbox(
+        "使用回應快取（相同輸入不重複呼叫模型）",
+        key="llm_cache_enabled",
+    )
+    cache_stats = get_llm_response_cache().stats()
+    st.sidebar.caption(
+        f"🗃️ 快取：{cache_stats['entries']} 筆 / {cache_stats['bytes'] / 1024:.0f} KB；"
+        f"本工作階段命中 {st.session_state.llm_cache_hits}、未命中 {st.session_state.llm_cache_misses}"
+    )
+    st.sidebar.checkbox(
+        "使用供應商提示快取（重複的系統提示與文件只計一次完整費用）",
+        key="prompt_cache_enabled",
+    )
+    st.sidebar.caption(f"♻️ 本工作階段提示快取命中 {session_usage['cached_tokens']:,} 輸入 tokens")
+    if st.sidebar.button("🗑️ 清除回應快取"):
+        get_llm_response_cache().clear()
+        add_combat_log("已清除 LLM 回應快取。", "info")
+        st.rerun()
+
     st.sidebar.markdown("---")
 
     # Case Log
     st.sidebar.markdown(f"### 📁 {get_translation('quest_log')}")
     st.sidebar.metric("已完成案件數", st.session_state.quests_completed)
 
-    if st.sidebar.button("🔄 恢復資源"):
-        update_player_stats("regenerate")
-        add_combat_log("AI 資源與合規健康度已適度恢復", "success")
-        st.rerun()
+    # Token budgets and in-flight requests (QuotaGovernor)
+    def fmt(used: int, total: int) -> str:
+        return f"{used:,} / {total:,}" if total else f"{used:,}（無上限）"
+
+    with st.sidebar.expander("📏 AI 資源配額", expanded=False):
+        for row in get_quota_governor().snapshot(quota_session()):
+            st.markdown(
+                f"**{row['provider']}**　進行中 {row['in_flight']}/{row['max_in_flight']}  \n"
+                f"本工作階段 {fmt(row['session_tokens'], row['session_budget'])} tokens"
+                + (f"（預留 {row['reserved']:,}）" if row["reserved"] else "")
+                + f"  \n本日 {fmt(row['daily_tokens'], row['daily_budget'])} tokens"
+            )
+        st.caption("預算可用環境變數調整，例如 OPENAI_SESSION_TOKENS、OPENAI_DAILY_TOKENS、OPENAI_MAX_IN_FLIGHT。")
 
 # -----------------------------------------------------------
 # Input Tab
@@ -778,27 +4463,38 @@ def render_input_tab():
 # Pipeline Tab
 # -----------------------------------------------------------
 
-def render_pipeline_tab(config: Dict[str, Any]):
+def render_pipeline_tab(registry: AgentRegistry):
     """Render multi-agent 510(k) review pipeline tab"""
     st.markdown(f"## 🔄 {get_translation('pipeline')}")
 
-    if not config or "pipelines" not in config:
+    if not registry.pipelines:
         st.warning("⚠️ agents.yaml 中未找到任何審查流程 (pipelines) 設定。")
         return
 
     col1, col2 = st.columns([2, 1])
 
     with col1:
-        pipeline_options = {p["name"]: p for p in config["pipelines"]}
-        selected_name = st.selectbox("🔎 選擇審查流程", list(pipeline_options.keys()))
-        pipeline = pipeline_options[selected_name]
+        selected_name = st.selectbox("🔎 選擇審查流程", list(registry.pipelines_by_name))
+        pipeline = registry.pipelines_by_name[selected_name]
 
         st.markdown(f"**流程 ID：** `{pipeline['id']}`")
         st.markdown(f"**說明：** {pipeline.get('description', '')}")
 
+        # Resolved and checked against the agents when the registry was compiled
+        steps = registry.pipeline_steps(pipeline["id"])
+
         st.markdown("### 📂 流程步驟")
-        for idx, step in enumerate(pipeline["steps"], start=1):
-            st.markdown(f"- 第 {idx} 步：`{step['agent_id']}`")
+        for idx, step in enumerate(steps, start=1):
+            if step["input"] == "raw":
+                source = "原始輸入"
+            elif step["depends_on"]:
+                source = "、".join(f"`{d}`" for d in step["depends_on"])
+            else:
+                source = "原始輸入"
+            st.markdown(f"- 第 {idx} 步：`{step['id']}` → 代理 `{step['agent_id']}`（輸入：{source}）")
+        levels = pipeline_levels(steps)
+        if len(levels) < len(steps):
+            st.caption(f"⚡ 可平行執行：{len(steps)} 個步驟分為 {len(levels)} 個階段。")
 
         st.markdown("---")
 
@@ -808,7 +4504,7 @@ def render_pipeline_tab(config: Dict[str, Any]):
             height=120,
         )
 
-        col_a, col_b = st.columns(2)
+        col_a, col_b, col_c = st.columns(3)
         with col_a:
             provider = st.selectbox(
                 "模型供應商覆寫（選填）",
@@ -816,55 +4512,150 @@ def render_pipeline_tab(config: Dict[str, Any]):
             )
         with col_b:
             model_override = st.text_input("模型名稱覆寫（選填）", "")
+        with col_c:
+            max_concurrency = st.number_input(
+                "平行執行上限",
+                min_value=1,
+                max_value=16,
+                value=int(pipeline.get("max_concurrency", DEFAULT_PIPELINE_CONCURRENCY)),
+                step=1,
+            )
 
-        if st.button(f"▶️ {get_translation('run')}", use_container_width=True):
-            if st.session_state.mana < 20:
-                st.error("❌ AI 資源不足，請先按左側『恢復資源』。")
-                return
+        raw_input = build_pipeline_raw_input(
+            st.session_state.get("template", ""),
+            st.session_state.get("observations", ""),
+            override_prompt,
+        )
+        checkpoint_store = get_pipeline_checkpoint_store()
+        input_hash = pipeline_input_hash(raw_input)
+        saved_steps = checkpoint_store.count(pipeline["id"], input_hash)
+
+        reuse_checkpoints = st.checkbox(
+            "重用已完成步驟的檢查點（設定與輸入未變更的步驟不重新呼叫模型）",
+            value=True,
+            key="pipeline_reuse_checkpoints",
+        )
+        if saved_steps:
+            col_s1, col_s2 = st.columns([3, 1])
+            with col_s1:
+                st.caption(f"💾 此流程與輸入已保存 {saved_steps} 個步驟檢查點。")
+            with col_s2:
+                if st.button("🗑️ 清除檢查點", key="pipeline_clear_checkpoints"):
+                    checkpoint_store.clear(pipeline["id"], input_hash)
+                    add_combat_log(f"已清除流程 {pipeline['id']} 的檢查點。", "info")
+                    st.rerun()
+
+        resume_state = st.session_state.get("pipeline_resume") or {}
+        can_resume = (
+            resume_state.get("pipeline_id") == pipeline["id"]
+            and resume_state.get("input_hash") == input_hash
+        )
+        run_clicked = st.button(f"▶️ {get_translation('run')}", use_container_width=True)
+        resume_clicked = can_resume and st.button(
+            f"⏯️ 從中斷步驟 `{resume_state['step_id']}` 繼續",
+            use_container_width=True,
+            key="pipeline_resume_run",
+        )
 
-            template = st.session_state.get("template", "")
-            observations = st.session_state.get("observations", "")
-            current_input = (
-                "【510(k) 案件輸入】\n"
-                f"{template}\n\n"
-                "【審查觀察與備註】\n"
-                f"{observations}\n\n"
-                "【額外指示】\n"
-                f"{override_prompt}"
-            )
+        if run_clicked or resume_clicked:
+            agents_by_id = registry.agents
+            max_tokens = st.session_state.get("default_max_tokens", DEFAULT_MAX_TOKENS["chat"])
+            temperature = st.session_state.get("default_temperature", 0.7)
+
+            def step_call(step: Dict[str, Any], step_input: str) -> Dict[str, Any]:
+                return resolve_agent_call(
+                    agents_by_id[step["agent_id"]],
+                    step_input,
+                    override_provider=None if provider.startswith("(") else provider,
+                    override_model=model_override or None,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                )
+
+            # Admission control: reserve the run's estimated tokens up front
+            try:
+                reservation = reserve_pipeline_quota(steps, raw_input, step_call)
+            except QuotaExceededError as e:
+                st.error(f"❌ {e}")
+                add_combat_log(f"審查流程未啟動：{e}", "warning")
+                return
 
-            outputs = []
             progress_bar = st.progress(0)
             status_text = st.empty()
+            active: Dict[str, str] = {}
+            completed: List[str] = []
 
-            for idx, step in enumerate(pipeline["steps"]):
-                agent_id = step["agent_id"]
-                agent_cfg = next((a for a in config["agents"] if a["id"] == agent_id), None)
+            # Step outputs stream into their expanders while the pipeline runs
+            st.markdown("### 📘 流程輸出結果")
+            renderers: Dict[str, Callable[[Optional[str]], str]] = {}
+            for idx, step in enumerate(steps, start=1):
+                with st.expander(f"步驟 {idx} – 代理 `{step['agent_id']}`", expanded=True):
+                    renderers[step["id"]] = make_stream_renderer(st.empty())
+
+            async def call_step(step: Dict[str, Any], step_input: str) -> str:
+                return await acall_llm(
+                    **step_call(step, step_input), on_chunk=renderers[step["id"]]
+                )
 
-                if not agent_cfg:
-                    st.error(f"❌ 找不到代理設定：{agent_id}")
-                    return
+            reused: List[str] = []
 
-                progress = (idx + 1) / len(pipeline["steps"])
-                progress_bar.progress(progress)
-                status_text.text(f"執行代理：{agent_cfg['name']} ...")
+            def on_reuse(step: Dict[str, Any], output: str):
+                renderers[step["id"]](output)
+                reused.append(step["id"])
 
-                try:
-                    result = run_agent(
-                        agent_cfg=agent_cfg,
-                        user_prompt=current_input,
-                        override_provider=None if provider.startswith("(") else provider,
-                        override_model=model_override or None,
-                        max_tokens=st.session_state.get("default_max_tokens", 1024),
-                        temperature=st.session_state.get("default_temperature", 0.7),
-                    )
-                    outputs.append({"agent_id": agent_id, "output": result})
-                    current_input = result
+            run_step = with_checkpoints(
+                call_step,
+                pipeline["id"],
+                raw_input,
+                lambda step, step_input: step_fingerprint(step_call(step, step_input)),
+                reuse=reuse_checkpoints or resume_clicked,
+                on_reuse=on_reuse,
+            )
+
+            def on_update(step: Dict[str, Any], event: str):
+                if event == "started":
+                    active[step["id"]] = agents_by_id[step["agent_id"]]["name"]
+                else:
+                    renderers[step["id"]](None)
+                    active.pop(step["id"], None)
+                    completed.append(step["id"])
                     update_player_stats("regenerate")
-                except Exception as e:
-                    st.error(f"❌ 模型呼叫失敗：{e}")
-                    add_combat_log(f"審查流程在代理 {agent_id} 中斷。", "error")
-                    return
+                    progress_bar.progress(len(completed) / len(steps))
+                if active:
+                    status_text.text("執行代理：" + "、".join(active.values()) + " ...")
+
+            quota_token = quota_reservation.set(reservation)
+            try:
+                results = execute_pipeline_dag(
+                    steps,
+                    raw_input,
+                    run_step,
+                    max_concurrency=int(max_concurrency),
+                    on_update=on_update,
+                )
+            except PipelineStepError as e:
+                st.error(f"❌ 模型呼叫失敗：{e.error}")
+                add_combat_log(f"審查流程在代理 {e.step['agent_id']} 中斷。", "error")
+                st.session_state.pipeline_resume = {
+                    "pipeline_id": pipeline["id"],
+                    "input_hash": input_hash,
+                    "step_id": e.step["id"],
+                }
+                st.info(
+                    f"💾 已保存 {len(e.outputs)} 個已完成步驟，可按「從中斷步驟繼續」從 `{e.step['id']}` 接續執行。"
+                )
+                return
+            finally:
+                quota_reservation.reset(quota_token)
+                release_quota_reservation(reservation)
+            st.session_state.pipeline_resume = None
+            if reused:
+                add_combat_log(f"審查流程重用了 {len(reused)} 個步驟檢查點。", "info")
+
+            outputs = [
+                {"step_id": step["id"], "agent_id": step["agent_id"], "output": results[step["id"]]}
+                for step in steps
+            ]
 
             progress_bar.progress(1.0)
             status_text.text("✅ 審查流程完成。")
@@ -875,11 +4666,6 @@ def render_pipeline_tab(config: Dict[str, Any]):
 
             st.session_state.pipeline_history.append(outputs)
 
-            st.markdown("### 📘 流程輸出結果")
-            for idx, item in enumerate(outputs, start=1):
-                with st.expander(f"步驟 {idx} – 代理 `{item['agent_id']}`", expanded=(idx == len(outputs))):
-                    st.markdown(item["output"])
-
     with col2:
         render_activity_log()
         st.markdown("### 📊 流程統計")
@@ -898,21 +4684,132 @@ def render_smart_replace_tab():
 # AI Note Keeper: helpers
 # -----------------------------------------------------------
 
+_FULL_WIDTH_RE = re.compile("[\uff01-\uff5e\u3000]")
+# Only the markup highlight_keywords_in_text itself emits: a bare "<" / ">"
+# (p<0.05, x>3) is common in OCR'd clinical text and must stay matchable
+_HIGHLIGHT_TAG_RE = re.compile(r"</?span\b[^>]*>", re.IGNORECASE)
+
+def _fold_full_width(m: "re.Match[str]") -> str:
+    ch = m.group(0)
+    return " " if ch == "\u3000" else chr(ord(ch) - 0xFEE0)
+
+def fold_for_keyword_match(text: str) -> str:
+    """Lower-case and map full-width ASCII to half-width, keeping offsets 1:1."""
+    folded = text.lower()
+    # lower() can change length for a few code points (e.g. "İ"); keep offsets aligned
+    if len(folded) != len(text):
+        folded = "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+    return _FULL_WIDTH_RE.sub(_fold_full_width, folded)
+
+def _trie_regex(words: List[str]) -> str:
+    """
+    Regex equivalent to an alternation of words, factored into a prefix trie
+    (Aho-Corasick-style sharing) so the engine does not retry every keyword at
+    each position. Longer continuations are tried first: longest match wins.
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: Dict[str, Any]) -> str:
+        branches = [re.escape(ch) + emit(child) for ch, child in node.items() if ch]
+        branches.sort(key=len, reverse=True)
+        optional = "" in node
+        if not branches:
+            return ""
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")" + ("?" if optional else "")
+
+    return emit(trie)
+
+@functools.lru_cache(maxsize=64)
+def compile_keyword_pattern(keywords: Tuple[str, ...]) -> Optional["re.Pattern[str]"]:
+    """
+    One trie-factored pattern for the whole keyword set, matched against
+    folded text (lower-case, full-width ASCII mapped to half-width).
+    """
+    words = {fold_for_keyword_match(kw.strip()) for kw in keywords if kw.strip()}
+    if not words:
+        return None
+    return re.compile(_trie_regex(sorted(words)))
+
 def highlight_keywords_in_text(text: str, keywords: List[str], color: str) -> str:
     """Highlight given keywords in text using HTML span with specified color"""
     if not text or not keywords:
         return text
-    result = text
-    for kw in keywords:
-        kw = kw.strip()
-        if not kw:
-            continue
-        pattern = re.compile(re.escape(kw), re.IGNORECASE)
-        result = pattern.sub(
-            lambda m: f"<span style='color:{color}'>{m.group(0)}</span>",
-            result,
-        )
-    return result
+    pattern = compile_keyword_pattern(tuple(keywords))
+    if pattern is None:
+        return text
+    folded = fold_for_keyword_match(text)
+    if "<" in folded:
+        # Blank out existing highlight tags (same length) so keywords never match inside them
+        folded = _HIGHLIGHT_TAG_RE.sub(lambda m: "\0" * len(m.group(0)), folded)
+    open_tag = f"<span style='color:{color}'>"
+    parts: List[str] = []
+    pos = 0
+    for m in pattern.finditer(folded):
+        start, end = m.span()
+        parts.append(text[pos:start])
+        parts.append(open_tag)
+        parts.append(text[start:end])
+        parts.append("</span>")
+        pos = end
+    parts.append(text[pos:])
+    return "".join(parts)
+
+NOTE_ENTITIES_SYSTEM_PROMPT = (
+    "You are an information extraction specialist for FDA 510(k) dossiers.\n"
+    "From the provided text, identify up to 20 highest-value entities. Entities may be:\n"
+    "- regulations or standards\n"
+    "- submission sections (e.g., Indications for Use, Device Description)\n"
+    "- device modules or components\n"
+    "- risk types or hazards\n"
+    "- performance tests\n"
+    "- clinical endpoints or outcomes\n"
+    "Return **JSON only** in the form:\n"
+    "[\n"
+    "  {\"id\": 1, \"name\": \"...\", \"type\": \"regulation|section|risk|test|clinical|other\", "
+    "\"description\": \"short explanation\", \"source_snippet\": \"representative phrase from text\"},\n"
+    "  ... up to 20 entities\n"
+    "]"
+)
+
+NOTE_MINDMAP_SYSTEM_PROMPT = (
+    "You are a knowledge graph designer.\n"
+    "Create a compact **mind-map JSON** from the text:\n"
+    "{\n"
+    "  \"nodes\": [\n"
+    "    {\"id\": \"NodeID\", \"label\": \"display name\", \"type\": \"device|risk|test|regulation|clinical|other\"},\n"
+    "    ... 8–15 nodes\n"
+    "  ],\n"
+    "  \"edges\": [\n"
+    "    {\"source\": \"NodeID\", \"target\": \"NodeID\", \"relation\": \"short description\"},\n"
+    "    ... 10–25 edges\n"
+    "  ]\n"
+    "}\n"
+    "Output JSON only."
+)
+
+NOTE_WORDGRAPH_SYSTEM_PROMPT = (
+    "You are a text mining and terminology network expert.\n"
+    "From the text, select 10–15 key technical/regulatory/clinical terms and "
+    "build a wordgraph JSON:\n"
+    "{\n"
+    "  \"nodes\": [\n"
+    "    {\"id\": \"TermID\", \"label\": \"display name\", \"frequency\": number},\n"
+    "    ...\n"
+    "  ],\n"
+    "  \"edges\": [\n"
+    "    {\"source\": \"TermID\", \"target\": \"TermID\", \"weight\": 1-5, \"note\": \"link explanation\"},\n"
+    "    ...\n"
+    "  ]\n"
+    "}\n"
+    "Output JSON only."
+)
 
 # -----------------------------------------------------------
 # AI Note Keeper Tab
@@ -959,7 +4856,7 @@ def render_notes_tab():
                         model=model,
                         system_prompt=system_prompt,
                         user_prompt=user_prompt,
-                        max_tokens=st.session_state.get("default_max_tokens", 1024),
+                        max_tokens=st.session_state.get("default_max_tokens", DEFAULT_MAX_TOKENS["chat"]),
                         temperature=0.1,
                     )
                     st.session_state.note_markdown = md
@@ -976,6 +4873,47 @@ def render_notes_tab():
 
     st.markdown("---")
 
+    if st.button("⚡ 同時產生實體、心智圖與詞彙關聯圖", use_container_width=True, key="btn_notes_parallel"):
+        base_text = st.session_state.note_markdown or st.session_state.note_raw_text
+        if not base_text.strip():
+            st.warning("請先貼上文字並至少完成一次 Markdown 轉換。")
+        else:
+            provider = st.session_state.get("default_provider", "openai")
+            model = st.session_state.get("default_model", "gpt-4o-mini")
+            entities_raw, mindmap_raw, wordgraph_raw = run_llm_calls_concurrently([
+                {
+                    "provider": provider,
+                    "model": model,
+                    "system_prompt": system_prompt,
+                    "user_prompt": base_text,
+                    "max_tokens": DEFAULT_MAX_TOKENS["note_extraction"],
+                    "temperature": temperature,
+                }
+                for system_prompt, temperature in (
+                    (NOTE_ENTITIES_SYSTEM_PROMPT, 0.2),
+                    (NOTE_MINDMAP_SYSTEM_PROMPT, 0.3),
+                    (NOTE_WORDGRAPH_SYSTEM_PROMPT, 0.4),
+                )
+            ])
+            try:
+                if isinstance(entities_raw, Exception):
+                    raise entities_raw
+                entities = json.loads(entities_raw.strip().strip("```json").strip("```").strip())
+                if not isinstance(entities, list):
+                    raise ValueError("回傳內容並非 JSON 陣列。")
+                st.session_state.note_entities_json_data = entities
+            except Exception as e:
+                st.error(f"實體抽取與 JSON 解析失敗：{e}")
+            if isinstance(mindmap_raw, Exception):
+                st.error(f"心智圖 JSON 產生失敗：{mindmap_raw}")
+            else:
+                st.session_state.note_mindmap_json_text = mindmap_raw.strip().strip("```json").strip("```").strip()
+            if isinstance(wordgraph_raw, Exception):
+                st.error(f"詞彙關聯 JSON 產生失敗：{wordgraph_raw}")
+            else:
+                st.session_state.note_wordgraph_json_text = wordgraph_raw.strip().strip("```json").strip("```").strip()
+            add_combat_log("已並行完成實體抽取、心智圖與詞彙關聯圖。", "success")
+
     tab_fmt, tab_kw, tab_ent, tab_mind, tab_word = st.tabs(
         ["AI 格式優化", "AI 關鍵字標示", "AI 實體抽取", "AI 心智圖", "AI 詞彙關聯圖"]
     )
@@ -1011,7 +4949,7 @@ def render_notes_tab():
                         model=model,
                         system_prompt=system_prompt,
                         user_prompt=user_prompt,
-                        max_tokens=st.session_state.get("default_max_tokens", 2048),
+                        max_tokens=st.session_state.get("default_max_tokens", DEFAULT_MAX_TOKENS["note_format"]),
                         temperature=0.4,
                     )
                     st.session_state.note_formatted = formatted
@@ -1066,29 +5004,14 @@ def render_notes_tab():
                 try:
                     provider = st.session_state.get("default_provider", "openai")
                     model = st.session_state.get("default_model", "gpt-4o-mini")
-                    system_prompt = (
-                        "You are an information extraction specialist for FDA 510(k) dossiers.\n"
-                        "From the provided text, identify up to 20 highest-value entities. Entities may be:\n"
-                        "- regulations or standards\n"
-                        "- submission sections (e.g., Indications for Use, Device Description)\n"
-                        "- device modules or components\n"
-                        "- risk types or hazards\n"
-                        "- performance tests\n"
-                        "- clinical endpoints or outcomes\n"
-                        "Return **JSON only** in the form:\n"
-                        "[\n"
-                        "  {\"id\": 1, \"name\": \"...\", \"type\": \"regulation|section|risk|test|clinical|other\", "
-                        "\"description\": \"short explanation\", \"source_snippet\": \"representative phrase from text\"},\n"
-                        "  ... up to 20 entities\n"
-                        "]"
-                    )
+                    system_prompt = NOTE_ENTITIES_SYSTEM_PROMPT
                     user_prompt = base_text
                     raw = call_llm(
                         provider=provider,
                         model=model,
                         system_prompt=system_prompt,
                         user_prompt=user_prompt,
-                        max_tokens=1024,
+                        max_tokens=DEFAULT_MAX_TOKENS["note_extraction"],
                         temperature=0.2,
                     )
                     raw_str = raw.strip().strip("```json").strip("```").strip()
@@ -1131,28 +5054,14 @@ def render_notes_tab():
                 try:
                     provider = st.session_state.get("default_provider", "openai")
                     model = st.session_state.get("default_model", "gpt-4o-mini")
-                    system_prompt = (
-                        "You are a knowledge graph designer.\n"
-                        "Create a compact **mind-map JSON** from the text:\n"
-                        "{\n"
-                        "  \"nodes\": [\n"
-                        "    {\"id\": \"NodeID\", \"label\": \"display name\", \"type\": \"device|risk|test|regulation|clinical|other\"},\n"
-                        "    ... 8–15 nodes\n"
-                        "  ],\n"
-                        "  \"edges\": [\n"
-                        "    {\"source\": \"NodeID\", \"target\": \"NodeID\", \"relation\": \"short description\"},\n"
-                        "    ... 10–25 edges\n"
-                        "  ]\n"
-                        "}\n"
-                        "Output JSON only."
-                    )
+                    system_prompt = NOTE_MINDMAP_SYSTEM_PROMPT
                     user_prompt = base_text
                     raw = call_llm(
                         provider=provider,
                         model=model,
                         system_prompt=system_prompt,
                         user_prompt=user_prompt,
-                        max_tokens=1024,
+                        max_tokens=DEFAULT_MAX_TOKENS["note_extraction"],
                         temperature=0.3,
                     )
                     raw_str = raw.strip().strip("```json").strip("```").strip()
@@ -1200,29 +5109,14 @@ def render_notes_tab():
                 try:
                     provider = st.session_state.get("default_provider", "openai")
                     model = st.session_state.get("default_model", "gpt-4o-mini")
-                    system_prompt = (
-                        "You are a text mining and terminology network expert.\n"
-                        "From the text, select 10–15 key technical/regulatory/clinical terms and "
-                        "build a wordgraph JSON:\n"
-                        "{\n"
-                        "  \"nodes\": [\n"
-                        "    {\"id\": \"TermID\", \"label\": \"display name\", \"frequency\": number},\n"
-                        "    ...\n"
-                        "  ],\n"
-                        "  \"edges\": [\n"
-                        "    {\"source\": \"TermID\", \"target\": \"TermID\", \"weight\": 1-5, \"note\": \"link explanation\"},\n"
-                        "    ...\n"
-                        "  ]\n"
-                        "}\n"
-                        "Output JSON only."
-                    )
+                    system_prompt = NOTE_WORDGRAPH_SYSTEM_PROMPT
                     user_prompt = base_text
                     raw = call_llm(
                         provider=provider,
                         model=model,
                         system_prompt=system_prompt,
                         user_prompt=user_prompt,
-                        max_tokens=1024,
+                        max_tokens=DEFAULT_MAX_TOKENS["note_extraction"],
                         temperature=0.4,
                     )
                     raw_str = raw.strip().strip("```json").strip("```").strip()
@@ -1297,42 +5191,516 @@ def parse_page_selection(pages_str: str, max_pages: int) -> List[int]:
     return pages
 
 def ensure_pdf_reader():
-    if PdfReader is None:
+    if not PyPDF2.available:
         raise RuntimeError("PyPDF2 未安裝，無法讀取 PDF。請在環境中安裝 PyPDF2。")
 
 def ensure_tesseract():
-    if pytesseract is None or convert_from_bytes is None:
+    if not (pytesseract.available and pdf2image.available):
         raise RuntimeError("pytesseract 或 pdf2image 未安裝，無法執行 Python OCR。")
 
-def get_pdf_page_count(pdf_bytes: bytes) -> int:
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+def pdf_digest(pdf_bytes: bytes) -> str:
+    """Content hash used to key parsed documents and OCR results"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+class ParsedPdf:
+    """A parsed PdfReader plus its page count and lazily extracted page texts"""
+
+    def __init__(self, digest: str, pdf_bytes: bytes):
+        self.digest = digest
+        self.reader = PyPDF2.PdfReader(BytesIO(pdf_bytes))
+        self.num_pages = len(self.reader.pages)
+        self.page_texts: Dict[int, str] = {}
+        self.fast_texts: Dict[int, str] = {}
+        self.lock = threading.Lock()
+        self._source = pdf_bytes
+        self._fitz_doc = None
+        # Rough footprint: source bytes + parsed object graph; texts added later
+        self.size_bytes = 2 * len(pdf_bytes)
+
+    def page_text(self, page: int) -> str:
+        """Text layer of a 1-based page, extracted once"""
+        with self.lock:
+            if page not in self.page_texts:
+                text = self.reader.pages[page - 1].extract_text() or ""
+                self.page_texts[page] = text
+                self.size_bytes += len(text.encode("utf-8"))
+            return self.page_texts[page]
+
+    def fast_page_text(self, page: int) -> str:
+        """Text layer of a 1-based page via PyMuPDF when installed, else PyPDF2"""
+        if not fitz.available:
+            return self.page_text(page)
+        with self.lock:
+            if page not in self.fast_texts:
+                if self._fitz_doc is None:
+                    self._fitz_doc = fitz.open(stream=self._source, filetype="pdf")
+                text = self._fitz_doc[page - 1].get_text() or ""
+                self.fast_texts[page] = text
+                self.size_bytes += len(text.encode("utf-8"))
+            return self.fast_texts[page]
+
+    def page_fingerprint(self, page: int) -> str:
+        """
+        Hash of what a 1-based page renders from: its content stream, media box,
+        rotation, the raw data of the XObjects (scans, forms) it draws and its
+        fonts (dictionaries, ToUnicode maps and embedded font files). Subset
+        CID fonts make identical content streams draw different text, so the
+        fonts are part of the key. Equal pages in a resubmitted file get equal
+        fingerprints.
+        """
+        with self.lock:
+            pdf_page = self.reader.pages[page - 1]
+            h = hashlib.sha256()
+            try:
+                contents = pdf_page.get_contents()
+                if contents is not None:
+                    # A single stream or (older PyPDF2) an array of streams
+                    for stream in contents if isinstance(contents, list) else [contents]:
+                        h.update(stream.get_object().get_data())
+                h.update(repr(list(pdf_page.mediabox)).encode("utf-8"))
+                h.update(str(pdf_page.get("/Rotate", 0)).encode("utf-8"))
+                _hash_resources(pdf_page.get("/Resources"), h, depth=0)
+            except Exception:
+                return f"{self.digest}:{page}"
+            return h.hexdigest()
+
+def _hash_resources(resources: Any, h: Any, depth: int):
+    if resources is None or depth > 4:
+        return
+    resources = resources.get_object()
+    fonts = resources.get("/Font")
+    if fonts is not None:
+        fonts = fonts.get_object()
+        for name in sorted(fonts.keys()):
+            h.update(str(name).encode("utf-8"))
+            _hash_pdf_object(fonts[name], h, set(), depth=0)
+    xobjects = resources.get("/XObject")
+    if xobjects is None:
+        return
+    xobjects = xobjects.get_object()
+    for name in sorted(xobjects.keys()):
+        obj = xobjects[name].get_object()
+        h.update(str(name).encode("utf-8"))
+        raw = getattr(obj, "_data", None)
+        h.update(raw if isinstance(raw, bytes) else obj.get_data())
+        if obj.get("/Subtype") == "/Form":
+            _hash_resources(obj.get("/Resources"), h, depth + 1)
+
+def _hash_pdf_object(obj: Any, h: Any, seen: set, depth: int):
+    """
+    Hash a PDF object tree (a font: its dictionary, descendant fonts, font
+    descriptor, ToUnicode / CIDToGIDMap and embedded font file streams)
+    """
+    ref = getattr(obj, "idnum", None)
+    if ref is not None:
+        if ref in seen:
+            return
+        seen.add(ref)
+    obj = obj.get_object() if hasattr(obj, "get_object") else obj
+    if depth > 8:
+        return
+    if hasattr(obj, "get_data"):
+        raw = getattr(obj, "_data", None)
+        h.update(raw if isinstance(raw, bytes) else obj.get_data())
+    if isinstance(obj, dict):
+        for key in sorted(obj.keys()):
+            if key == "/Parent":
+                continue
+            h.update(str(key).encode("utf-8"))
+            value = obj.raw_get(key) if hasattr(obj, "raw_get") else obj[key]
+            _hash_pdf_object(value, h, seen, depth + 1)
+    elif isinstance(obj, list):
+        for item in obj:
+            _hash_pdf_object(item, h, seen, depth + 1)
+    else:
+        h.update(repr(obj).encode("utf-8"))
+
+class PdfDocumentCache:
+    """
+    LRU cache of parsed PDFs keyed by content hash, bounded by an estimate of
+    memory use, so page counts and page-range extractions on the same upload
+    do not reparse the xref table on every rerun.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._docs: "OrderedDict[str, ParsedPdf]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pdf_bytes: bytes, digest: Optional[str] = None) -> ParsedPdf:
+        digest = digest or pdf_digest(pdf_bytes)
+        with self._lock:
+            doc = self._docs.get(digest)
+            if doc is not None:
+                self._docs.move_to_end(digest)
+                return doc
+        doc = ParsedPdf(digest, pdf_bytes)
+        with self._lock:
+            self._docs[digest] = doc
+            self._docs.move_to_end(digest)
+            self._evict_locked()
+        return doc
+
+    def trim(self):
+        """Re-apply the memory bound after page texts were added"""
+        with self._lock:
+            self._evict_locked()
+
+    def _evict_locked(self):
+        # Drop least recently used documents until under the memory bound
+        total = sum(d.size_bytes for d in self._docs.values())
+        while total > self.max_bytes and len(self._docs) > 1:
+            _, doc = self._docs.popitem(last=False)
+            total -= doc.size_bytes
+
+@st.cache_resource
+def get_pdf_cache() -> PdfDocumentCache:
+    """Shared parsed-PDF cache (one per server process)"""
+    return PdfDocumentCache(PDF_CACHE_MAX_BYTES)
+
+def get_pdf_page_count(pdf_bytes: bytes, digest: Optional[str] = None) -> int:
     ensure_pdf_reader()
-    reader = PdfReader(BytesIO(pdf_bytes))
-    return len(reader.pages)
+    return get_pdf_cache().get(pdf_bytes, digest).num_pages
 
-def extract_pdf_text(pdf_bytes: bytes, pages: List[int]) -> str:
-    """Extract textual content from specified 1-based pages using PyPDF2"""
+def extract_pdf_page_texts(
+    pdf_bytes: bytes, pages: List[int], digest: Optional[str] = None
+) -> Dict[int, str]:
+    """
+    Text layer of the specified 1-based pages as {page: text} using PyPDF2;
+    page texts already in the OCR page store are reused instead of re-extracted.
+    """
     ensure_pdf_reader()
-    reader = PdfReader(BytesIO(pdf_bytes))
-    texts: List[str] = []
+    digest = digest or pdf_digest(pdf_bytes)
+    cache = get_pdf_cache()
+    doc = cache.get(pdf_bytes, digest)
+    page_keys = pdf_page_keys(pdf_bytes, pages, digest)
+    store = get_ocr_page_store()
+    stored = store.get_many(list(page_keys.values()), "text", 0, text_layer_engine())
+    texts: Dict[int, str] = {}
     for p in pages:
-        if 1 <= p <= len(reader.pages):
-            page = reader.pages[p - 1]
-            txt = page.extract_text() or ""
-            texts.append(f"\n\n--- Page {p} ---\n\n{txt}")
-    return "\n".join(texts).strip()
-
-def ocr_pdf_tesseract(pdf_bytes: bytes, pages: List[int], lang: str) -> str:
-    """OCR selected pages using Tesseract (english / traditional chinese)"""
+        if 1 <= p <= doc.num_pages:
+            if page_keys[p] in stored:
+                txt = stored[page_keys[p]][0]
+            else:
+                txt = doc.page_text(p)
+                store.put(page_keys[p], "text", 0, text_layer_engine(), txt, "text", digest, p)
+            texts[p] = txt
+    cache.trim()
+    return texts
+
+def extract_pdf_text(pdf_bytes: bytes, pages: List[int], digest: Optional[str] = None) -> str:
+    """Extract textual content from specified 1-based pages using PyPDF2"""
+    texts = extract_pdf_page_texts(pdf_bytes, pages, digest)
+    return "\n".join(f"\n\n--- Page {p} ---\n\n{txt}" for p, txt in texts.items()).strip()
+
+# -----------------------------------------------------------
+# Persistent OCR page store
+# -----------------------------------------------------------
+
+class OcrPageStore:
+    """
+    SQLite store of per-page OCR / text-layer results keyed by page
+    fingerprint, language, DPI and engine version, so reopened sessions and
+    resubmissions only recompute pages whose content actually changed.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_pages ("
+            " page_key TEXT NOT NULL,"
+            " lang TEXT NOT NULL,"
+            " dpi INTEGER NOT NULL,"
+            " engine TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " lang_used TEXT NOT NULL,"
+            " file_hash TEXT,"
+            " page INTEGER,"
+            " created REAL NOT NULL,"
+            " PRIMARY KEY (page_key, lang, dpi, engine))"
+        )
+        self._conn.commit()
+
+    def get_many(
+        self, page_keys: List[str], lang: str, dpi: int, engine: str
+    ) -> Dict[str, Tuple[str, str]]:
+        """Return {page_key: (text, lang_used)} for the keys already stored"""
+        found: Dict[str, Tuple[str, str]] = {}
+        unique_keys = list(dict.fromkeys(page_keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                rows = self._conn.execute(
+                    "SELECT page_key, text, lang_used FROM ocr_pages"
+                    f" WHERE lang = ? AND dpi = ? AND engine = ? AND page_key IN ({','.join('?' * len(batch))})",
+                    [lang, dpi, engine, *batch],
+                ).fetchall()
+                for page_key, text, lang_used in rows:
+                    found[page_key] = (text, lang_used)
+        return found
+
+    def put(
+        self,
+        page_key: str,
+        lang: str,
+        dpi: int,
+        engine: str,
+        text: str,
+        lang_used: str,
+        file_hash: Optional[str] = None,
+        page: Optional[int] = None,
+    ):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ocr_pages"
+                " (page_key, lang, dpi, engine, text, lang_used, file_hash, page, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (page_key, lang, dpi, engine, text, lang_used, file_hash, page, time.time()),
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM ocr_pages")
+            self._conn.commit()
+
+@st.cache_resource
+def get_ocr_page_store() -> OcrPageStore:
+    """Shared OCR page store (one connection per server process)"""
+    return OcrPageStore(os.path.join(APP_CACHE_DIR, "ocr_pages.sqlite"))
+
+@functools.lru_cache(maxsize=None)
+def tesseract_engine_version() -> str:
+    try:
+        return f"tesseract-{pytesseract.get_tesseract_version()}"
+    except Exception:
+        return "tesseract-unknown"
+
+@functools.lru_cache(maxsize=None)
+def text_layer_engine() -> str:
+    return f"pypdf2-{PyPDF2.__version__}" if PyPDF2.available else "pypdf2-None"
+
+def pdf_page_keys(pdf_bytes: bytes, pages: List[int], digest: Optional[str] = None) -> Dict[int, str]:
+    """Content fingerprints for pages (file hash + page number without PyPDF2)"""
+    digest = digest or pdf_digest(pdf_bytes)
+    if not PyPDF2.available:
+        return {p: f"{digest}:{p}" for p in pages}
+    doc = get_pdf_cache().get(pdf_bytes, digest)
+    return {p: doc.page_fingerprint(p) for p in pages if 1 <= p <= doc.num_pages}
+
+# -----------------------------------------------------------
+# Page-parallel Tesseract OCR
+# -----------------------------------------------------------
+
+OCR_DPI = 200
+
+def ocr_worker_count() -> int:
+    """Cores available to this process (respects CPU affinity / cgroup pinning)"""
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return max(1, os.cpu_count() or 1)
+
+# Tesseract script (from OSD) -> language models needed for that page
+OSD_SCRIPT_LANGS = {
+    "Latin": "eng",
+    "Han": "chi_tra+eng",
+    "HanT": "chi_tra+eng",
+}
+AUTO_LANG = "auto"
+AUTO_LANG_FALLBACK = "eng+chi_tra"
+
+def detect_page_lang(image: Any) -> str:
+    """
+    Choose Tesseract languages for a page from its detected script (OSD), so
+    English-only pages skip loading the Chinese model. Falls back to the full
+    bilingual spec when OSD is unavailable or unsure.
+    """
+    try:
+        osd = pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT)
+    except Exception:
+        return AUTO_LANG_FALLBACK
+    return OSD_SCRIPT_LANGS.get(osd.get("script", ""), AUTO_LANG_FALLBACK)
+
+def _ocr_single_page(pdf_path: str, page: int, lang: str, dpi: int) -> Tuple[str, str]:
+    # Rasterize exactly one page, then recognize it in a single pass with the
+    # combined language spec (e.g. "eng+chi_tra"); both steps run as external
+    # pdftoppm / tesseract processes, so threads only wait on them.
+    images = pdf2image.convert_from_path(pdf_path, dpi=dpi, first_page=page, last_page=page)
+    if not images:
+        return "", lang
+    page_lang = detect_page_lang(images[0]) if lang == AUTO_LANG else lang
+    return pytesseract.image_to_string(images[0], lang=page_lang), page_lang
+
+def iter_ocr_pages(
+    pdf_bytes: bytes,
+    pages: List[int],
+    lang: str,
+    dpi: int = OCR_DPI,
+    max_workers: Optional[int] = None,
+    digest: Optional[str] = None,
+) -> Iterator[Tuple[int, str, str, bool]]:
+    """
+    OCR the selected pages in parallel, one pdftoppm + tesseract job per page,
+    yielding (page, text, languages used, from_store) in page order as results
+    become available. lang may be a Tesseract spec such as "eng+chi_tra" or
+    "auto". Pages already in the OCR page store are not recomputed.
+    """
     ensure_tesseract()
-    first_page, last_page = min(pages), max(pages)
-    images = convert_from_bytes(pdf_bytes, first_page=first_page, last_page=last_page)
+    pages = sorted(set(pages))
+    page_keys = pdf_page_keys(pdf_bytes, pages, digest)
+    pages = [p for p in pages if p in page_keys]
+    engine = tesseract_engine_version()
+    store = get_ocr_page_store()
+    stored = store.get_many(list(page_keys.values()), lang, dpi, engine)
+    missing = [p for p in pages if page_keys[p] not in stored]
+
+    if not missing:
+        for page in pages:
+            text, page_lang = stored[page_keys[page]]
+            yield page, text, page_lang, True
+        return
+
+    workers = max(1, min(max_workers or ocr_worker_count(), len(missing)))
+    if workers > 1:
+        # One core per tesseract process; its own OpenMP threads would oversubscribe
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+    with tempfile.TemporaryDirectory(prefix="ocr_") as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "source.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(pdf_bytes)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                page: pool.submit(_ocr_single_page, pdf_path, page, lang, dpi)
+                for page in missing
+            }
+            try:
+                for page in pages:
+                    if page not in futures:
+                        text, page_lang = stored[page_keys[page]]
+                        yield page, text, page_lang, True
+                        continue
+                    text, page_lang = futures[page].result()
+                    store.put(
+                        page_keys[page], lang, dpi, engine, text, page_lang,
+                        file_hash=digest, page=page,
+                    )
+                    yield page, text, page_lang, False
+            finally:
+                for future in futures.values():
+                    future.cancel()
+
+def ocr_pdf_tesseract(
+    pdf_bytes: bytes,
+    pages: List[int],
+    lang: str,
+    dpi: int = OCR_DPI,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """OCR selected pages using Tesseract (english / traditional chinese / auto)"""
     result_chunks: List[str] = []
-    for idx, img in enumerate(images, start=first_page):
-        if idx in pages:
-            text = pytesseract.image_to_string(img, lang=lang)
-            result_chunks.append(f"\n\n--- Page {idx} ---\n\n{text}")
+    total = len(set(pages))
+    for done, (page, text, _lang, _stored) in enumerate(iter_ocr_pages(pdf_bytes, pages, lang, dpi), start=1):
+        result_chunks.append(f"\n\n--- Page {page} ---\n\n{text}")
+        if progress:
+            progress(done, total)
     return "\n".join(result_chunks).strip()
 
+# -----------------------------------------------------------
+# Hybrid extraction: text layer first, OCR fallback per page
+# -----------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def fast_text_engine() -> str:
+    return f"pymupdf-{fitz.VersionBind}" if fitz.available else text_layer_engine()
+
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "80"))
+TEXT_LAYER_MAX_GARBAGE_RATIO = float(os.getenv("TEXT_LAYER_MAX_GARBAGE_RATIO", "0.15"))
+_CID_GLYPH_RE = re.compile(r"\(cid:\d+\)")
+
+def assess_text_layer(text: str) -> Dict[str, Any]:
+    """
+    Judge whether a page's embedded text layer is usable: enough visible
+    characters, and few broken glyphs (U+FFFD, private-use, control chars,
+    "(cid:NN)" placeholders left by fonts without a Unicode map).
+    """
+    cid_hits = len(_CID_GLYPH_RE.findall(text))
+    cleaned = _CID_GLYPH_RE.sub("", text)
+    visible = [c for c in cleaned if not c.isspace()]
+    garbage = sum(
+        1 for c in visible
+        if c == "\ufffd" or "\ue000" <= c <= "\uf8ff" or (ord(c) < 32)
+    ) + cid_hits
+    total = len(visible) + cid_hits
+    ratio = garbage / total if total else 1.0
+    if total < TEXT_LAYER_MIN_CHARS:
+        usable, reason = False, f"文字層僅 {total} 字元"
+    elif ratio > TEXT_LAYER_MAX_GARBAGE_RATIO:
+        usable, reason = False, f"亂碼比例 {ratio:.0%}"
+    else:
+        usable, reason = True, "文字層品質良好"
+    return {"usable": usable, "chars": total, "garbage_ratio": ratio, "reason": reason}
+
+def extract_pdf_hybrid(
+    pdf_bytes: bytes,
+    pages: List[int],
+    lang: str,
+    digest: Optional[str] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Per page, use the (fast) text layer when it is good enough and send only
+    image-only or garbled pages to Tesseract. Text layers are kept in the OCR
+    page store under the fast extractor's engine label, so unchanged pages
+    are not re-extracted. Returns the page-tagged text and one decision
+    record per page.
+    """
+    ensure_pdf_reader()
+    digest = digest or pdf_digest(pdf_bytes)
+    doc = get_pdf_cache().get(pdf_bytes, digest)
+    pages = [p for p in sorted(set(pages)) if 1 <= p <= doc.num_pages]
+    page_keys = pdf_page_keys(pdf_bytes, pages, digest)
+    store = get_ocr_page_store()
+    engine = fast_text_engine()
+    stored = store.get_many(list(page_keys.values()), "text", 0, engine)
+
+    texts: Dict[int, str] = {}
+    decisions: Dict[int, Dict[str, Any]] = {}
+    ocr_pages: List[int] = []
+    for p in pages:
+        if page_keys[p] in stored:
+            text = stored[page_keys[p]][0]
+        else:
+            text = doc.fast_page_text(p)
+            store.put(page_keys[p], "text", 0, engine, text, "text", digest, p)
+        verdict = assess_text_layer(text)
+        decisions[p] = {"page": p, "method": "text", **verdict}
+        if verdict["usable"]:
+            texts[p] = text
+        else:
+            ocr_pages.append(p)
+    done = len(pages) - len(ocr_pages)
+    if progress and pages:
+        progress(done, len(pages))
+
+    if ocr_pages:
+        for page, text, page_lang, from_store in iter_ocr_pages(pdf_bytes, ocr_pages, lang, digest=digest):
+            texts[page] = text
+            decisions[page].update({"method": "ocr", "lang": page_lang, "from_store": from_store})
+            done += 1
+            if progress:
+                progress(done, len(pages))
+    get_pdf_cache().trim()
+
+    combined = "\n".join(f"\n\n--- Page {p} ---\n\n{texts[p]}" for p in pages).strip()
+    return combined, [decisions[p] for p in pages]
+
 def pdf_to_base64_iframe(pdf_bytes: bytes, width: str = "100%", height: str = "600") -> str:
     """Generate an HTML iframe to preview a PDF from bytes."""
     b64 = base64.b64encode(pdf_bytes).decode("utf-8")
@@ -1370,6 +5738,520 @@ Output:
 - Return **Markdown + inline HTML only**, ready to render in a viewer.
 """
 
+# -----------------------------------------------------------
+# Chunked LLM OCR (map-reduce over page chunks)
+# -----------------------------------------------------------
+
+OCR_CHUNK_MAX_CHARS = 12000
+OCR_CHUNK_OVERLAP_CHARS = 800
+# Reconstructed Markdown (with highlight markup) runs to about this many output
+# tokens per input token; chunks are sized so their output fits max_tokens
+OCR_OUTPUT_TOKEN_RATIO = 1.3
+
+def _normalize_edge_line(line: str) -> str:
+    # Page numbers and dates differ between pages; compare the rest
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+def strip_repeated_headers_footers(
+    page_texts: Dict[int, str], edge_lines: int = 2, min_share: float = 0.5
+) -> Dict[int, str]:
+    """
+    Remove running headers/footers: lines among the first/last edge_lines of a
+    page that recur (ignoring digits) on at least min_share of the pages.
+    """
+    if len(page_texts) < 3:
+        return dict(page_texts)
+
+    def edge_indices(lines: List[str]) -> List[int]:
+        non_empty = [i for i, l in enumerate(lines) if l.strip()]
+        # Never let the header and footer windows cover the page body
+        k = min(edge_lines, len(non_empty) // 2)
+        return non_empty[:k] + non_empty[len(non_empty) - k:] if k else []
+
+    counts: Dict[str, int] = {}
+    for text in page_texts.values():
+        lines = text.splitlines()
+        edges = {_normalize_edge_line(lines[i]) for i in edge_indices(lines)}
+        for norm in edges:
+            counts[norm] = counts.get(norm, 0) + 1
+    threshold = max(2, int(len(page_texts) * min_share))
+    repeated = {norm for norm, n in counts.items() if n >= threshold}
+
+    cleaned: Dict[int, str] = {}
+    for page, text in page_texts.items():
+        lines = text.splitlines()
+        edge_idx = set(edge_indices(lines))
+        cleaned[page] = "\n".join(
+            l for i, l in enumerate(lines)
+            if not (i in edge_idx and _normalize_edge_line(l) in repeated)
+        )
+    return cleaned
+
+def build_page_chunks(
+    page_texts: Dict[int, str],
+    max_chars: int = OCR_CHUNK_MAX_CHARS,
+    overlap_chars: int = OCR_CHUNK_OVERLAP_CHARS,
+    max_tokens: Optional[int] = None,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Group consecutive pages into chunks of at most max_chars and, with
+    max_tokens and count_tokens, at most max_tokens / OCR_OUTPUT_TOKEN_RATIO
+    input tokens, so each chunk's reconstruction fits its output budget (a
+    single larger page becomes its own chunk; its "tokens" tell the caller
+    to raise that chunk's budget). Each chunk carries the tail of the
+    previous chunk as read-only context so sentences cut at the boundary
+    stay coherent.
+    """
+    token_limit = max_tokens / OCR_OUTPUT_TOKEN_RATIO if max_tokens and count_tokens else None
+    chunks: List[Dict[str, Any]] = []
+    current: List[int] = []
+    size = tokens = 0
+    for page, text in page_texts.items():
+        block = len(text) + 32
+        page_tokens = count_tokens(text) + 8 if token_limit else 0
+        if current and (
+            size + block > max_chars or (token_limit and tokens + page_tokens > token_limit)
+        ):
+            chunks.append({"pages": current, "tokens": tokens})
+            current, size, tokens = [], 0, 0
+        current.append(page)
+        size += block
+        tokens += page_tokens
+    if current:
+        chunks.append({"pages": current, "tokens": tokens})
+
+    previous_text = ""
+    for chunk in chunks:
+        chunk["text"] = "\n".join(
+            f"\n\n--- Page {p} ---\n\n{page_texts[p]}" for p in chunk["pages"]
+        ).strip()
+        chunk["context"] = previous_text[-overlap_chars:] if overlap_chars else ""
+        previous_text = chunk["text"]
+    return chunks
+
+def chunk_user_prompt(chunk: Dict[str, Any], index: int, total: int) -> str:
+    pages = chunk["pages"]
+    header = f"[Part {index}/{total}: pages {pages[0]}–{pages[-1]}]\n"
+    if not chunk["context"]:
+        return header + chunk["text"]
+    return (
+        header
+        + "=== PRECEDING CONTEXT (for continuity only; do NOT reproduce) ===\n"
+        + chunk["context"]
+        + "\n=== CONTENT TO RECONSTRUCT ===\n"
+        + chunk["text"]
+    )
+
+_MD_HEADING_RE = re.compile(r"^\s{0,3}(#{1,6})\s+(.*?)\s*#*\s*$")
+
+def stitch_markdown_chunks(parts: List[str]) -> str:
+    """
+    Join per-chunk Markdown: drop a chunk's leading heading(s) when they repeat
+    the heading already open from the previous chunk, and drop leading lines
+    that duplicate the previous chunk's last lines (overlap echo).
+    """
+    stitched: List[str] = []
+    open_headings: Dict[int, str] = {}
+    for part in parts:
+        lines = part.strip().splitlines()
+        tail = [l.strip() for l in stitched[-8:] if l.strip()]
+        while lines and lines[0].strip() and lines[0].strip() in tail:
+            lines.pop(0)
+        while lines:
+            first = lines[0]
+            m = _MD_HEADING_RE.match(first)
+            if not first.strip():
+                lines.pop(0)
+            elif m and open_headings.get(len(m.group(1))) == m.group(2).strip().lower():
+                lines.pop(0)
+            else:
+                break
+        for line in lines:
+            m = _MD_HEADING_RE.match(line)
+            if m:
+                level = len(m.group(1))
+                open_headings[level] = m.group(2).strip().lower()
+                for deeper in [k for k in open_headings if k > level]:
+                    del open_headings[deeper]
+        if lines:
+            if stitched:
+                stitched.append("")
+            stitched.extend(lines)
+    return "\n".join(stitched).strip()
+
+def run_chunked_llm_ocr(
+    page_texts: Dict[int, str],
+    provider: str,
+    model: str,
+    system_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    max_chars: int = OCR_CHUNK_MAX_CHARS,
+    overlap_chars: int = OCR_CHUNK_OVERLAP_CHARS,
+    on_progress: Optional[Callable[[int, int, Dict[str, Any]], None]] = None,
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Map: clean headers/footers, split pages into overlapping chunks sized to
+    what max_tokens can reconstruct, and send them to the model concurrently.
+    A single page too large for max_tokens gets a larger budget for its chunk
+    (up to the model's max output). Reduce: stitch the Markdown in page order.
+
+    A chunk that fails keeps the others: its pages are marked in the stitched
+    Markdown and the chunk gets an "error". Chunks whose output stopped at
+    the token limit get "truncated". on_progress(done, total, chunk) fires as
+    each chunk finishes.
+    """
+    chunks = build_page_chunks(
+        strip_repeated_headers_footers(page_texts),
+        max_chars,
+        overlap_chars,
+        max_tokens=max_tokens,
+        count_tokens=lambda text: estimate_tokens(text, provider, model),
+    )
+    output_cap = int(model_token_limits(provider, model)["max_output"])
+    for chunk in chunks:
+        needed = math.ceil(chunk["tokens"] * OCR_OUTPUT_TOKEN_RATIO)
+        chunk["max_tokens"] = max(max_tokens, min(needed, output_cap))
+    chunk_prompt = (
+        system_prompt
+        + "\n\nYou are processing one part of a longer document. Reconstruct only "
+        "the CONTENT TO RECONSTRUCT section; continue headings naturally and do not "
+        "add a document title, introduction or closing summary."
+    )
+
+    async def run_all() -> List[str]:
+        done = 0
+
+        async def run_one(i: int, chunk: Dict[str, Any]) -> str:
+            nonlocal done
+            usage = new_token_usage()
+            try:
+                result = await acall_llm(
+                    provider=provider,
+                    model=model,
+                    system_prompt=chunk_prompt if len(chunks) > 1 else system_prompt,
+                    user_prompt=chunk_user_prompt(chunk, i + 1, len(chunks)) if len(chunks) > 1 else chunk["text"],
+                    max_tokens=chunk["max_tokens"],
+                    temperature=temperature,
+                    usage=usage,
+                )
+                chunk["truncated"] = bool(usage["truncated"])
+                return result
+            finally:
+                done += 1
+                if on_progress:
+                    on_progress(done, len(chunks), chunk)
+
+        return await asyncio.gather(
+            *(run_one(i, c) for i, c in enumerate(chunks)), return_exceptions=True
+        )
+
+    parts: List[str] = []
+    for chunk, result in zip(chunks, run_async(run_all)):
+        pages = chunk["pages"]
+        if isinstance(result, BaseException):
+            chunk["error"] = f"{type(result).__name__}: {result}"
+            parts.append(f"> ⚠️ 第 {pages[0]}–{pages[-1]} 頁處理失敗，未包含於此結果：{chunk['error']}")
+            add_combat_log(f"OCR 第 {pages[0]}–{pages[-1]} 頁處理失敗：{chunk['error']}", "error")
+        else:
+            parts.append(result)
+            if chunk.get("truncated"):
+                add_combat_log(
+                    f"OCR 第 {pages[0]}–{pages[-1]} 頁輸出達到 {chunk['max_tokens']:,} tokens 上限，內容可能不完整。",
+                    "warning",
+                )
+    return stitch_markdown_chunks(parts), chunks
+
+# -----------------------------------------------------------
+# Corpus retrieval index (BM25 + optional hashed-vector rerank)
+# -----------------------------------------------------------
+
+RETRIEVAL_PASSAGE_CHARS = 1200
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_VECTOR_DIM = 4096
+
+_LATIN_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+_CJK_RUN_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+
+def tokenize_for_retrieval(text: str) -> List[str]:
+    """Latin/number words plus CJK character bigrams (unigram for 1-char runs)."""
+    text = text.lower()
+    tokens = _LATIN_TOKEN_RE.findall(text)
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+def strip_highlight_markup(text: str) -> str:
+    """Remove keyword-highlight spans (highlight_keywords_in_text), keeping their text"""
+    return _HIGHLIGHT_TAG_RE.sub("", text) if "<" in text else text
+
+def split_markdown_passages(markdown: str, max_chars: int = RETRIEVAL_PASSAGE_CHARS) -> List[str]:
+    """
+    Split Markdown into paragraph-aligned passages of about max_chars, each
+    prefixed with the nearest heading so it stays interpretable on its own.
+    """
+    passages: List[str] = []
+    heading = ""
+    buf: List[str] = []
+    size = 0
+
+    def flush():
+        nonlocal buf, size
+        body = "\n\n".join(buf).strip()
+        if body:
+            passages.append(f"{heading}\n\n{body}" if heading and not body.startswith(heading) else body)
+        buf, size = [], 0
+
+    for para in re.split(r"\n\s*\n", markdown):
+        para = para.strip()
+        if not para:
+            continue
+        if _MD_HEADING_RE.match(para.splitlines()[0]):
+            flush()
+            heading = para.splitlines()[0].strip()
+        while len(para) > max_chars:
+            flush()
+            buf, size = [para[:max_chars]], max_chars
+            flush()
+            para = para[max_chars:]
+        if buf and size + len(para) > max_chars:
+            flush()
+        buf.append(para)
+        size += len(para)
+    flush()
+    return passages
+
+def _hashed_vector(text: str, dim: int = RETRIEVAL_VECTOR_DIM) -> Dict[int, float]:
+    """L2-normalised sparse vector of hashed character trigrams."""
+    compact = re.sub(r"\s+", " ", text.lower())
+    vec: Dict[int, float] = {}
+    for i in range(len(compact) - 2):
+        h = int.from_bytes(hashlib.blake2b(compact[i:i + 3].encode("utf-8"), digest_size=4).digest(), "little")
+        vec[h % dim] = vec.get(h % dim, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+    return {k: v / norm for k, v in vec.items()}
+
+class CorpusRetrievalIndex:
+    """
+    Incremental BM25 index over per-file Markdown passages. Documents are
+    keyed by id and versioned by content hash, so re-OCR of one file only
+    re-indexes that file's passages.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs: Dict[str, Dict[str, Any]] = {}   # doc_id -> {version, filename, passage_ids}
+        self.passages: Dict[int, Dict[str, Any]] = {}
+        self.doc_freq: Dict[str, int] = {}
+        self.total_len = 0
+        self._next_id = 0
+
+    def _remove(self, doc_id: str):
+        doc = self.docs.pop(doc_id, None)
+        if not doc:
+            return
+        for pid in doc["passage_ids"]:
+            passage = self.passages.pop(pid)
+            self.total_len -= passage["length"]
+            for term in passage["tf"]:
+                self.doc_freq[term] -= 1
+                if not self.doc_freq[term]:
+                    del self.doc_freq[term]
+
+    def upsert(self, doc_id: str, filename: str, markdown: str) -> bool:
+        """
+        (Re)index one document; returns False when its content is unchanged.
+        Keyword-highlight markup is stripped first so it neither scores in
+        BM25 (span, style, color, ff7f50) nor reaches the LLM in passages.
+        """
+        markdown = strip_highlight_markup(markdown)
+        version = hashlib.sha256(markdown.encode("utf-8")).hexdigest()
+        current = self.docs.get(doc_id)
+        if current and current["version"] == version:
+            current["filename"] = filename
+            return False
+        self._remove(doc_id)
+        passage_ids = []
+        for text in split_markdown_passages(markdown):
+            tokens = tokenize_for_retrieval(text)
+            tf: Dict[str, int] = {}
+            for t in tokens:
+                tf[t] = tf.get(t, 0) + 1
+            pid = self._next_id
+            self._next_id += 1
+            self.passages[pid] = {
+                "doc_id": doc_id, "text": text, "tf": tf,
+                "length": len(tokens), "vector": None,
+            }
+            self.total_len += len(tokens)
+            for term in tf:
+                self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+            passage_ids.append(pid)
+        self.docs[doc_id] = {"version": version, "filename": filename, "passage_ids": passage_ids}
+        return True
+
+    def sync(self, documents: Dict[str, Tuple[str, str]]) -> int:
+        """Make the index match {doc_id: (filename, markdown)}; returns docs re-indexed."""
+        for doc_id in [d for d in self.docs if d not in documents]:
+            self._remove(doc_id)
+        return sum(self.upsert(doc_id, name, md) for doc_id, (name, md) in documents.items())
+
+    def search(self, query: str, top_k: int = RETRIEVAL_TOP_K, vector_rerank: bool = False) -> List[Dict[str, Any]]:
+        """Top-k passages as {filename, text, score}, in descending relevance."""
+        n = len(self.passages)
+        terms = set(tokenize_for_retrieval(query))
+        if not n or not terms:
+            return []
+        avg_len = self.total_len / n or 1.0
+        scores: Dict[int, float] = {}
+        for pid, passage in self.passages.items():
+            score = 0.0
+            for term in terms:
+                f = passage["tf"].get(term)
+                if not f:
+                    continue
+                df = self.doc_freq[term]
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                score += idf * f * (self.k1 + 1) / (
+                    f + self.k1 * (1 - self.b + self.b * passage["length"] / avg_len)
+                )
+            if score > 0:
+                scores[pid] = score
+        ranked = sorted(scores, key=scores.get, reverse=True)
+
+        if vector_rerank and ranked:
+            # Rerank a wider BM25 shortlist by trigram cosine, blended with normalised BM25
+            shortlist = ranked[: top_k * 4]
+            qvec = _hashed_vector(query)
+            best = scores[shortlist[0]]
+            blended = {}
+            for pid in shortlist:
+                passage = self.passages[pid]
+                if passage["vector"] is None:
+                    passage["vector"] = _hashed_vector(passage["text"])
+                cos = sum(w * passage["vector"].get(k, 0.0) for k, w in qvec.items())
+                blended[pid] = 0.5 * scores[pid] / best + 0.5 * cos
+            ranked = sorted(shortlist, key=blended.get, reverse=True)
+            scores = blended
+
+        return [
+            {
+                "filename": self.docs[self.passages[pid]["doc_id"]]["filename"],
+                "text": self.passages[pid]["text"],
+                "score": round(scores[pid], 4),
+            }
+            for pid in ranked[:top_k]
+        ]
+
+class CombinedCorpus:
+    """
+    Combined OCR corpus maintained incrementally across reruns. Each file's
+    segment is re-hashed only when its Markdown object changes; the joined
+    text is rebuilt only when the fingerprint (ordered doc ids + versions)
+    changes, so callers can cheaply detect stale derived results.
+    """
+
+    def __init__(self):
+        self.segments: Dict[str, Dict[str, Any]] = {}
+        self.order: List[str] = []
+        self.fingerprint = ""
+        self._text = ""
+        self._text_fingerprint = ""
+        self._token_counts: Dict[Tuple[str, str, str], int] = {}
+
+    def update(self, ocr_files: List[Dict[str, Any]]) -> List[str]:
+        """Sync with st.session_state.ocr_files; returns ids of changed segments."""
+        order: List[str] = []
+        changed: List[str] = []
+        for i, f in enumerate(ocr_files):
+            markdown = f.get("markdown")
+            if not markdown:
+                continue
+            doc_id = f.get("sha256") or f"{i}:{f['filename']}"
+            order.append(doc_id)
+            seg = self.segments.get(doc_id)
+            if seg and seg["markdown"] is markdown and seg["filename"] == f["filename"]:
+                continue
+            version = hashlib.sha256(markdown.encode("utf-8")).hexdigest()[:16]
+            if not seg or seg["version"] != version or seg["filename"] != f["filename"]:
+                changed.append(doc_id)
+            self.segments[doc_id] = {"filename": f["filename"], "markdown": markdown, "version": version}
+        removed = [d for d in self.segments if d not in order]
+        for doc_id in removed:
+            del self.segments[doc_id]
+        if changed or removed:
+            versions = {seg["version"] for seg in self.segments.values()}
+            self._token_counts = {k: v for k, v in self._token_counts.items() if k[0] in versions}
+        if changed or removed or order != self.order:
+            self.order = order
+            self.fingerprint = hashlib.sha256(
+                "|".join(f"{d}:{self.segments[d]['version']}" for d in order).encode("utf-8")
+            ).hexdigest()[:16] if order else ""
+        return changed + removed
+
+    @property
+    def text(self) -> str:
+        if self._text_fingerprint != self.fingerprint:
+            self._text = "\n\n---\n\n".join(
+                f"## File {n}: {self.segments[d]['filename']}\n\n{self.segments[d]['markdown']}"
+                for n, d in enumerate(self.order, start=1)
+            )
+            self._text_fingerprint = self.fingerprint
+        return self._text
+
+    def documents(self) -> Dict[str, Tuple[str, str]]:
+        return {d: (self.segments[d]["filename"], self.segments[d]["markdown"]) for d in self.order}
+
+    def total_chars(self) -> int:
+        return sum(len(self.segments[d]["markdown"]) for d in self.order)
+
+    def estimate_tokens(self, provider: str, model: str) -> int:
+        """
+        Token estimate of text, summed per document: each file is tokenized
+        once per version and model, not on every rerun.
+        """
+        total = 0
+        for d in self.order:
+            seg = self.segments[d]
+            key = (seg["version"], provider, model)
+            if key not in self._token_counts:
+                self._token_counts[key] = estimate_tokens(seg["markdown"], provider, model)
+            total += self._token_counts[key]
+        # File headers and separators
+        total += estimate_tokens("\n\n---\n\n".join(
+            f"## File {n}: {self.segments[d]['filename']}\n\n" for n, d in enumerate(self.order, start=1)
+        ), provider, model)
+        return total
+
+def get_combined_corpus() -> CombinedCorpus:
+    """Per-session incremental combined corpus."""
+    if "combined_corpus" not in st.session_state:
+        st.session_state["combined_corpus"] = CombinedCorpus()
+    return st.session_state["combined_corpus"]
+
+def render_corpus_cost_estimate(
+    provider: str, model: str, corpus: CombinedCorpus, max_tokens: int, question: str = ""
+):
+    """render_cost_estimate for the combined corpus (plus an optional question) as user prompt"""
+    user_tokens = corpus.estimate_tokens(provider, model) + estimate_tokens(question, provider, model)
+    render_budget_caption(budget_for_tokens(provider, model, 0, user_tokens, max_tokens))
+
+def get_retrieval_index() -> CorpusRetrievalIndex:
+    """Per-session retrieval index over the OCR files' Markdown."""
+    if "retrieval_index" not in st.session_state:
+        st.session_state["retrieval_index"] = CorpusRetrievalIndex()
+    return st.session_state["retrieval_index"]
+
+def format_retrieved_passages(hits: List[Dict[str, Any]]) -> str:
+    return "\n\n".join(
+        f"[Passage {i} | File: {h['filename']}]\n{h['text']}" for i, h in enumerate(hits, start=1)
+    )
+
 def render_submission_ocr_tab():
     """Render multi-file Submission OCR Studio with PDF/TXT upload + OCR + summaries + combined QA"""
     st.markdown(f"## 📂 {get_translation('ocr')}")
@@ -1387,6 +6269,10 @@ def render_submission_ocr_tab():
         key="ocr_global_keywords",
     )
 
+    if st.button("🗑️ 清除 OCR 頁面快取", key="ocr_store_clear"):
+        get_ocr_page_store().clear()
+        add_combat_log("已清除 OCR 頁面快取。", "info")
+
     # Step 1 – user-estimated number of files
     num_files = st.number_input("預計處理的檔案數量", min_value=1, max_value=20, value=1, step=1)
 
@@ -1401,27 +6287,35 @@ def render_submission_ocr_tab():
         if len(uploaded_files) != num_files:
             st.warning(f"目前已上傳 {len(uploaded_files)} 個檔案，與預計數量 {num_files} 不同，可視需要調整。")
 
-        # Rebuild or update state for ocr_files
+        # Update state for ocr_files; unchanged uploads keep their entry as-is
         existing_by_name = {f["filename"]: f for f in st.session_state.ocr_files}
         new_state_files: List[Dict[str, Any]] = []
 
         for uf in uploaded_files:
             name = uf.name
+            upload_id = getattr(uf, "file_id", None) or f"{name}:{uf.size}"
+            prev = existing_by_name.get(name, {})
+            if prev.get("upload_id") == upload_id:
+                new_state_files.append(prev)
+                continue
+
             ext = "pdf" if name.lower().endswith(".pdf") else "txt"
             content = uf.getvalue()
-
-            prev = existing_by_name.get(name, {})
+            digest = pdf_digest(content)
+            same_content = prev.get("sha256") == digest
             entry = {
                 "filename": name,
                 "ext": ext,
                 "bytes": content,
-                "num_pages": prev.get("num_pages"),
+                "sha256": digest,
+                "upload_id": upload_id,
+                "num_pages": prev.get("num_pages") if same_content else None,
                 "markdown": prev.get("markdown", ""),
                 "summary": prev.get("summary", ""),
             }
             if ext == "pdf" and entry["num_pages"] is None:
                 try:
-                    entry["num_pages"] = get_pdf_page_count(content)
+                    entry["num_pages"] = get_pdf_page_count(content, digest)
                 except Exception as e:
                     st.error(f"無法讀取 PDF 頁數：{name} - {e}")
                     entry["num_pages"] = 0
@@ -1459,22 +6353,33 @@ def render_submission_ocr_tab():
 
                     ocr_backend = st.radio(
                         "OCR 方式",
-                        ["Python OCR (Tesseract)", "LLM-based OCR (多模型支援)"],
+                        [
+                            "Python OCR (Tesseract)",
+                            "自動：文字層優先，掃描頁才 OCR",
+                            "LLM-based OCR (多模型支援)",
+                        ],
                         key=f"{key_prefix}_backend",
                     )
 
-                    if ocr_backend.startswith("Python"):
+                    if not ocr_backend.startswith("LLM"):
                         lang_label = st.selectbox(
                             "Tesseract 語言",
-                            ["English", "Traditional Chinese", "English + Traditional Chinese"],
+                            [
+                                "English",
+                                "Traditional Chinese",
+                                "English + Traditional Chinese",
+                                "自動偵測（逐頁判斷文字系統）",
+                            ],
                             key=f"{key_prefix}_lang",
                         )
                         if lang_label == "English":
                             lang_code = "eng"
                         elif lang_label == "Traditional Chinese":
                             lang_code = "chi_tra"
-                        else:
+                        elif lang_label == "English + Traditional Chinese":
                             lang_code = "eng+chi_tra"
+                        else:
+                            lang_code = AUTO_LANG
                     else:
                         lang_code = None  # not used
 
@@ -1501,7 +6406,7 @@ def render_submission_ocr_tab():
 
                         llm_max_tokens = st.number_input(
                             "最大輸出 tokens（OCR/清理用）",
-                            min_value=128, max_value=4096, value=1500, step=64,
+                            min_value=128, max_value=4096, value=DEFAULT_MAX_TOKENS["ocr_cleanup"], step=64,
                             key=f"{key_prefix}_llm_max_tokens",
                         )
 
@@ -1511,6 +6416,21 @@ def render_submission_ocr_tab():
                             key=f"{key_prefix}_llm_temp",
                         )
 
+                        col_c1, col_c2 = st.columns(2)
+                        with col_c1:
+                            st.checkbox(
+                                "分段並行處理（大型文件）",
+                                value=True,
+                                key=f"{key_prefix}_llm_chunked",
+                                help="依頁面分段、段間保留重疊脈絡，並行送出後再合併 Markdown。",
+                            )
+                        with col_c2:
+                            st.number_input(
+                                "每段字元上限",
+                                min_value=2000, max_value=100000, value=OCR_CHUNK_MAX_CHARS, step=1000,
+                                key=f"{key_prefix}_llm_chunk_chars",
+                            )
+
                         default_ocr_prompt = ADVANCED_OCR_SYSTEM_PROMPT.strip()
                         llm_system_prompt = st.text_area(
                             "進階 OCR 系統提示（可微調）",
@@ -1527,15 +6447,38 @@ def render_submission_ocr_tab():
                                 pages = parse_page_selection(pages_str, num_pages)
 
                                 if ocr_backend.startswith("Python"):
-                                    # Python OCR path
-                                    if "+" in (lang_code or ""):
-                                        langs = lang_code.split("+")
-                                        text_agg = ""
-                                        for l in langs:
-                                            text_agg += ocr_pdf_tesseract(file_info["bytes"], pages, l)
-                                        raw_text = text_agg
-                                    else:
-                                        raw_text = ocr_pdf_tesseract(file_info["bytes"], pages, lang_code)
+                                    # Python OCR path (pages recognized in parallel)
+                                    ocr_progress = st.progress(0.0)
+
+                                    def report_ocr_progress(done: int, total: int):
+                                        ocr_progress.progress(done / total, text=f"OCR 第 {done}/{total} 頁")
+
+                                    # Multi-language specs ("eng+chi_tra") run as one pass per page
+                                    page_chunks: List[str] = []
+                                    page_langs: Dict[int, str] = {}
+                                    reused_pages = 0
+                                    for done, (page, text, page_lang, from_store) in enumerate(
+                                        iter_ocr_pages(
+                                            file_info["bytes"], pages, lang_code,
+                                            digest=file_info.get("sha256"),
+                                        ),
+                                        start=1,
+                                    ):
+                                        page_chunks.append(f"\n\n--- Page {page} ---\n\n{text}")
+                                        page_langs[page] = page_lang
+                                        reused_pages += int(from_store)
+                                        report_ocr_progress(done, len(pages))
+                                    raw_text = "\n".join(page_chunks).strip()
+                                    if reused_pages:
+                                        st.caption(
+                                            f"♻️ {reused_pages}/{len(pages)} 頁沿用先前的 OCR 結果，"
+                                            f"僅重新辨識 {len(pages) - reused_pages} 頁。"
+                                        )
+                                    if lang_code == AUTO_LANG:
+                                        st.caption(
+                                            "🔤 逐頁語言："
+                                            + "、".join(f"p{p}: {l}" for p, l in page_langs.items())
+                                        )
 
                                     # Simple Markdown wrap + keyword highlight
                                     markdown_raw = raw_text or ""
@@ -1548,25 +6491,100 @@ def render_submission_ocr_tab():
                                     st.session_state.ocr_files[idx] = file_info
                                     add_combat_log(f"{fname} 已完成 Python OCR。", "success")
 
+                                elif ocr_backend.startswith("自動"):
+                                    # Hybrid path: text layer where usable, Tesseract elsewhere
+                                    ocr_progress = st.progress(0.0)
+                                    raw_text, decisions = extract_pdf_hybrid(
+                                        file_info["bytes"],
+                                        pages,
+                                        lang_code,
+                                        digest=file_info.get("sha256"),
+                                        progress=lambda done, total: ocr_progress.progress(
+                                            done / total, text=f"處理第 {done}/{total} 頁"
+                                        ),
+                                    )
+                                    n_ocr = sum(1 for d in decisions if d["method"] == "ocr")
+                                    st.caption(
+                                        f"📑 {len(decisions) - n_ocr} 頁使用文字層，{n_ocr} 頁以 OCR 辨識。"
+                                    )
+                                    with st.expander("逐頁判斷結果", expanded=False):
+                                        table_md = "| 頁 | 方式 | 字元數 | 亂碼比例 | 說明 |\n"
+                                        table_md += "|---|------|--------|----------|------|\n"
+                                        for d in decisions:
+                                            method = "文字層" if d["method"] == "text" else f"OCR ({d.get('lang', '')})"
+                                            table_md += (
+                                                f"| {d['page']} | {method} | {d['chars']} "
+                                                f"| {d['garbage_ratio']:.0%} | {d['reason']} |\n"
+                                            )
+                                        st.markdown(table_md)
+
+                                    kw_str = st.session_state.get("ocr_global_keywords", "")
+                                    keywords = [k for k in kw_str.split(",") if k.strip()]
+                                    file_info["markdown"] = highlight_keywords_in_text(
+                                        raw_text or "", keywords, "#FF7F50"
+                                    )
+                                    st.session_state.ocr_files[idx] = file_info
+                                    add_combat_log(
+                                        f"{fname} 已完成混合擷取（文字層 {len(decisions) - n_ocr} 頁／OCR {n_ocr} 頁）。",
+                                        "success",
+                                    )
+
                                 else:
                                     # LLM-based OCR / cleanup
-                                    text_extracted = extract_pdf_text(file_info["bytes"], pages)
+                                    page_texts = extract_pdf_page_texts(
+                                        file_info["bytes"], pages, file_info.get("sha256")
+                                    )
                                     llm_provider = st.session_state.get(f"{key_prefix}_llm_provider", "openai")
                                     llm_model = st.session_state.get(f"{key_prefix}_llm_model", "gpt-4o-mini")
-                                    llm_max_tokens = st.session_state.get(f"{key_prefix}_llm_max_tokens", 1500)
+                                    llm_max_tokens = st.session_state.get(f"{key_prefix}_llm_max_tokens", DEFAULT_MAX_TOKENS["ocr_cleanup"])
                                     llm_temp = st.session_state.get(f"{key_prefix}_llm_temp", 0.2)
                                     llm_system = st.session_state.get(
                                         f"{key_prefix}_llm_system_prompt",
                                         ADVANCED_OCR_SYSTEM_PROMPT.strip(),
                                     )
-                                    markdown = call_llm(
-                                        provider=llm_provider,
-                                        model=llm_model,
-                                        system_prompt=llm_system,
-                                        user_prompt=text_extracted,
-                                        max_tokens=int(llm_max_tokens),
-                                        temperature=float(llm_temp),
-                                    )
+                                    if st.session_state.get(f"{key_prefix}_llm_chunked", True):
+                                        chunk_progress = st.progress(0.0)
+
+                                        def report_chunk(done: int, total: int, chunk: Dict[str, Any]):
+                                            chunk_progress.progress(
+                                                done / total,
+                                                text=f"已完成第 {done}/{total} 段（頁 {chunk['pages'][0]}–{chunk['pages'][-1]}）",
+                                            )
+
+                                        markdown, chunks = run_chunked_llm_ocr(
+                                            page_texts,
+                                            provider=llm_provider,
+                                            model=llm_model,
+                                            system_prompt=llm_system,
+                                            max_tokens=int(llm_max_tokens),
+                                            temperature=float(llm_temp),
+                                            max_chars=int(st.session_state.get(
+                                                f"{key_prefix}_llm_chunk_chars", OCR_CHUNK_MAX_CHARS
+                                            )),
+                                            on_progress=report_chunk,
+                                        )
+                                        st.caption(f"🧩 共分 {len(chunks)} 段並行處理後合併。")
+                                        for label, flagged in (
+                                            ("處理失敗（已在結果中標示）", [c for c in chunks if c.get("error")]),
+                                            ("輸出達 token 上限、可能不完整", [c for c in chunks if c.get("truncated")]),
+                                        ):
+                                            if flagged:
+                                                st.warning(
+                                                    f"⚠️ {label}：第 "
+                                                    + "、".join(f"{c['pages'][0]}–{c['pages'][-1]}" for c in flagged)
+                                                    + " 頁"
+                                                )
+                                    else:
+                                        markdown = call_llm(
+                                            provider=llm_provider,
+                                            model=llm_model,
+                                            system_prompt=llm_system,
+                                            user_prompt="\n".join(
+                                                f"\n\n--- Page {p} ---\n\n{t}" for p, t in page_texts.items()
+                                            ).strip(),
+                                            max_tokens=int(llm_max_tokens),
+                                            temperature=float(llm_temp),
+                                        )
                                     file_info["markdown"] = markdown
                                     st.session_state.ocr_files[idx] = file_info
                                     add_combat_log(f"{fname} 已完成 LLM OCR / 清理。", "success")
@@ -1595,7 +6613,7 @@ def render_submission_ocr_tab():
                                 model=model,
                                 system_prompt=system_prompt,
                                 user_prompt=text_content,
-                                max_tokens=2000,
+                                max_tokens=DEFAULT_MAX_TOKENS["txt_format"],
                                 temperature=0.2,
                             )
                             file_info["markdown"] = markdown
@@ -1628,7 +6646,7 @@ def render_submission_ocr_tab():
                     )
                     sum_tokens = st.number_input(
                         "最大摘要 tokens",
-                        min_value=128, max_value=4096, value=800, step=64,
+                        min_value=128, max_value=4096, value=DEFAULT_MAX_TOKENS["summary"], step=64,
                         key=f"{key_prefix}_sum_tokens",
                     )
 
@@ -1675,23 +6693,63 @@ def render_submission_ocr_tab():
                         with st.expander("🔎 目前儲存的摘要", expanded=False):
                             st.markdown(file_info["summary"], unsafe_allow_html=True)
 
+        ready_files = [
+            (idx, f) for idx, f in enumerate(st.session_state.ocr_files) if f.get("markdown")
+        ]
+        if len(ready_files) > 1 and st.button(
+            f"🧾 同時為 {len(ready_files)} 份檔案產生摘要（使用各檔摘要設定）",
+            key="ocr_summarize_all",
+        ):
+            results = run_llm_calls_concurrently([
+                {
+                    "provider": st.session_state.get(f"ocr_{idx}_sum_provider", "openai"),
+                    "model": st.session_state.get(f"ocr_{idx}_sum_model", "gpt-4o-mini"),
+                    "system_prompt": st.session_state.get(f"ocr_{idx}_sum_prompt", ""),
+                    "user_prompt": f["markdown"],
+                    "max_tokens": int(st.session_state.get(f"ocr_{idx}_sum_tokens", DEFAULT_MAX_TOKENS["summary"])),
+                    "temperature": 0.3,
+                }
+                for idx, f in ready_files
+            ])
+            failed = False
+            for (idx, f), summary in zip(ready_files, results):
+                if isinstance(summary, Exception):
+                    st.error(f"{f['filename']} 產生摘要失敗：{summary}")
+                    failed = True
+                    continue
+                f["summary"] = summary
+                st.session_state.ocr_files[idx] = f
+                add_combat_log(f"{f['filename']} 已產生摘要。", "success")
+            if not failed:
+                st.rerun()
+
     # Combined analysis for all OCR documents
     st.markdown("---")
     st.markdown("### 🔗 整合所有 OCR 文件並執行跨文件分析")
 
-    all_markdowns = [
-        f"## File {i+1}: {f['filename']}\n\n{f.get('markdown','')}"
-        for i, f in enumerate(st.session_state.ocr_files)
-        if f.get("markdown")
-    ]
-    if all_markdowns:
-        combined_markdown = "\n\n---\n\n".join(all_markdowns)
+    corpus = get_combined_corpus()
+    changed = corpus.update(st.session_state.ocr_files)
+    if corpus.order:
+        if changed:
+            indexed = get_retrieval_index().sync(corpus.documents())
+            if indexed:
+                add_combat_log(f"檢索索引已更新 {indexed} 份文件。", "info")
+        combined_markdown = corpus.text
         st.session_state.combined_markdown = combined_markdown
 
-        with st.expander("📚 合併後 Markdown 預覽", expanded=False):
+        st.caption(
+            f"合併文件：{len(corpus.order)} 份 · {corpus.total_chars():,} 字元 · 版本 {corpus.fingerprint[:8]}"
+        )
+        # Rendering the full corpus is the expensive part of a rerun; only do it on request
+        if st.checkbox("📚 顯示合併後 Markdown 預覽", value=False, key="combined_preview_show"):
             st.markdown(combined_markdown, unsafe_allow_html=True)
 
         # Entity extraction across all files
+        render_corpus_cost_estimate(
+            st.session_state.get("default_provider", "openai"),
+            st.session_state.get("default_model", "gpt-4o-mini"),
+            corpus, DEFAULT_MAX_TOKENS["entities"],
+        )
         if st.button("🧬 從所有文件中抽取 20 個跨文件關鍵實體", key="combined_entities_run"):
             try:
                 provider = st.session_state.get("default_provider", "openai")
@@ -1722,7 +6780,7 @@ def render_submission_ocr_tab():
                     model=model,
                     system_prompt=system_prompt,
                     user_prompt=user_prompt,
-                    max_tokens=2000,
+                    max_tokens=DEFAULT_MAX_TOKENS["entities"],
                     temperature=0.2,
                 )
                 raw_str = raw.strip().strip("```json").strip("```").strip()
@@ -1730,12 +6788,15 @@ def render_submission_ocr_tab():
                 if not isinstance(entities, list):
                     raise ValueError("回傳內容並非 JSON 陣列。")
                 st.session_state.combined_entities = entities
+                st.session_state.combined_entities_fingerprint = corpus.fingerprint
                 add_combat_log("完成跨文件 20 個關鍵實體抽取。", "success")
             except Exception as e:
                 st.error(f"跨文件實體抽取失敗：{e}")
 
         if st.session_state.combined_entities:
             st.markdown("#### 🧬 跨文件關鍵實體表格")
+            if st.session_state.get("combined_entities_fingerprint") != corpus.fingerprint:
+                st.warning("⚠️ 文件內容已於抽取後變更，下列實體可能已過時，建議重新抽取。")
             table_md = "| id | name | type | description | source_files | context_snippet |\n"
             table_md += "|---|------|------|-------------|--------------|-----------------|\n"
             for ent in st.session_state.combined_entities:
@@ -1783,7 +6844,7 @@ def render_submission_ocr_tab():
         with col_q3:
             qa_max_tokens = st.number_input(
                 "最大回答 tokens",
-                min_value=128, max_value=4096, value=1200, step=64,
+                min_value=128, max_value=4096, value=DEFAULT_MAX_TOKENS["qa"], step=64,
                 key="combined_qa_max_tokens",
             )
         with col_q4:
@@ -1793,6 +6854,32 @@ def render_submission_ocr_tab():
                 key="combined_qa_temp",
             )
 
+        col_r1, col_r2, col_r3 = st.columns(3)
+        with col_r1:
+            qa_use_retrieval = st.checkbox(
+                "僅送出檢索到的相關段落",
+                value=True,
+                key="combined_qa_retrieval",
+                help="以 BM25 從各檔案段落中檢索最相關內容，取代送出整份合併文件。",
+            )
+        with col_r2:
+            qa_top_k = st.number_input(
+                "檢索段落數 (top-k)",
+                min_value=1, max_value=50, value=RETRIEVAL_TOP_K, step=1,
+                key="combined_qa_top_k",
+            )
+        with col_r3:
+            qa_vector_rerank = st.checkbox(
+                "向量重排（本地字元 n-gram）",
+                value=False,
+                key="combined_qa_vector_rerank",
+            )
+
+        if not qa_use_retrieval:
+            render_corpus_cost_estimate(
+                qa_provider, qa_model, corpus, int(qa_max_tokens), question=qa_prompt
+            )
+
         if st.button("💬 針對合併文件執行提問", key="combined_qa_run"):
             if not qa_prompt.strip():
                 st.warning("請先輸入提問內容。")
@@ -1808,26 +6895,59 @@ def render_submission_ocr_tab():
                         "- Clearly distinguish hypotheses from explicit evidence.\n"
                         "Output: A structured Markdown answer (with headings and bullet lists) aimed at regulatory reviewers."
                     )
-                    user_prompt = (
-                        "=== COMBINED OCR DOCUMENTS START ===\n"
-                        f"{st.session_state.combined_markdown}\n"
-                        "=== COMBINED OCR DOCUMENTS END ===\n\n"
-                        f"User question:\n{qa_prompt}"
-                    )
-                    answer = call_llm(
+                    if qa_use_retrieval:
+                        hits = get_retrieval_index().search(
+                            qa_prompt, int(qa_top_k), vector_rerank=qa_vector_rerank
+                        )
+                        if not hits:
+                            st.warning("未檢索到相關段落，改為送出整份合併文件。")
+                    else:
+                        hits = []
+                    if hits:
+                        with st.expander(f"🔎 檢索到的 {len(hits)} 個段落", expanded=False):
+                            for h in hits:
+                                st.markdown(f"**{h['filename']}** · score {h['score']}")
+                                st.text(h["text"][:500])
+                        user_prompt = (
+                            "=== RETRIEVED PASSAGES START (each tagged with its source file) ===\n"
+                            f"{format_retrieved_passages(hits)}\n"
+                            "=== RETRIEVED PASSAGES END ===\n\n"
+                            f"User question:\n{qa_prompt}"
+                        )
+                    else:
+                        corpus_block = (
+                            "=== COMBINED OCR DOCUMENTS START ===\n"
+                            f"{st.session_state.combined_markdown}\n"
+                            "=== COMBINED OCR DOCUMENTS END ==="
+                        )
+                        # The corpus joins the system prompt so every follow-up question
+                        # shares the same cacheable prefix; only an oversized corpus
+                        # stays in the user prompt where the token budget can trim it
+                        corpus_system = f"{system_prompt}\n\n{corpus_block}"
+                        question = f"User question:\n{qa_prompt}"
+                        if prompt_budget(
+                            qa_provider, qa_model, corpus_system, question, int(qa_max_tokens)
+                        )["fits"]:
+                            system_prompt, user_prompt = corpus_system, question
+                        else:
+                            user_prompt = f"{corpus_block}\n\n{question}"
+                    st.markdown("#### 回答")
+                    render_answer = make_stream_renderer(st.empty(), allow_html=True)
+                    for chunk in call_llm(
                         provider=qa_provider,
                         model=qa_model,
                         system_prompt=system_prompt,
                         user_prompt=user_prompt,
                         max_tokens=int(qa_max_tokens),
                         temperature=float(qa_temp),
-                    )
+                        stream=True,
+                    ):
+                        render_answer(chunk)
+                    answer = render_answer(None)
                     st.session_state.combined_qa_history.append(
-                        {"question": qa_prompt, "answer": answer}
+                        {"question": qa_prompt, "answer": answer, "fingerprint": corpus.fingerprint}
                     )
                     st.success("✅ 已根據合併文件完成回答。")
-                    st.markdown("#### 回答")
-                    st.markdown(answer, unsafe_allow_html=True)
                 except Exception as e:
                     st.error(f"合併文件提問失敗：{e}")
 
@@ -1835,6 +6955,8 @@ def render_submission_ocr_tab():
             with st.expander("🧾 歷史 Q&A", expanded=False):
                 for i, qa in enumerate(reversed(st.session_state.combined_qa_history), start=1):
                     st.markdown(f"**Q{i}:** {qa['question']}")
+                    if qa.get("fingerprint") != corpus.fingerprint:
+                        st.caption("⚠️ 此回答基於較舊版本的文件。")
                     st.markdown(qa["answer"], unsafe_allow_html=True)
                     st.markdown("---")
 
@@ -1855,14 +6977,17 @@ def render_dashboard_tab():
     with col2:
         st.metric("已完成案件數", st.session_state.quests_completed)
     with col3:
-        st.metric("LLM 呼叫次數", len(st.session_state.combat_log))
+        st.metric(
+            "LLM 呼叫次數",
+            len(get_llm_telemetry().records(st.session_state.get("telemetry_session"))),
+        )
     with col4:
         st.metric("已執行流程數", len(st.session_state.pipeline_history))
 
     st.markdown("---")
 
-    dash_tab1, dash_tab2, dash_tab3, dash_tab4 = st.tabs(
-        ["案件歷程", "活動紀錄", "里程碑", "互動分析圖"]
+    dash_tab1, dash_tab2, dash_tab3, dash_tab4, dash_tab5 = st.tabs(
+        ["案件歷程", "活動紀錄", "里程碑", "互動分析圖", "模型呼叫遙測"]
     )
 
     with dash_tab1:
@@ -1879,9 +7004,42 @@ def render_dashboard_tab():
 
     with dash_tab2:
         st.markdown("### 📑 完整活動紀錄")
-        if st.session_state.combat_log:
-            for entry in reversed(st.session_state.combat_log):
-                st.markdown(f"{entry['icon']} {entry['message']}")
+        activity_log = get_activity_log()
+        if activity_log.total:
+            counts = activity_log.type_counts()
+            col_f1, col_f2, col_f3 = st.columns([2, 2, 1])
+            with col_f1:
+                types = st.multiselect(
+                    "類型",
+                    options=list(ACTIVITY_LOG_ICONS),
+                    default=list(ACTIVITY_LOG_ICONS),
+                    format_func=lambda t: f"{ACTIVITY_LOG_ICONS[t]} {t}（{counts.get(t, 0)}）",
+                    key="activity_log_types",
+                )
+            with col_f2:
+                query = st.text_input("搜尋", key="activity_log_query")
+            with col_f3:
+                window = st.number_input(
+                    "顯示筆數", min_value=20, max_value=ACTIVITY_LOG_MAX_ENTRIES,
+                    value=min(200, ACTIVITY_LOG_MAX_ENTRIES), step=20, key="activity_log_window",
+                )
+            entries = activity_log.entries(
+                types=None if len(types) == len(ACTIVITY_LOG_ICONS) else types,
+                query=query,
+                limit=int(window),
+            )
+            st.caption(
+                f"共 {activity_log.total:,} 筆，記憶體中保留最近 {len(activity_log):,} 筆"
+                + ("，較舊紀錄已寫入磁碟" if activity_log.spill_path else "")
+                + f"；符合條件顯示 {len(entries):,} 筆。"
+            )
+            render_log_block(entries, height=480)
+            st.download_button(
+                "⬇️ 下載完整活動紀錄（JSONL）",
+                data=activity_log.export_jsonl(),
+                file_name="activity_log.jsonl",
+                mime="application/json",
+            )
         else:
             st.info("尚無活動紀錄。")
 
@@ -1893,7 +7051,7 @@ def render_dashboard_tab():
             achievements.append("🎖️ 進階審查官：審查成熟度等級達 5。")
         if st.session_state.quests_completed >= 10:
             achievements.append("📜 案件達人：完成 10 件以上案件流程。")
-        if len(st.session_state.combat_log) >= 50:
+        if get_activity_log().total >= 50:
             achievements.append("📈 高度互動：已執行超過 50 次模型呼叫或操作。")
         if st.session_state.player_level >= 10:
             achievements.append("👑 資深審查架構師：審查成熟度等級達 10。")
@@ -1930,6 +7088,94 @@ def render_dashboard_tab():
             )
             st.altair_chart(chart, use_container_width=True)
 
+    with dash_tab5:
+        render_llm_telemetry()
+
+def render_llm_telemetry():
+    """Per-agent latency, token and cost breakdown from the call telemetry"""
+    st.markdown("### ⏱️ 模型呼叫遙測（延遲 / Token / 成本）")
+    all_sessions = st.checkbox(
+        "包含所有工作階段", value=False, key="telemetry_all_sessions",
+        help="預設僅顯示本工作階段的呼叫；勾選後顯示此伺服器程序保留的全部紀錄。",
+    )
+    records = get_llm_telemetry().records(
+        None if all_sessions else st.session_state.get("telemetry_session")
+    )
+    if not records:
+        st.info("尚無模型呼叫紀錄。")
+        return
+
+    sent = [r for r in records if r["status"] == "ok"]
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("呼叫數（含快取命中）", len(records))
+    with col2:
+        p95 = percentile([r["total_s"] for r in sent], 95)
+        st.metric("整體 p95 延遲", f"{p95:.2f} 秒" if p95 is not None else "—")
+    with col3:
+        st.metric("錯誤數", sum(1 for r in records if r["status"] == "error"))
+    with col4:
+        st.metric("成本（USD）", f"${sum(r['cost'] for r in records):.4f}")
+    if any(r["cost_estimated"] for r in records):
+        st.caption("部分呼叫未取得供應商回報的 token 用量，其成本以預估值計入。")
+
+    rows = summarize_llm_calls(records)
+    st.dataframe(
+        [
+            {
+                **row,
+                **{
+                    k: round(row[k], 3) if row[k] is not None else None
+                    for k in ("p50_s", "p95_s", "p50_ttfb_s", "p50_queue_s")
+                },
+                "cost": round(row["cost"], 4),
+            }
+            for row in rows
+        ],
+        use_container_width=True,
+    )
+
+    latency = [
+        {"agent_id": row["agent_id"], "percentile": name, "seconds": row[key]}
+        for row in rows
+        for name, key in (("p50", "p50_s"), ("p95", "p95_s"))
+        if row[key] is not None
+    ]
+    if latency:
+        chart = (
+            alt.Chart(alt.Data(values=latency))
+            .mark_bar()
+            .encode(
+                x=alt.X("agent_id:N", title="Agent ID", sort="-y"),
+                y=alt.Y("seconds:Q", title="延遲（秒）"),
+                xOffset="percentile:N",
+                color=alt.Color("percentile:N", title="百分位"),
+                tooltip=["agent_id:N", "percentile:N", alt.Tooltip("seconds:Q", format=".2f")],
+            )
+            .properties(height=300, title="各代理延遲 p50 / p95")
+        )
+        st.altair_chart(chart, use_container_width=True)
+
+    chart = (
+        alt.Chart(alt.Data(values=[{"agent_id": r["agent_id"], "cost": r["cost"]} for r in rows]))
+        .mark_bar(cornerRadiusTopLeft=6, cornerRadiusTopRight=6)
+        .encode(
+            x=alt.X("agent_id:N", title="Agent ID", sort="-y"),
+            y=alt.Y("cost:Q", title="成本（USD）"),
+            tooltip=["agent_id:N", alt.Tooltip("cost:Q", format=".4f")],
+            color=alt.Color("cost:Q", scale=alt.Scale(scheme="oranges"), legend=None),
+        )
+        .properties(height=300, title="各代理成本")
+    )
+    st.altair_chart(chart, use_container_width=True)
+
+    st.download_button(
+        "⬇️ 下載呼叫紀錄（JSONL）",
+        data="".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records),
+        file_name="llm_calls.jsonl",
+        mime="application/json",
+    )
+
 # -----------------------------------------------------------
 # Main Entry Point
 # -----------------------------------------------------------
@@ -1945,8 +7191,18 @@ def main():
 
     init_session_state()
     apply_custom_css()
-    config = load_agents_config()
-    render_enhanced_sidebar(config)
+    try:
+        registry = get_agent_registry()
+    except AgentConfigError as e:
+        st.error("❌ agents.yaml 設定錯誤：\n\n" + "\n".join(f"- {p}" for p in e.problems))
+        st.stop()
+    reload_error = get_agent_registry_cache().errors.get(registry.path)
+    if reload_error is not None:
+        st.warning(
+            "⚠️ agents.yaml 已變更但無法載入，仍使用上一版設定：\n\n"
+            + "\n".join(f"- {p}" for p in reload_error.problems)
+        )
+    render_enhanced_sidebar(registry)
 
     st.markdown(f"# 🏥 {get_translation('title')}")
     st.markdown(f"_{get_translation('subtitle')}_")
@@ -1968,7 +7224,7 @@ def main():
         render_input_tab()
 
     with tab_pipeline:
-        render_pipeline_tab(config)
+        render_pipeline_tab(registry)
 
     with tab_smart:
         render_smart_replace_tab()
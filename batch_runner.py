@@ -0,0 +1,496 @@
+"""
+Headless batch runner: run one agents.yaml pipeline across many 510(k) cases.
+
+Cases come from a JSONL file (one object per line) or a directory:
+
+    {"id": "K231234", "template": "...", "observations": "...", "instructions": "..."}
+
+In a directory, every *.json file is one such object and every *.txt / *.md
+file is a case whose content is the template (id = file name without suffix).
+
+Results are appended to a JSONL file as each case finishes, so an interrupted
+run can be continued with --resume (finished cases are skipped, and the steps
+of unfinished cases are reused from the pipeline checkpoint store).
+
+    python batch_runner.py --pipeline zh_510k_precheck_pipeline \\
+        --cases cases.jsonl --output results.jsonl --concurrency 4 --resume
+
+With --deferred, all pending cases go through the OpenAI / Anthropic batch
+APIs instead (about half the price, results within 24h): each dependency
+level of the pipeline is one batch across every case, polled until it ends.
+Gemini and xAI steps are still called directly.
+
+API keys are read from OPENAI_API_KEY / GEMINI_API_KEY / XAI_API_KEY /
+ANTHROPIC_API_KEY.
+
+Token budgets: the whole run is ONE quota session, so by default every case
+together shares a single app session budget per provider (e.g. 2,000,000
+OpenAI tokens) and the daily budget shared with the app. Size the run with
+
+    python batch_runner.py ... --session-tokens 50000000
+
+(every provider; without the flag OPENAI_SESSION_TOKENS etc. set it per
+provider, and OPENAI_DAILY_TOKENS etc. the daily budgets). The budgets in effect are
+printed when the run starts. A case whose estimated tokens no longer fit is
+recorded as an error without calling any model, and can be rerun later with
+--resume.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+from streamlit import logger as streamlit_logger
+
+import app
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CASE_TEXT_SUFFIXES = (".txt", ".md")
+
+
+def iter_cases(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield case dicts with at least id and template from a JSONL file or directory."""
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            full = os.path.join(path, name)
+            stem, suffix = os.path.splitext(name)
+            if suffix == ".json":
+                with open(full, "r", encoding="utf-8") as f:
+                    case = json.load(f)
+                case.setdefault("id", stem)
+            elif suffix in CASE_TEXT_SUFFIXES:
+                with open(full, "r", encoding="utf-8", errors="ignore") as f:
+                    case = {"id": stem, "template": f.read()}
+            else:
+                continue
+            yield case
+        return
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            case = json.loads(line)
+            case.setdefault("id", f"line-{line_no}")
+            yield case
+
+
+def completed_case_ids(output_path: str) -> Set[str]:
+    """Ids of cases that already finished successfully in an earlier run."""
+    done: Set[str] = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by an interrupted run
+            if record.get("status") == "ok":
+                done.add(str(record.get("case_id")))
+    return done
+
+
+def usage_fields(usage: Dict[str, float]) -> Dict[str, Any]:
+    """Result-record fields from a case's quota reservation usage."""
+    return {
+        "llm_calls": int(usage["calls"]),
+        "input_tokens": int(usage["input_tokens"]),
+        "output_tokens": int(usage["output_tokens"]),
+        "cached_tokens": int(usage["cached_tokens"]),
+        "estimated_cost_usd": round(usage["cost"], 6),
+    }
+
+
+class BatchRunner:
+    """Runs one pipeline per case with bounded case-level concurrency."""
+
+    def __init__(
+        self,
+        registry: app.AgentRegistry,
+        pipeline_id: str,
+        provider: Optional[str] = None,
+        model: Optional[str] = None,
+        max_tokens: int = app.DEFAULT_MAX_TOKENS["chat"],
+        temperature: float = 0.2,
+        step_concurrency: Optional[int] = None,
+        use_checkpoints: bool = True,
+        budget_policy: str = app.DEFAULT_TOKEN_BUDGET_POLICY,
+    ):
+        if pipeline_id not in registry.pipelines:
+            raise KeyError(
+                f"Unknown pipeline '{pipeline_id}'. Available: {', '.join(sorted(registry.pipelines))}"
+            )
+        self.pipeline = registry.pipelines[pipeline_id]
+        self.steps = registry.pipeline_steps(pipeline_id)
+        self.agents_by_id = registry.agents
+        self.provider = provider
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.step_concurrency = step_concurrency or int(
+            self.pipeline.get("max_concurrency", app.DEFAULT_PIPELINE_CONCURRENCY)
+        )
+        self.use_checkpoints = use_checkpoints
+        self.budget_policy = budget_policy
+
+    def step_call(self, step: Dict[str, Any], step_input: str) -> Dict[str, Any]:
+        return app.resolve_agent_call(
+            self.agents_by_id[step["agent_id"]],
+            step_input,
+            override_provider=self.provider,
+            override_model=self.model,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+
+    async def run_case(self, case: Dict[str, Any]) -> Dict[str, Any]:
+        raw_input = app.build_pipeline_raw_input(
+            case.get("template", ""), case.get("observations", ""), case.get("instructions", "")
+        )
+        reused: List[str] = []
+
+        async def call_step(step: Dict[str, Any], step_input: str) -> str:
+            return await app.acall_llm(
+                **self.step_call(step, step_input), budget_policy=self.budget_policy
+            )
+
+        run_step = app.with_checkpoints(
+            call_step,
+            self.pipeline["id"],
+            raw_input,
+            lambda step, step_input: app.step_fingerprint(self.step_call(step, step_input)),
+            reuse=self.use_checkpoints,
+            on_reuse=lambda step, output: reused.append(step["id"]),
+        )
+        record: Dict[str, Any] = {
+            "case_id": str(case["id"]),
+            "pipeline_id": self.pipeline["id"],
+        }
+        started = time.perf_counter()
+        reservation = quota_token = None
+        try:
+            # Reserve the case's estimated tokens before any step is sent
+            reservation = app.reserve_pipeline_quota(self.steps, raw_input, self.step_call)
+            quota_token = app.quota_reservation.set(reservation)
+            outputs = await app.aexecute_pipeline_dag(
+                self.steps, raw_input, run_step, max_concurrency=self.step_concurrency
+            )
+            record.update(
+                status="ok",
+                error=None,
+                outputs={s["id"]: outputs[s["id"]] for s in self.steps},
+                final_output=outputs[self.steps[-1]["id"]],
+            )
+        except app.QuotaExceededError as e:
+            record.update(status="error", error=f"quota: {e}", outputs={}, final_output=None)
+        except app.PipelineStepError as e:
+            record.update(
+                status="error",
+                error=f"{e.step['id']}: {e.error}",
+                outputs=dict(e.outputs),
+                final_output=None,
+            )
+        finally:
+            if reservation is not None:
+                app.quota_reservation.reset(quota_token)
+                app.release_quota_reservation(reservation)
+        record.update(
+            elapsed_s=round(time.perf_counter() - started, 3),
+            reused_steps=reused,
+            **usage_fields(reservation.usage if reservation is not None else app.new_llm_usage()),
+        )
+        return record
+
+    async def run(
+        self,
+        cases: List[Dict[str, Any]],
+        output_path: str,
+        concurrency: int,
+    ) -> List[Dict[str, Any]]:
+        """Run cases, appending each record to output_path as soon as it finishes."""
+        limit = asyncio.Semaphore(max(1, concurrency))
+        records: List[Dict[str, Any]] = []
+        total = len(cases)
+
+        async def run_limited(case: Dict[str, Any]) -> Dict[str, Any]:
+            async with limit:
+                return await self.run_case(case)
+
+        with open(output_path, "a", encoding="utf-8") as out:
+            for finished in asyncio.as_completed([run_limited(c) for c in cases]):
+                record = await finished
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                records.append(record)
+                mark = "✓" if record["status"] == "ok" else "✗"
+                print(
+                    f"[{len(records)}/{total}] {mark} {record['case_id']}"
+                    f"  {record['elapsed_s']:.1f}s  {record['llm_calls']} calls"
+                    f"  ${record['estimated_cost_usd']:.4f}"
+                    + (f"  {record['error']}" if record["error"] else ""),
+                    file=sys.stderr,
+                    flush=True,
+                )
+        return records
+
+    def run_deferred(
+        self,
+        cases: List[Dict[str, Any]],
+        output_path: str,
+        poll_interval: float = app.BATCH_POLL_SECONDS,
+    ) -> List[Dict[str, Any]]:
+        """Run every case through provider batch APIs, one batch per pipeline level."""
+        jobs = {
+            str(c["id"]): app.build_pipeline_raw_input(
+                c.get("template", ""), c.get("observations", ""), c.get("instructions", "")
+            )
+            for c in cases
+        }
+        # Reserve each case's estimated tokens up front; cases that do not fit
+        # are recorded as quota errors and left out of the batches
+        reservations: Dict[str, "app.QuotaReservation"] = {}
+        results: Dict[str, Any] = {}
+        for job_id, raw_input in list(jobs.items()):
+            try:
+                reservations[job_id] = app.reserve_pipeline_quota(self.steps, raw_input, self.step_call)
+            except app.QuotaExceededError as e:
+                results[job_id] = e
+                del jobs[job_id]
+        reused: Dict[str, List[str]] = {job_id: [] for job_id in jobs}
+        started = time.perf_counter()
+
+        def on_wave(wave: int, total: int, batch_set: "app.DeferredBatchSet"):
+            print(f"Level {wave}/{total}: {len(batch_set)} requests queued", file=sys.stderr, flush=True)
+
+        def on_poll(statuses: Dict[str, str]):
+            print(
+                "  " + "  ".join(f"{p}: {s}" for p, s in statuses.items()),
+                file=sys.stderr,
+                flush=True,
+            )
+
+        try:
+            results.update(app.execute_pipelines_deferred(
+                self.steps,
+                jobs,
+                lambda job_id, step, step_input: dict(
+                    self.step_call(step, step_input), budget_policy=self.budget_policy
+                ),
+                pipeline_id=self.pipeline["id"] if self.use_checkpoints else None,
+                reuse_checkpoints=self.use_checkpoints,
+                poll_interval=poll_interval,
+                on_wave=on_wave,
+                on_poll=on_poll,
+                reservations=reservations,
+                on_reuse=lambda job_id, step: reused[job_id].append(step["id"]),
+            ))
+        finally:
+            for reservation in reservations.values():
+                app.release_quota_reservation(reservation)
+        elapsed = round(time.perf_counter() - started, 3)
+
+        records: List[Dict[str, Any]] = []
+        with open(output_path, "a", encoding="utf-8") as out:
+            for job_id, result in results.items():
+                record: Dict[str, Any] = {"case_id": job_id, "pipeline_id": self.pipeline["id"]}
+                if isinstance(result, app.QuotaExceededError):
+                    record.update(status="error", error=f"quota: {result}", outputs={}, final_output=None)
+                elif isinstance(result, app.PipelineStepError):
+                    record.update(
+                        status="error",
+                        error=f"{result.step['id']}: {result.error}",
+                        outputs=dict(result.outputs),
+                        final_output=None,
+                    )
+                else:
+                    record.update(
+                        status="ok",
+                        error=None,
+                        outputs={s["id"]: result[s["id"]] for s in self.steps},
+                        final_output=result[self.steps[-1]["id"]],
+                    )
+                reservation = reservations.get(job_id)
+                record.update(
+                    elapsed_s=elapsed,
+                    reused_steps=reused.get(job_id, []),
+                    **usage_fields(reservation.usage if reservation is not None else app.new_llm_usage()),
+                )
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                records.append(record)
+        return records
+
+
+def write_parquet(jsonl_path: str, parquet_path: str):
+    """Convert the latest record per case in the JSONL results to Parquet (needs pyarrow)."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+    latest: Dict[str, Dict[str, Any]] = {}
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            record["outputs"] = json.dumps(record.get("outputs", {}), ensure_ascii=False)
+            latest[record["case_id"]] = record
+    pq.write_table(pa.Table.from_pylist(list(latest.values())), parquet_path)
+
+
+def describe_skipped(resumed: int, limited: int) -> str:
+    """", N skipped as done, M left by --limit" (empty when nothing was skipped)."""
+    parts = []
+    if resumed:
+        parts.append(f"{resumed} skipped as done")
+    if limited:
+        parts.append(f"{limited} left by --limit")
+    return "".join(f", {p}" for p in parts)
+
+
+def print_summary(records: List[Dict[str, Any]], resumed: int = 0, limited: int = 0):
+    ok = sum(r["status"] == "ok" for r in records)
+    cost = sum(r["estimated_cost_usd"] for r in records)
+    tokens_in = sum(r["input_tokens"] for r in records)
+    tokens_out = sum(r["output_tokens"] for r in records)
+    print(
+        f"\nCases: {len(records)} run ({ok} ok, {len(records) - ok} failed)"
+        f"{describe_skipped(resumed, limited)}\n"
+        f"LLM calls: {sum(r['llm_calls'] for r in records)}  "
+        f"reused steps: {sum(len(r['reused_steps']) for r in records)}\n"
+        f"Tokens: {tokens_in:,} in / {tokens_out:,} out  "
+        f"estimated cost: ${cost:.4f}",
+        file=sys.stderr,
+    )
+    if records:
+        print("\nPer-case estimated cost:", file=sys.stderr)
+        for r in sorted(records, key=lambda r: r["estimated_cost_usd"], reverse=True):
+            print(
+                f"  {r['case_id']:<32} {r['status']:<6} {r['llm_calls']:>3} calls  ${r['estimated_cost_usd']:.4f}",
+                file=sys.stderr,
+            )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run an agents.yaml pipeline over many cases.")
+    parser.add_argument("--pipeline", required=True, help="pipeline id from agents.yaml")
+    parser.add_argument("--cases", required=True, help="JSONL file or directory of cases")
+    parser.add_argument("--output", required=True, help="JSONL results file (appended to)")
+    parser.add_argument("--parquet", help="also write the results as Parquet to this path")
+    parser.add_argument("--agents", default=os.path.join(BASE_DIR, "agents.yaml"))
+    parser.add_argument("--concurrency", type=int, default=4, help="cases run at once")
+    parser.add_argument("--step-concurrency", type=int, help="steps run at once within a case")
+    parser.add_argument("--provider", help="override every agent's provider")
+    parser.add_argument("--model", help="override every agent's model")
+    parser.add_argument("--max-tokens", type=int, default=app.DEFAULT_MAX_TOKENS["chat"])
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument(
+        "--budget-policy",
+        choices=list(app.TOKEN_BUDGET_POLICIES),
+        default=app.DEFAULT_TOKEN_BUDGET_POLICY,
+        help="what to do with prompts larger than the model's context window",
+    )
+    parser.add_argument("--resume", action="store_true", help="skip cases already ok in --output")
+    parser.add_argument(
+        "--no-checkpoints", action="store_true", help="do not reuse saved step outputs"
+    )
+    parser.add_argument("--limit", type=int, help="only run the first N pending cases")
+    parser.add_argument(
+        "--deferred",
+        action="store_true",
+        help="use the OpenAI / Anthropic batch APIs (cheaper, slower) instead of direct calls",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=app.BATCH_POLL_SECONDS,
+        help="seconds between batch status checks with --deferred",
+    )
+    parser.add_argument(
+        "--session-tokens",
+        type=int,
+        help="token budget of this run per provider (the whole run is one quota session)",
+    )
+    return parser.parse_args(argv)
+
+
+def quiet_streamlit_logs():
+    """
+    Drop Streamlit warnings below ERROR. Outside `streamlit run`, every cache
+    and session_state access logs "missing ScriptRunContext" from its own
+    module logger (streamlit.runtime.scriptrunner_utils.script_run_context,
+    ...), which does not propagate to the "streamlit" logger; set_log_level
+    covers those and the ones created later.
+    """
+    streamlit_logger.set_log_level(logging.ERROR)
+
+
+def apply_session_budget(session_tokens: Optional[int]):
+    """Set the run's per-provider session budget and print the budgets in effect."""
+    if session_tokens is not None:
+        for provider in app.PROVIDER_TOKEN_BUDGETS:
+            os.environ[f"{provider.upper()}_SESSION_TOKENS"] = str(session_tokens)
+    budgets = {p: app.provider_token_budgets(p) for p in app.PROVIDER_TOKEN_BUDGETS}
+    print(
+        "Token budgets (this run / today): "
+        + ", ".join(f"{p} {b['session']:,} / {b['daily']:,}" for p, b in budgets.items()),
+        file=sys.stderr,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    quiet_streamlit_logs()
+    apply_session_budget(args.session_tokens)
+
+    try:
+        registry = app.AgentRegistry.compile(args.agents)
+    except app.AgentConfigError as e:
+        raise SystemExit("agents.yaml is invalid:\n" + "\n".join(f"  - {p}" for p in e.problems))
+    runner = BatchRunner(
+        registry,
+        args.pipeline,
+        provider=args.provider,
+        model=args.model,
+        max_tokens=args.max_tokens,
+        temperature=args.temperature,
+        step_concurrency=args.step_concurrency,
+        use_checkpoints=not args.no_checkpoints,
+        budget_policy=args.budget_policy,
+    )
+
+    cases = list(iter_cases(args.cases))
+    ids = [str(c["id"]) for c in cases]
+    if len(set(ids)) != len(ids):
+        raise SystemExit("Case ids must be unique.")
+    done = completed_case_ids(args.output) if args.resume else set()
+    pending = [c for c in cases if str(c["id"]) not in done]
+    resumed = len(cases) - len(pending)
+    if args.limit is not None:
+        pending = pending[: args.limit]
+    limited = len(cases) - resumed - len(pending)
+    print(
+        f"Pipeline {args.pipeline}: {len(runner.steps)} steps, {len(pending)} cases to run"
+        f"{describe_skipped(resumed, limited)}",
+        file=sys.stderr,
+    )
+
+    if args.deferred:
+        records = runner.run_deferred(pending, args.output, args.poll_interval)
+    else:
+        records = app.run_async(lambda: runner.run(pending, args.output, args.concurrency))
+    print_summary(records, resumed=resumed, limited=limited)
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+    return 0 if all(r["status"] == "ok" for r in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
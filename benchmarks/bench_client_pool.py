@@ -0,0 +1,86 @@
+"""
+Per-call client overhead: fresh SDK client per call vs. pooled registry client.
+
+Runs a 10-step pipeline (10 sequential chat completions) against the local mock
+server, first constructing ``OpenAI(...)`` for every step (the old ``call_llm``
+behaviour) and then through ``ProviderClientRegistry``.
+
+    python benchmarks/bench_client_pool.py --runs 20
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mock_llm_server import start_mock_server  # noqa: E402
+
+PIPELINE_STEPS = 10
+
+
+def _run_pipeline(get_client, model: str) -> float:
+    start = time.perf_counter()
+    current = "【510(k) 案件輸入】benchmark"
+    for _ in range(PIPELINE_STEPS):
+        client = get_client()
+        resp = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "benchmark"},
+                {"role": "user", "content": current},
+            ],
+            max_tokens=16,
+            temperature=0.0,
+        )
+        current = resp.choices[0].message.content
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pooled vs. per-call provider clients")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="mock server latency per request (s)")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(latency_s=args.latency)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    api_key = "sk-benchmark"
+
+    from openai import OpenAI
+    import app
+
+    def fresh_client():
+        return OpenAI(api_key=api_key)
+
+    registry = app.ProviderClientRegistry()
+
+    def pooled_client():
+        return registry.get("openai", api_key)
+
+    results = {}
+    for label, factory in (("fresh client per call", fresh_client), ("pooled registry", pooled_client)):
+        _run_pipeline(factory, "mock-model")  # warm-up (imports, DNS, first pool)
+        conns_before = server.stats["connections"]
+        timings = [_run_pipeline(factory, "mock-model") for _ in range(args.runs)]
+        results[label] = (timings, server.stats["connections"] - conns_before)
+
+    registry.close_all()
+    server.shutdown()
+
+    print(f"{PIPELINE_STEPS}-step pipeline x {args.runs} runs against {base_url}")
+    for label, (timings, conns) in results.items():
+        per_call_ms = statistics.mean(timings) / PIPELINE_STEPS * 1000
+        print(
+            f"  {label:<22} median {statistics.median(timings) * 1000:8.1f} ms/pipeline"
+            f"  {per_call_ms:6.2f} ms/call  {conns:4d} TCP connections"
+        )
+    fresh = statistics.mean(results["fresh client per call"][0])
+    pooled = statistics.mean(results["pooled registry"][0])
+    print(f"  per-call overhead removed: {(fresh - pooled) / PIPELINE_STEPS * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
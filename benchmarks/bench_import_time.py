@@ -0,0 +1,113 @@
+"""
+Cold-start import cost of app.py, measured with ``python -X importtime``.
+
+Imports ``app`` in a fresh interpreter (several runs, median reported), prints
+the slowest top-level imports and fails when a heavy SDK or PDF / OCR library is
+imported at startup, or when the import takes longer than ``--max-ms``:
+
+    python benchmarks/bench_import_time.py --runs 5 --max-ms 1500
+
+Exit status is non-zero on failure, so the script can run as a CI check.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Modules that must only be imported when a provider or feature is first used
+LAZY_MODULES = (
+    "openai",
+    "anthropic",
+    "google.generativeai",
+    "xai_sdk",
+    "altair",
+    "PyPDF2",
+    "pdf2image",
+    "pytesseract",
+    "fitz",
+    "tiktoken",
+)
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)\s*$")
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """(module, self_us, cumulative_us, depth) for every line of -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            depth = (len(m.group(3)) - 1) // 2
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2)), depth))
+    return rows
+
+
+def measure_once() -> List[Tuple[str, int, int, int]]:
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr[-4000:])
+        raise SystemExit(f"import app failed (exit {proc.returncode})")
+    return parse_importtime(proc.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time budget for app.py")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest top-level imports to list")
+    parser.add_argument("--max-ms", type=float, default=0.0, help="fail above this median (0 = no limit)")
+    args = parser.parse_args()
+
+    totals: List[float] = []
+    per_module: Dict[str, List[int]] = {}
+    eager: set = set()
+    for _ in range(max(1, args.runs)):
+        rows = measure_once()
+        imported = {name for name, _self, _cum, _depth in rows}
+        eager.update(m for m in LAZY_MODULES if m in imported)
+        # Children are printed before their parent: app's direct imports are
+        # the depth-1 rows between the previous top-level row and app itself
+        app_index = next(i for i, row in enumerate(rows) if row[0] == "app" and row[3] == 0)
+        totals.append(rows[app_index][2] / 1000.0)
+        for name, _self, cumulative, depth in reversed(rows[:app_index]):
+            if depth == 0:
+                break
+            if depth == 1:
+                per_module.setdefault(name, []).append(cumulative)
+
+    median_ms = statistics.median(totals)
+    print(f"import app: median {median_ms:.0f} ms over {len(totals)} runs "
+          f"(min {min(totals):.0f} ms, max {max(totals):.0f} ms)")
+    print("\nSlowest imports made by app.py (median cumulative):")
+    slowest = sorted(
+        ((statistics.median(v) / 1000.0, k) for k, v in per_module.items()), reverse=True
+    )[: args.top]
+    for ms, name in slowest:
+        print(f"  {ms:8.1f} ms  {name}")
+
+    failed = False
+    if eager:
+        print(f"\nFAIL: imported at startup, should be lazy: {', '.join(sorted(eager))}")
+        failed = True
+    if args.max_ms and median_ms > args.max_ms:
+        print(f"\nFAIL: median {median_ms:.0f} ms exceeds budget {args.max_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("\nOK: no lazy module imported at startup")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
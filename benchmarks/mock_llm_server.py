@@ -0,0 +1,312 @@
+"""
+Local mock of the provider HTTP APIs used by app.py.
+
+Serves OpenAI-style ``/v1/chat/completions`` and Anthropic-style ``/v1/messages``
+responses over keep-alive HTTP/1.1 and counts TCP connections, so benchmarks can
+show how many connections a workload actually opens.
+
+The batch APIs are mocked too (OpenAI ``/v1/files`` + ``/v1/batches``, Anthropic
+``/v1/messages/batches``): a batch ends ``--batch-delay`` seconds after it was
+created. Requests whose prompt contains ``MOCK_ERROR`` fail inside the batch.
+
+    python benchmarks/mock_llm_server.py --port 8765
+"""
+
+import argparse
+import itertools
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+MOCK_ERROR_MARKER = "MOCK_ERROR"
+_ids = itertools.count(1)
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def openai_completion(payload: Dict[str, Any]) -> Dict[str, Any]:
+    user_text = (payload.get("messages") or [{}])[-1].get("content", "")
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "mock"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": f"mock: {str(user_text)[:40]}"},
+        }],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    }
+
+
+def anthropic_message(payload: Dict[str, Any]) -> Dict[str, Any]:
+    user_text = (payload.get("messages") or [{}])[-1].get("content", "")
+    return {
+        "id": "msg_mock",
+        "type": "message",
+        "role": "assistant",
+        "model": payload.get("model", "mock"),
+        "content": [{"type": "text", "text": f"mock: {str(user_text)[:40]}"}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": 5},
+    }
+
+
+def _wants_error(payload: Dict[str, Any]) -> bool:
+    return MOCK_ERROR_MARKER in json.dumps(payload.get("messages", []), ensure_ascii=False)
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in one buffered write (flushed by the base class
+    # after each request) with TCP_NODELAY: separate small writes on a reused
+    # connection hit the ~40 ms Nagle / delayed-ACK stall, which would penalise
+    # exactly the keep-alive clients the benchmarks compare.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stats["connections"] += 1
+
+    def log_message(self, format, *args):  # keep benchmark output clean
+        pass
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+
+    def _send_bytes(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload: Dict[str, Any], status: int = 200):
+        self._send_bytes(json.dumps(payload).encode("utf-8"), "application/json", status)
+
+    def _not_found(self, path: str):
+        self._send_json({"error": {"message": f"unknown path {path}"}}, status=404)
+
+    def do_POST(self):
+        self.server.stats["requests"] += 1
+        if self.server.latency_s:
+            time.sleep(self.server.latency_s)
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/files"):
+            self._upload_file()
+            return
+        payload = self._read_json()
+
+        if path.endswith("/chat/completions"):
+            self._send_json(openai_completion(payload))
+        elif path.endswith("/messages"):
+            self._send_json(anthropic_message(payload))
+        elif path.endswith("/messages/batches"):
+            self._send_json(self._anthropic_batch(self._create_batch("anthropic", payload["requests"])))
+        elif path.endswith("/batches"):
+            content = self.server.files[payload["input_file_id"]]
+            requests = [json.loads(line) for line in content.decode("utf-8").splitlines() if line.strip()]
+            batch = self._create_batch("openai", requests)
+            batch["input_file_id"] = payload["input_file_id"]
+            self._send_json(self._openai_batch(batch))
+        else:
+            self._not_found(path)
+
+    def do_GET(self):
+        self.server.stats["requests"] += 1
+        path = self.path.split("?", 1)[0].rstrip("/")
+        parts = path.split("/")
+        batches = self.server.batches
+
+        if "/messages/batches/" in path:
+            batch = batches.get(parts[4] if len(parts) > 4 else "")
+            if batch is None:
+                self._not_found(path)
+            elif path.endswith("/results"):
+                lines = [json.dumps(r) for r in self._results(batch)]
+                self._send_bytes("\n".join(lines).encode("utf-8"), "application/x-jsonl")
+            else:
+                self._send_json(self._anthropic_batch(batch))
+        elif "/batches/" in path:
+            batch = batches.get(parts[-1])
+            if batch is None:
+                self._not_found(path)
+            else:
+                self._send_json(self._openai_batch(batch))
+        elif "/files/" in path and path.endswith("/content"):
+            content = self.server.files.get(parts[-2])
+            if content is None:
+                self._not_found(path)
+            else:
+                self._send_bytes(content, "application/octet-stream")
+        else:
+            self._not_found(path)
+
+    # -- batch helpers ------------------------------------------------------
+
+    def _upload_file(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        head = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode("ascii")
+        message = BytesParser(policy=HTTP).parsebytes(head + raw)
+        content = b""
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                content = part.get_payload(decode=True)
+        file_id = f"file-mock{next(_ids)}"
+        self.server.files[file_id] = content
+        self._send_json({
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": "requests.jsonl",
+            "purpose": "batch",
+            "status": "processed",
+        })
+
+    def _create_batch(self, kind: str, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        prefix = "msgbatch_mock" if kind == "anthropic" else "batch_mock"
+        batch = {
+            "id": f"{prefix}{next(_ids)}",
+            "kind": kind,
+            "requests": requests,
+            "created_at": time.time(),
+        }
+        self.server.batches[batch["id"]] = batch
+        self.server.stats["batches"] += 1
+        return batch
+
+    def _ended(self, batch: Dict[str, Any]) -> bool:
+        return time.time() - batch["created_at"] >= self.server.batch_delay_s
+
+    def _results(self, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        results = []
+        for request in batch["requests"]:
+            custom_id = request["custom_id"]
+            if batch["kind"] == "anthropic":
+                params = request["params"]
+                if _wants_error(params):
+                    result = {"type": "errored", "error": {
+                        "type": "error",
+                        "error": {"type": "invalid_request_error", "message": "mock error"},
+                    }}
+                else:
+                    result = {"type": "succeeded", "message": anthropic_message(params)}
+                results.append({"custom_id": custom_id, "result": result})
+            else:
+                body = request["body"]
+                if _wants_error(body):
+                    response = {"status_code": 400, "request_id": custom_id,
+                                "body": {"error": {"message": "mock error", "type": "invalid_request_error"}}}
+                else:
+                    response = {"status_code": 200, "request_id": custom_id, "body": openai_completion(body)}
+                results.append({"id": f"batch_req_{custom_id}", "custom_id": custom_id,
+                                "response": response, "error": None})
+        return results
+
+    def _openai_batch(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        ended = self._ended(batch)
+        if ended and "output_file_id" not in batch:
+            ok, failed = [], []
+            for result in self._results(batch):
+                (ok if result["response"]["status_code"] == 200 else failed).append(json.dumps(result))
+            for key, lines in (("output_file_id", ok), ("error_file_id", failed)):
+                file_id = None
+                if lines:
+                    file_id = f"file-mock{next(_ids)}"
+                    self.server.files[file_id] = "\n".join(lines).encode("utf-8")
+                batch[key] = file_id
+        total = len(batch["requests"])
+        return {
+            "id": batch["id"],
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "input_file_id": batch["input_file_id"],
+            "completion_window": "24h",
+            "status": "completed" if ended else "in_progress",
+            "output_file_id": batch.get("output_file_id"),
+            "error_file_id": batch.get("error_file_id"),
+            "created_at": int(batch["created_at"]),
+            "request_counts": {"total": total, "completed": total if ended else 0, "failed": 0},
+        }
+
+    def _anthropic_batch(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        ended = self._ended(batch)
+        total = len(batch["requests"])
+        host = self.headers.get("Host", "127.0.0.1")
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else total,
+                "succeeded": total if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": _iso(batch["created_at"]),
+            "expires_at": _iso(batch["created_at"] + 24 * 3600),
+            "ended_at": _iso(time.time()) if ended else None,
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": f"http://{host}/v1/messages/batches/{batch['id']}/results" if ended else None,
+        }
+
+
+def start_mock_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    latency_s: float = 0.0,
+    handler: Optional[type] = None,
+    batch_delay_s: float = 0.0,
+) -> Tuple[ThreadingHTTPServer, str]:
+    """Start the mock server on a background thread; returns (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), handler or MockLLMHandler)
+    server.daemon_threads = True
+    server.stats = {"connections": 0, "requests": 0, "batches": 0}
+    server.latency_s = latency_s
+    server.batch_delay_s = batch_delay_s
+    server.files = {}
+    server.batches = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="artificial latency per request (s)")
+    parser.add_argument("--batch-delay", type=float, default=0.0, help="seconds until a batch ends")
+    args = parser.parse_args()
+    server, base_url = start_mock_server(
+        args.host, args.port, args.latency, batch_delay_s=args.batch_delay
+    )
+    print(f"Mock LLM server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
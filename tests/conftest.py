@@ -0,0 +1,21 @@
+"""
+Shared setup: app.py is imported headless (no `streamlit run`), with its
+on-disk caches (response cache, checkpoints, quota ledger) in a throwaway
+directory and the mock provider server importable from benchmarks/.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# APP_CACHE_DIR is read when app is imported
+os.environ["FDA_APP_CACHE_DIR"] = tempfile.mkdtemp(prefix="fda-app-tests-")
+
+from streamlit import logger as streamlit_logger  # noqa: E402
+
+# Bare mode warns about the missing ScriptRunContext on every session access
+streamlit_logger.set_log_level("error")
@@ -0,0 +1,64 @@
+import json
+
+import app
+
+
+def fill(log, count):
+    types = ["info", "warning", "error", "spell", "success"]
+    for i in range(count):
+        log.append(f"message {i}", types[i % len(types)])
+
+
+def test_buffer_is_bounded_and_indexes_follow_evictions():
+    log = app.ActivityLog(max_entries=10)
+    fill(log, 25)
+    assert len(log) == 10 and log.total == 25
+    entries = log.entries()
+    assert [e["seq"] for e in entries] == list(range(25, 15, -1))
+    assert sum(log.type_counts().values()) == 10
+    assert log.type_counts() == {t: 2 for t in ("info", "warning", "error", "spell", "success")}
+    assert all(e["seq"] > 15 for e in log.entries(types=["error"]))
+
+
+def test_filters_combine_and_return_newest_first():
+    log = app.ActivityLog(max_entries=100)
+    log.append("呼叫 openai 模型", "spell")
+    log.append("OpenAI 速率限制", "warning")
+    log.append("連線失敗", "error")
+    log.append("完成", "success")
+
+    assert [e["message"] for e in log.entries(levels=["info"])] == ["完成", "呼叫 openai 模型"]
+    assert [e["message"] for e in log.entries(levels=["warning", "error"])] == ["連線失敗", "OpenAI 速率限制"]
+    assert [e["type"] for e in log.entries(types=["spell", "success"])] == ["success", "spell"]
+    assert [e["message"] for e in log.entries(query="openai")] == ["OpenAI 速率限制", "呼叫 openai 模型"]
+    assert log.entries(types=["spell", "warning"], levels=["warning"])[0]["message"] == "OpenAI 速率限制"
+    assert len(log.entries(limit=2)) == 2
+    assert log.entries(types=["unknown"]) == []
+
+
+def test_entries_are_ordered_by_sequence_and_time():
+    log = app.ActivityLog(max_entries=5)
+    fill(log, 5)
+    entries = list(reversed(log.entries()))
+    assert [e["seq"] for e in entries] == [1, 2, 3, 4, 5]
+    assert all(a["mono"] <= b["mono"] for a, b in zip(entries, entries[1:]))
+    assert entries[0]["icon"] == app.ACTIVITY_LOG_ICONS["info"]
+
+
+def test_evicted_entries_spill_to_disk_and_export_keeps_full_history(tmp_path):
+    path = tmp_path / "log.jsonl"
+    log = app.ActivityLog(max_entries=10, spill_path=str(path))
+    fill(log, 10 + app.ACTIVITY_LOG_SPILL_BATCH + 3)
+    # Only full batches are written while appending
+    spilled = path.read_text(encoding="utf-8").splitlines()
+    assert len(spilled) == app.ACTIVITY_LOG_SPILL_BATCH
+
+    exported = [json.loads(line) for line in log.export_jsonl().splitlines()]
+    assert [e["seq"] for e in exported] == list(range(1, 10 + app.ACTIVITY_LOG_SPILL_BATCH + 4))
+    assert len(log) == 10
+
+
+def test_without_spill_path_evicted_entries_are_dropped():
+    log = app.ActivityLog(max_entries=3)
+    fill(log, 5)
+    assert [json.loads(line)["seq"] for line in log.export_jsonl().splitlines()] == [3, 4, 5]
@@ -0,0 +1,162 @@
+import os
+import time
+
+import pytest
+
+import app
+
+VALID = """
+agents:
+  - id: summarizer
+    name: 摘要
+    provider: OpenAI
+    system_prompt: Summarize.
+  - id: reviewer
+    provider: anthropic
+    default_model: claude-3-5-haiku-latest
+    cache: false
+    extra_field: kept
+pipelines:
+  - id: review
+    name: 審查流程
+    steps:
+      - agent_id: summarizer
+      - agent_id: reviewer
+        depends_on: summarizer
+"""
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf-8")
+    # Same-second rewrites must still change the signature
+    stamp = time.time() + write.bump
+    write.bump += 1
+    os.utime(path, (stamp, stamp))
+    return str(path)
+
+
+write.bump = 0
+
+
+def problems_of(path):
+    with pytest.raises(app.AgentConfigError) as info:
+        app.AgentRegistry.compile(path)
+    return info.value.problems
+
+
+def test_repository_agents_yaml_is_valid():
+    registry = app.AgentRegistry.compile(app.AGENTS_CONFIG_PATH)
+    assert registry.agents and registry.pipelines
+    for pipeline_id in registry.pipelines:
+        assert registry.pipeline_steps(pipeline_id)
+
+
+def test_compile_normalizes_agents_and_resolves_pipelines(tmp_path):
+    registry = app.AgentRegistry.compile(write(tmp_path / "agents.yaml", VALID))
+    assert registry.agents["summarizer"]["provider"] == "openai"
+    assert registry.agents["reviewer"]["name"] == "reviewer"
+    assert registry.agents["reviewer"]["extra_field"] == "kept"
+    assert "cache_nonzero_temperature" not in registry.agents["reviewer"]
+    assert registry.pipelines_by_name["審查流程"]["id"] == "review"
+    assert [s["depends_on"] for s in registry.pipeline_steps("review")] == [[], ["summarizer"]]
+
+
+def test_every_problem_is_reported(tmp_path):
+    problems = problems_of(write(tmp_path / "agents.yaml", """
+agents:
+  - id: a
+    provider: openai
+  - id: a
+  - id: b
+    provider: nobody
+  - name: missing id
+pipelines:
+  - id: p1
+    steps:
+      - agent_id: ghost
+  - id: p2
+    steps: []
+  - id: p3
+    steps:
+      - agent_id: a
+        depends_on: a#2
+"""))
+    text = "\n".join(problems)
+    assert "代理 id 重複：a" in text
+    assert "未知的供應商 nobody" in text
+    assert "代理 #4 欄位 id" in text
+    assert "流程 p1 參照不存在的代理：ghost" in text
+    assert "流程 p2 欄位 steps" in text
+    assert "參照不存在的步驟：a#2" in text
+    assert len(problems) == 6
+
+
+def test_duplicate_yaml_keys_are_rejected(tmp_path):
+    problems = problems_of(write(tmp_path / "agents.yaml", """
+agents:
+  - id: a
+    system_prompt: first
+    system_prompt: second
+"""))
+    assert "重複的鍵 'system_prompt'" in problems[0]
+
+
+def test_duplicate_pipeline_names_and_non_mapping_root(tmp_path):
+    problems = problems_of(write(tmp_path / "agents.yaml", """
+agents:
+  - id: a
+pipelines:
+  - id: p1
+    name: same
+    steps: [{agent_id: a}]
+  - id: p2
+    name: same
+    steps: [{agent_id: a}]
+"""))
+    assert problems == ["流程名稱重複：same"]
+    assert problems_of(write(tmp_path / "list.yaml", "- a\n- b\n"))
+
+
+def test_unreadable_files_are_config_errors(tmp_path):
+    path = tmp_path / "agents.yaml"
+    path.write_bytes(b"agents:\n  - id: \xff\xfe\n")
+    assert "UTF-8" in problems_of(str(path))[0]
+    assert "無法讀取檔案" in problems_of(str(tmp_path))[0]
+
+
+def test_missing_file_is_an_empty_registry(tmp_path):
+    registry = app.AgentRegistry.compile(str(tmp_path / "absent.yaml"))
+    assert registry.agents == {} and registry.signature is None
+
+
+def test_cache_keeps_last_good_registry_and_recompiles_only_on_change(tmp_path, monkeypatch):
+    path = write(tmp_path / "agents.yaml", VALID)
+    compiles = []
+    compile_ = app.AgentRegistry.compile
+    monkeypatch.setattr(
+        app.AgentRegistry, "compile", classmethod(lambda cls, p: compiles.append(p) or compile_(p))
+    )
+    cache = app.AgentRegistryCache()
+    good = cache.get(path)
+    assert cache.get(path) is good and len(compiles) == 1
+
+    write(tmp_path / "agents.yaml", VALID + "  - id: broken\n    steps: [\n")
+    for _ in range(3):
+        assert cache.get(path) is good
+    assert len(compiles) == 2
+    assert path in cache.errors
+
+    write(tmp_path / "agents.yaml", VALID.replace("摘要", "新摘要"))
+    fixed = cache.get(path)
+    assert fixed is not good and fixed.agents["summarizer"]["name"] == "新摘要"
+    assert path not in cache.errors and len(compiles) == 3
+
+
+def test_cache_reraises_while_no_good_registry_exists(tmp_path):
+    path = write(tmp_path / "agents.yaml", "agents: [\n")
+    cache = app.AgentRegistryCache()
+    for _ in range(2):
+        with pytest.raises(app.AgentConfigError):
+            cache.get(path)
+    write(tmp_path / "agents.yaml", VALID)
+    assert "summarizer" in cache.get(path).agents
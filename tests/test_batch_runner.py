@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+import app
+import batch_runner
+from mock_llm_server import start_mock_server
+
+PIPELINE = "zh_510k_precheck_pipeline"
+
+
+@pytest.fixture(scope="module")
+def mock_server():
+    server, base_url = start_mock_server()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("OPENAI_BASE_URL", base_url)
+        mp.setenv("ANTHROPIC_BASE_URL", base_url[: -len("/v1")])
+        mp.setenv("OPENAI_API_KEY", "test-key")
+        mp.setenv("ANTHROPIC_API_KEY", "test-key")
+        yield server
+    server.shutdown()
+
+
+def write_cases(path, ids):
+    cases = [
+        {"id": case_id, "template": f"{case_id} 裝置描述", "observations": "無", "instructions": ""}
+        for case_id in ids
+    ]
+    path.write_text("\n".join(json.dumps(c, ensure_ascii=False) for c in cases), encoding="utf-8")
+    return str(path)
+
+
+def read_records(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+@pytest.mark.parametrize("provider,model", [
+    ("openai", "gpt-4o-mini"),
+    ("anthropic", "claude-3-5-haiku-latest"),
+])
+def test_deferred_run_against_mock_batch_api(mock_server, tmp_path, provider, model):
+    cases = write_cases(tmp_path / "cases.jsonl", ["K000001", "K000002"])
+    output = tmp_path / "results.jsonl"
+    batches_before = mock_server.stats["batches"]
+    levels = len(app.pipeline_levels(app.AgentRegistry.compile(app.AGENTS_CONFIG_PATH).pipeline_steps(PIPELINE)))
+
+    code = batch_runner.main([
+        "--pipeline", PIPELINE, "--cases", cases, "--output", str(output),
+        "--provider", provider, "--model", model,
+        "--deferred", "--poll-interval", "0.05", "--no-checkpoints",
+    ])
+
+    assert code == 0
+    records = read_records(output)
+    assert sorted(r["case_id"] for r in records) == ["K000001", "K000002"]
+    for record in records:
+        assert record["status"] == "ok", record["error"]
+        assert record["final_output"].startswith("mock: ")
+        assert record["llm_calls"] == levels
+        # The mock reports 10 input / 5 output tokens per request
+        assert (record["input_tokens"], record["output_tokens"]) == (10 * levels, 5 * levels)
+    # One batch per dependency level, shared by both cases
+    assert mock_server.stats["batches"] - batches_before == levels
+
+
+def test_deferred_resume_skips_finished_cases(mock_server, tmp_path, capsys):
+    cases = write_cases(tmp_path / "cases.jsonl", ["K000001", "K000002", "K000003"])
+    output = tmp_path / "results.jsonl"
+    args = [
+        "--pipeline", PIPELINE, "--cases", cases, "--output", str(output),
+        "--provider", "openai", "--model", "gpt-4o-mini",
+        "--deferred", "--poll-interval", "0.05", "--no-checkpoints", "--resume",
+    ]
+    assert batch_runner.main(args + ["--limit", "1"]) == 0
+    assert "1 cases to run, 2 left by --limit\n" in capsys.readouterr().err
+    assert batch_runner.main(args + ["--limit", "1"]) == 0
+    err = capsys.readouterr().err
+    assert "1 cases to run, 1 skipped as done, 1 left by --limit\n" in err
+    assert "1 ok, 0 failed), 1 skipped as done, 1 left by --limit\n" in err
+    assert batch_runner.main(args) == 0
+    assert [r["case_id"] for r in read_records(output)] == ["K000001", "K000002", "K000003"]
+
+
+def test_cases_over_the_session_budget_are_recorded_as_quota_errors(mock_server, tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_SESSION_TOKENS", "1")
+    cases = write_cases(tmp_path / "cases.jsonl", ["K000001"])
+    output = tmp_path / "results.jsonl"
+    batches_before = mock_server.stats["batches"]
+    code = batch_runner.main([
+        "--pipeline", PIPELINE, "--cases", cases, "--output", str(output),
+        "--provider", "openai", "--model", "gpt-4o-mini",
+        "--deferred", "--poll-interval", "0.05", "--no-checkpoints",
+    ])
+    assert code == 1
+    [record] = read_records(output)
+    assert record["status"] == "error" and record["error"].startswith("quota: ")
+    assert record["llm_calls"] == 0
+    assert mock_server.stats["batches"] == batches_before
+
+
+def test_failed_add_withdraws_the_jobs_queued_steps(monkeypatch):
+    steps = app.resolve_pipeline_steps({"id": "p", "steps": [
+        {"agent_id": "a", "input": "raw"},
+        {"agent_id": "b", "input": "raw"},
+    ]})
+    admit = app.admit_llm_call
+    admitted = []
+
+    def admit_once(provider, budget):
+        if admitted:
+            raise app.QuotaExceededError("over budget")
+        admitted.append(provider)
+        admit(provider, budget)
+
+    monkeypatch.setattr(app, "admit_llm_call", admit_once)
+    waves = []
+    results = app.execute_pipelines_deferred(
+        steps,
+        {"job": "input"},
+        lambda job_id, step, step_input: {
+            "provider": "openai", "model": "gpt-4o-mini", "system_prompt": step["id"],
+            "user_prompt": step_input, "max_tokens": 100, "temperature": 0.0, "use_cache": False,
+        },
+        on_wave=lambda wave, total, batch_set: waves.append((len(batch_set), dict(batch_set.batches))),
+    )
+    assert isinstance(results["job"], app.PipelineStepError)
+    assert results["job"].step["id"] == "b"
+    # Step a was queued first but is withdrawn, so no batch is submitted
+    assert waves == [(0, {})]
@@ -0,0 +1,80 @@
+import uuid
+
+import pytest
+
+import app
+
+
+def steps_for(*raw_steps):
+    return app.resolve_pipeline_steps({"id": "p", "steps": list(raw_steps)})
+
+
+def test_checkpoints_resume_after_failure():
+    steps = steps_for({"agent_id": "one"}, {"agent_id": "two"}, {"agent_id": "three"})
+    pipeline_id = f"test-{uuid.uuid4().hex}"
+    calls = []
+    fail_at = {"three"}
+
+    async def run_step(step, step_input):
+        calls.append(step["id"])
+        if step["id"] in fail_at:
+            raise RuntimeError("interrupted")
+        return f"{step['id']}({step_input})"
+
+    def fingerprint(step, step_input):
+        return f"{step['agent_id']}|{step_input}"
+
+    def run(reused):
+        wrapped = app.with_checkpoints(
+            run_step, pipeline_id, "RAW", fingerprint,
+            on_reuse=lambda step, output: reused.append(step["id"]),
+        )
+        return app.execute_pipeline_dag(steps, "RAW", wrapped)
+
+    with pytest.raises(app.PipelineStepError):
+        run([])
+    assert calls == ["one", "two", "three"]
+    store = app.get_pipeline_checkpoint_store()
+    assert store.count(pipeline_id, app.pipeline_input_hash("RAW")) == 2
+
+    calls.clear()
+    fail_at.clear()
+    reused = []
+    outputs = run(reused)
+    assert reused == ["one", "two"]
+    assert calls == ["three"]
+    assert outputs["three"] == "three(two(one(RAW)))"
+
+    # A different raw input shares no checkpoints
+    calls.clear()
+    wrapped = app.with_checkpoints(run_step, pipeline_id, "OTHER", fingerprint)
+    app.execute_pipeline_dag(steps, "OTHER", wrapped)
+    assert calls == ["one", "two", "three"]
+
+
+def test_checkpoints_rerun_a_step_whose_fingerprint_changed():
+    steps = steps_for({"agent_id": "one"}, {"agent_id": "two"})
+    pipeline_id = f"test-{uuid.uuid4().hex}"
+    calls = []
+    prompts = {"one": "v1", "two": "v1"}
+
+    async def run_step(step, step_input):
+        calls.append(step["id"])
+        return f"{step['id']}:{prompts[step['id']]}"
+
+    def fingerprint(step, step_input):
+        return f"{prompts[step['agent_id']]}|{step_input}"
+
+    def run(reuse=True):
+        wrapped = app.with_checkpoints(run_step, pipeline_id, "RAW", fingerprint, reuse=reuse)
+        return app.execute_pipeline_dag(steps, "RAW", wrapped)
+
+    run()
+    calls.clear()
+    prompts["two"] = "v2"
+    assert run()["two"] == "two:v2"
+    assert calls == ["two"]
+
+    calls.clear()
+    run(reuse=False)
+    assert calls == ["one", "two"]
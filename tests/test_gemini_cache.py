@@ -0,0 +1,68 @@
+from types import SimpleNamespace as NS
+
+import pytest
+
+import app
+
+
+class FakeCachedContent:
+    created = []
+
+    def __init__(self, system_instruction):
+        self.system_instruction = system_instruction
+        self.deleted = False
+
+    @classmethod
+    def create(cls, model, system_instruction, ttl):
+        cached = cls(system_instruction)
+        cls.created.append(cached)
+        return cached
+
+    def delete(self):
+        self.deleted = True
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    FakeCachedContent.created = []
+    fake_genai = NS(
+        configure=lambda api_key: None,
+        caching=NS(CachedContent=FakeCachedContent),
+        GenerativeModel=NS(from_cached_content=lambda cached_content: ("model", cached_content)),
+    )
+    monkeypatch.setattr(app, "genai", fake_genai)
+    return app.ProviderClientRegistry()
+
+
+def test_cache_is_created_on_the_second_use(registry):
+    assert registry.get_gemini_cached_model("k", "m", "prompt") is None
+    model = registry.get_gemini_cached_model("k", "m", "prompt")
+    assert model == ("model", FakeCachedContent.created[0])
+    assert registry.get_gemini_cached_model("k", "m", "prompt") is model
+    assert len(FakeCachedContent.created) == 1
+
+
+def test_changed_prompt_deletes_the_slots_previous_cache(registry):
+    for _ in range(2):
+        registry.get_gemini_cached_model("k", "m", "v1", slot="agent")
+    registry.get_gemini_cached_model("k", "m", "v1", slot="other")
+    [v1] = FakeCachedContent.created
+
+    # Still used by another slot
+    registry.get_gemini_cached_model("k", "m", "v2", slot="agent")
+    assert not v1.deleted
+    registry.get_gemini_cached_model("k", "m", "v2", slot="other")
+    assert v1.deleted
+    assert all(key[2] != app.hashlib.sha256(b"v1").hexdigest() for key in registry._gemini_cached)
+
+
+def test_expired_entries_are_pruned(registry, monkeypatch):
+    for _ in range(2):
+        registry.get_gemini_cached_model("k", "m", "old", slot="agent")
+    later = app.time.time() + app.GEMINI_CACHE_TTL_SECONDS + 1
+    monkeypatch.setattr(app.time, "time", lambda: later)
+    assert registry.get_gemini_cached_model("k", "m", "new") is None
+    assert list(registry._gemini_cached) == []
+    assert list(registry._gemini_cache_locks) == []
+    assert list(registry._gemini_slots) == []
+    assert [key[2] for key in registry._gemini_prompt_uses] == [app.hashlib.sha256(b"new").hexdigest()]
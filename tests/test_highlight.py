@@ -0,0 +1,39 @@
+import app
+
+
+def span(text, color="red"):
+    return f"<span style='color:{color}'>{text}</span>"
+
+
+def test_keywords_match_case_and_width_insensitively():
+    out = app.highlight_keywords_in_text("Risk, ＲＩＳＫ and risk", ["risk"], "red")
+    assert out == f"{span('Risk')}, {span('ＲＩＳＫ')} and {span('risk')}"
+
+
+def test_longest_keyword_wins():
+    out = app.highlight_keywords_in_text("risk analysis of risk", ["risk", "risk analysis"], "red")
+    assert out == f"{span('risk analysis')} of {span('risk')}"
+
+
+def test_comparison_operators_are_not_mistaken_for_tags():
+    out = app.highlight_keywords_in_text("p<0.05 risk and x>3 risk", ["risk"], "red")
+    assert out == f"p<0.05 {span('risk')} and x>3 {span('risk')}"
+
+
+def test_existing_highlights_are_not_matched_inside_their_tags():
+    once = app.highlight_keywords_in_text("risk color", ["risk"], "red")
+    twice = app.highlight_keywords_in_text(once, ["span", "style", "color", "risk"], "blue")
+    assert twice == f"<span style='color:red'>{span('risk', 'blue')}</span> {span('color', 'blue')}"
+
+
+def test_empty_inputs_are_returned_unchanged():
+    assert app.highlight_keywords_in_text("", ["risk"], "red") == ""
+    assert app.highlight_keywords_in_text("risk", [], "red") == "risk"
+    assert app.highlight_keywords_in_text("risk", ["  "], "red") == "risk"
+
+
+def test_strip_highlight_markup_restores_the_text():
+    text = "p<0.05 risk and x>3 風險"
+    marked = app.highlight_keywords_in_text(text, ["risk", "風險"], "red")
+    assert marked != text
+    assert app.strip_highlight_markup(marked) == text
@@ -0,0 +1,29 @@
+import pytest
+
+import app
+
+pymupdf = pytest.importorskip("pymupdf")
+
+
+def make_pdf(*lines):
+    doc = pymupdf.open()
+    for line in lines:
+        doc.new_page().insert_text((72, 72), line)
+    return doc.tobytes()
+
+
+def test_text_layers_are_stored_and_reused(monkeypatch):
+    pdf = make_pdf(*(f"Page {i} " + "substantial equivalence testing " * 4 for i in range(2)))
+    text, decisions = app.extract_pdf_hybrid(pdf, [1, 2], "eng")
+    assert [d["method"] for d in decisions] == ["text", "text"]
+
+    keys = app.pdf_page_keys(pdf, [1, 2])
+    stored = app.get_ocr_page_store().get_many(list(keys.values()), "text", 0, app.fast_text_engine())
+    assert len(stored) == 2
+
+    def no_extraction(*_args):
+        raise AssertionError("page text should come from the store")
+
+    doc = app.get_pdf_cache().get(pdf, app.pdf_digest(pdf))
+    monkeypatch.setattr(type(doc), "fast_page_text", no_extraction)
+    assert app.extract_pdf_hybrid(pdf, [1, 2], "eng") == (text, decisions)
@@ -0,0 +1,76 @@
+import app
+
+
+def make_cache(tmp_path, **overrides):
+    settings = dict(max_entries=100, max_bytes=10_000, ttl_seconds=3600)
+    settings.update(overrides)
+    return app.LLMResponseCache(str(tmp_path / "responses.sqlite"), **settings)
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_key_covers_every_input():
+    base = ("openai", "gpt-4o-mini", "system", "user", 0.2, 512)
+    key = app.LLMResponseCache.make_key(*base)
+    assert key == app.LLMResponseCache.make_key(*base)
+    for i, changed in enumerate(["anthropic", "gpt-4o", "system!", "user!", 0.3, 513]):
+        variant = list(base)
+        variant[i] = changed
+        assert app.LLMResponseCache.make_key(*variant) != key
+
+
+def test_hit_and_miss_are_counted(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get("k") is None
+    cache.put("k", "回應")
+    assert cache.get("k") == "回應"
+    assert cache.stats() == {"entries": 1, "bytes": len("回應".encode("utf-8")), "hits": 1, "misses": 1}
+
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app.time, "time", clock)
+    cache = make_cache(tmp_path, ttl_seconds=60)
+    cache.put("k", "v")
+    clock.now += 59
+    assert cache.get("k") == "v"
+    clock.now += 2
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app.time, "time", clock)
+    cache = make_cache(tmp_path, max_entries=2)
+    for key in ("a", "b"):
+        clock.now += 1
+        cache.put(key, key)
+    clock.now += 1
+    assert cache.get("a") == "a"  # b is now the least recently used
+    clock.now += 1
+    cache.put("c", "c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "a" and cache.get("c") == "c"
+
+
+def test_size_limit_evicts_oldest_entries(tmp_path, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app.time, "time", clock)
+    cache = make_cache(tmp_path, max_bytes=25)
+    for key in ("a", "b", "c"):
+        clock.now += 1
+        cache.put(key, key * 10)
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 20
+
+
+def test_cache_survives_reopen(tmp_path):
+    make_cache(tmp_path).put("k", "v")
+    assert make_cache(tmp_path).get("k") == "v"
@@ -0,0 +1,70 @@
+import app
+
+
+def pages(count, text):
+    return {p: f"{text} {p}" for p in range(1, count + 1)}
+
+
+def test_chunks_are_sized_to_the_output_budget():
+    page_texts = pages(10, "word " * 300)
+    count = lambda text: len(text.split())  # noqa: E731
+    chunks = app.build_page_chunks(page_texts, max_chars=10**6, max_tokens=1500, count_tokens=count)
+    assert [c["pages"] for c in chunks] == [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10]]
+    assert all(c["tokens"] * app.OCR_OUTPUT_TOKEN_RATIO <= 1500 for c in chunks)
+    # Without a token budget only the character limit applies
+    assert len(app.build_page_chunks(page_texts, max_chars=10**6)) == 1
+
+
+def test_oversized_page_gets_a_larger_budget_up_to_the_model_limit(monkeypatch):
+    seen = {}
+
+    async def fake_acall_llm(**kwargs):
+        seen[kwargs["user_prompt"].split("\n", 1)[0]] = kwargs["max_tokens"]
+        return "ok"
+
+    monkeypatch.setattr(app, "acall_llm", fake_acall_llm)
+    page_texts = {1: "short page", 2: "x " * 50_000}
+    app.run_chunked_llm_ocr(
+        page_texts, "openai", "gpt-4o-mini", "sys", max_tokens=1500, temperature=0.0,
+        max_chars=10**6,
+    )
+    assert seen["[Part 1/2: pages 1–1]"] == 1500
+    assert seen["[Part 2/2: pages 2–2]"] == 16384
+
+
+def test_failed_and_truncated_chunks_are_reported(monkeypatch):
+    async def fake_acall_llm(**kwargs):
+        header = kwargs["user_prompt"].split("\n", 1)[0]
+        if "pages 2–2" in header:
+            raise RuntimeError("provider down")
+        if "pages 3–3" in header:
+            kwargs["usage"]["truncated"] += 1
+        return f"content of {header}"
+
+    monkeypatch.setattr(app, "acall_llm", fake_acall_llm)
+    markdown, chunks = app.run_chunked_llm_ocr(
+        {1: "one", 2: "two", 3: "three"}, "openai", "gpt-4o-mini", "sys",
+        max_tokens=1500, temperature=0.0, max_chars=40,
+    )
+    assert [c["pages"] for c in chunks] == [[1], [2], [3]]
+    assert "content of [Part 1/3" in markdown and "content of [Part 3/3" in markdown
+    assert "第 2–2 頁處理失敗" in markdown and "provider down" in chunks[1]["error"]
+    assert chunks[2]["truncated"] and not chunks[0].get("truncated")
+
+
+def test_stop_reason_marks_truncated_responses():
+    from types import SimpleNamespace as NS
+
+    cases = [
+        ("openai", NS(choices=[NS(finish_reason="length")]), 1),
+        ("openai", NS(choices=[NS(finish_reason="stop")]), 0),
+        ("anthropic", NS(stop_reason="max_tokens"), 1),
+        ("anthropic", NS(stop_reason="end_turn"), 0),
+        ("gemini", NS(candidates=[NS(finish_reason=NS(name="MAX_TOKENS"))]), 1),
+        ("gemini", NS(candidates=[NS(finish_reason=NS(name="STOP"))]), 0),
+        ("xai", NS(finish_reason="REASON_MAX_LEN"), 1),
+    ]
+    for provider, resp, truncated in cases:
+        usage = app.new_token_usage()
+        app.read_stop_reason(provider, resp, usage)
+        assert usage["truncated"] == truncated, provider
@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import pytest
+
+import app
+
+
+def steps_for(*raw_steps):
+    return app.resolve_pipeline_steps({"id": "p", "steps": list(raw_steps)})
+
+
+def test_resolve_defaults_to_sequential_steps():
+    steps = steps_for({"agent_id": "a"}, {"agent_id": "b"}, {"agent_id": "a"})
+    assert [s["id"] for s in steps] == ["a", "b", "a#2"]
+    assert [s["depends_on"] for s in steps] == [[], ["a"], ["b"]]
+    assert app.pipeline_levels(steps) == [["a"], ["b"], ["a#2"]]
+
+
+def test_resolve_rejects_cycles_and_unknown_steps():
+    with pytest.raises(ValueError, match="循環"):
+        steps_for(
+            {"agent_id": "a", "depends_on": "b"},
+            {"agent_id": "b", "depends_on": "a"},
+        )
+    with pytest.raises(ValueError, match="不存在"):
+        steps_for({"agent_id": "a", "input": "missing"})
+
+
+def test_dag_runs_independent_steps_concurrently():
+    steps = steps_for(
+        {"agent_id": "a", "input": "raw"},
+        {"agent_id": "b", "input": "raw"},
+        {"agent_id": "c", "depends_on": ["a", "b"]},
+    )
+    assert app.pipeline_levels(steps) == [["a", "b"], ["c"]]
+    inputs = {}
+
+    async def run_step(step, step_input):
+        inputs[step["id"]] = step_input
+        await asyncio.sleep(0.2)
+        return step["id"].upper()
+
+    started = time.perf_counter()
+    outputs = app.execute_pipeline_dag(steps, "RAW", run_step, max_concurrency=4)
+    elapsed = time.perf_counter() - started
+
+    assert outputs == {"a": "A", "b": "B", "c": "C"}
+    assert inputs["a"] == inputs["b"] == "RAW"
+    assert "【步驟 a 輸出】\nA" in inputs["c"] and "【步驟 b 輸出】\nB" in inputs["c"]
+    # Critical path is two steps long, not three
+    assert elapsed < 0.55
+
+
+def test_dag_respects_max_concurrency():
+    steps = steps_for(*({"agent_id": f"s{i}", "input": "raw"} for i in range(6)))
+    active = peak = 0
+
+    async def run_step(step, step_input):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.02)
+        active -= 1
+        return step["id"]
+
+    outputs = app.execute_pipeline_dag(steps, "x", run_step, max_concurrency=2)
+    assert len(outputs) == 6
+    assert peak == 2
+
+
+def test_dag_failure_cancels_running_steps_and_keeps_finished_outputs():
+    steps = steps_for(
+        {"agent_id": "fast", "input": "raw"},
+        {"agent_id": "slow", "input": "raw"},
+        {"agent_id": "boom", "depends_on": "fast"},
+    )
+    cancelled = []
+
+    async def run_step(step, step_input):
+        if step["id"] == "slow":
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(step["id"])
+                raise
+        if step["id"] == "boom":
+            raise RuntimeError("provider down")
+        return "ok"
+
+    with pytest.raises(app.PipelineStepError) as info:
+        app.execute_pipeline_dag(steps, "x", run_step)
+    assert info.value.step["id"] == "boom"
+    assert isinstance(info.value.error, RuntimeError)
+    assert info.value.outputs == {"fast": "ok"}
+    assert cancelled == ["slow"]
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def governor(tmp_path, monkeypatch):
+    monkeypatch.setenv("OPENAI_SESSION_TOKENS", "1000")
+    monkeypatch.setenv("OPENAI_DAILY_TOKENS", "1500")
+    monkeypatch.setenv("OPENAI_MAX_IN_FLIGHT", "2")
+    return app.QuotaGovernor(str(tmp_path / "quota.sqlite"))
+
+
+def usage(input_tokens, output_tokens, cached_tokens=0):
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "cached_tokens": cached_tokens}
+
+
+def test_admit_checks_the_session_budget(governor):
+    governor.admit("s1", "openai", 1000)
+    governor.charge("s1", "openai", usage(600, 200), 0.01)
+    governor.admit("s1", "openai", 200)
+    with pytest.raises(app.QuotaExceededError) as info:
+        governor.admit("s1", "openai", 201)
+    assert info.value.provider == "openai"
+    # Another session has its own session budget
+    governor.admit("s2", "openai", 700)
+
+
+def test_daily_budget_is_shared_and_persisted(governor, tmp_path):
+    governor.charge("s1", "openai", usage(900, 0), 0.01)
+    with pytest.raises(app.QuotaExceededError, match="本日"):
+        governor.admit("s2", "openai", 700)
+    reopened = app.QuotaGovernor(str(tmp_path / "quota.sqlite"))
+    with pytest.raises(app.QuotaExceededError, match="本日"):
+        reopened.admit("s3", "openai", 700)
+    reopened.admit("s3", "openai", 600)
+
+
+def test_reservations_hold_tokens_until_released(governor):
+    reservation = governor.reserve("s1", {"openai": 800})
+    with pytest.raises(app.QuotaExceededError):
+        governor.admit("s1", "openai", 300)
+    # Calls of the run itself draw on the reservation first
+    governor.admit("s1", "openai", 900, reservation)
+    governor.charge("s1", "openai", usage(250, 50, cached_tokens=100), 0.02, reservation)
+    assert reservation.remaining("openai") == 500
+    assert governor.release(reservation) == {"openai": 500}
+    governor.admit("s1", "openai", 700)
+    with pytest.raises(app.QuotaExceededError):
+        governor.reserve("s1", {"openai": 701})
+
+
+def test_failed_reservation_reserves_nothing(governor, monkeypatch):
+    monkeypatch.setenv("ANTHROPIC_SESSION_TOKENS", "100")
+    with pytest.raises(app.QuotaExceededError):
+        governor.reserve("s1", {"openai": 500, "anthropic": 500})
+    governor.admit("s1", "openai", 1000)
+
+
+def test_charges_are_totalled_per_session_and_reservation(governor):
+    reservation = governor.reserve("s1", {"openai": 500})
+    governor.charge("s1", "openai", usage(100, 50, cached_tokens=40), 0.25, reservation)
+    governor.charge("s1", "openai", usage(10, 5), 0.5)
+    totals = governor.session_usage("s1")
+    assert totals == {"calls": 2, "input_tokens": 110, "output_tokens": 55, "cached_tokens": 40, "cost": 0.75}
+    assert reservation.usage == {
+        "calls": 1, "input_tokens": 100, "output_tokens": 50, "cached_tokens": 40, "cost": 0.25,
+    }
+    assert governor.session_usage("unknown") == app.new_llm_usage()
+    row = next(r for r in governor.snapshot("s1") if r["provider"] == "openai")
+    assert row["session_tokens"] == 165 and row["daily_tokens"] == 165
+    assert row["reserved"] == 350 and row["session_budget"] == 1000
+
+
+def test_in_flight_slots_are_limited_per_provider(governor):
+    assert governor.try_acquire_slot("openai")
+    assert governor.try_acquire_slot("openai")
+    assert not governor.try_acquire_slot("openai")
+    assert governor.try_acquire_slot("anthropic")
+
+    acquired = threading.Event()
+
+    def waiter():
+        governor.acquire_slot("openai")
+        acquired.set()
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    assert not acquired.wait(0.1)
+    governor.release_slot("openai")
+    assert acquired.wait(2)
+    thread.join()
+    assert next(r for r in governor.snapshot("s1") if r["provider"] == "openai")["in_flight"] == 2
+
+
+def test_unlimited_budget(tmp_path, monkeypatch):
+    monkeypatch.setenv("XAI_SESSION_TOKENS", "0")
+    monkeypatch.setenv("XAI_DAILY_TOKENS", "0")
+    governor = app.QuotaGovernor(str(tmp_path / "quota.sqlite"))
+    governor.charge("s1", "xai", usage(10**9, 0), 1.0)
+    governor.admit("s1", "xai", 10**9)
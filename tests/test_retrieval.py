@@ -0,0 +1,91 @@
+import app
+
+BIOCOMPAT = """# Biocompatibility
+
+Cytotoxicity, sensitization and irritation testing per ISO 10993-1 was completed.
+"""
+
+SOFTWARE = """# Software
+
+The device software follows IEC 62304; the level of concern is moderate.
+"""
+
+STERILITY = """# 滅菌
+
+環氧乙烷滅菌確效依 ISO 11135 執行，無菌保證水準為 10^-6。
+"""
+
+
+def build_index():
+    index = app.CorpusRetrievalIndex()
+    index.sync({
+        "bio": ("bio.pdf", BIOCOMPAT),
+        "sw": ("sw.pdf", SOFTWARE),
+        "ster": ("ster.pdf", STERILITY),
+    })
+    return index
+
+
+def test_tokenizer_keeps_standard_numbers_and_cjk_bigrams():
+    assert app.tokenize_for_retrieval("ISO 10993-1 滅菌確效") == ["iso", "10993-1", "滅菌", "菌確", "確效"]
+
+
+def test_search_ranks_the_relevant_passage_first():
+    index = build_index()
+    assert index.search("ISO 10993-1 cytotoxicity")[0]["filename"] == "bio.pdf"
+    assert index.search("IEC 62304 software")[0]["filename"] == "sw.pdf"
+    assert index.search("滅菌確效")[0]["filename"] == "ster.pdf"
+    assert index.search("unrelated words") == []
+
+
+def test_passages_carry_their_heading():
+    hit = build_index().search("level of concern")[0]
+    assert hit["text"].startswith("# Software")
+
+
+def test_unchanged_documents_are_not_reindexed():
+    index = build_index()
+    passages = dict(index.passages)
+    assert index.sync({
+        "bio": ("renamed.pdf", BIOCOMPAT),
+        "sw": ("sw.pdf", SOFTWARE),
+        "ster": ("ster.pdf", STERILITY),
+    }) == 0
+    assert index.passages == passages
+    assert index.search("cytotoxicity")[0]["filename"] == "renamed.pdf"
+
+
+def test_update_and_removal_keep_statistics_consistent():
+    index = build_index()
+    index.sync({
+        "bio": ("bio.pdf", BIOCOMPAT.replace("Cytotoxicity", "Hemocompatibility")),
+        "sw": ("sw.pdf", SOFTWARE),
+    })
+    assert index.search("cytotoxicity") == []
+    assert index.search("hemocompatibility")[0]["filename"] == "bio.pdf"
+    assert "滅菌" not in index.doc_freq
+
+    fresh = app.CorpusRetrievalIndex()
+    fresh.sync({
+        "bio": ("bio.pdf", BIOCOMPAT.replace("Cytotoxicity", "Hemocompatibility")),
+        "sw": ("sw.pdf", SOFTWARE),
+    })
+    assert index.doc_freq == fresh.doc_freq
+    assert index.total_len == fresh.total_len
+
+
+def test_highlight_markup_is_not_indexed():
+    marked = app.highlight_keywords_in_text(BIOCOMPAT, ["cytotoxicity"], "#ff7f50")
+    index = app.CorpusRetrievalIndex()
+    index.upsert("bio", "bio.pdf", marked)
+    assert not {"span", "style", "color", "ff7f50"} & set(index.doc_freq)
+    assert "<span" not in index.search("cytotoxicity")[0]["text"]
+    # Same text with or without markup is the same version
+    assert index.upsert("bio", "bio.pdf", BIOCOMPAT) is False
+
+
+def test_vector_rerank_returns_the_same_candidates():
+    index = build_index()
+    plain = {hit["filename"] for hit in index.search("ISO testing")}
+    reranked = {hit["filename"] for hit in index.search("ISO testing", vector_rerank=True)}
+    assert reranked == plain